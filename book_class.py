@@ -10,7 +10,22 @@ import sys
 import random
 import time
 import math
-from datetime import datetime, timedelta
+import re
+import statistics
+import argparse
+import threading
+import unicodedata
+import difflib
+import hashlib
+import shutil
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from urllib.parse import urlparse
 from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeout
 from twocaptcha import TwoCaptcha
 import traceback
@@ -84,6 +99,12 @@ def get_stealth_scripts():
     """
 
 
+def human_pause(min_seconds, max_seconds):
+    """Short pause between human-like input events; skipped in background steps (see LOGIN PIPELINE)"""
+    if not IN_BACKGROUND_STEP:
+        time.sleep(random.uniform(min_seconds, max_seconds))
+
+
 def human_mouse_move(page, x, y):
     """Move mouse in a human-like curved path"""
     try:
@@ -106,14 +127,14 @@ def human_mouse_move(page, x, y):
             pos_y = (1-t)**3 * current_y + 3*(1-t)**2*t * ctrl_y1 + 3*(1-t)*t**2 * ctrl_y2 + t**3 * y
             
             page.mouse.move(pos_x, pos_y)
-            time.sleep(random.uniform(0.001, 0.005))
+            human_pause(0.001, 0.005)
         
         # Add small jitter at the end
         for _ in range(random.randint(1, 3)):
             jitter_x = x + random.randint(-2, 2)
             jitter_y = y + random.randint(-2, 2)
             page.mouse.move(jitter_x, jitter_y)
-            time.sleep(random.uniform(0.01, 0.03))
+            human_pause(0.01, 0.03)
             
     except Exception as e:
         print(f"  Mouse movement error (non-critical): {str(e)}")
@@ -129,32 +150,32 @@ def human_type(element, text, page=None):
             
             # Type up to the typo
             for char in text[:typo_pos]:
-                element.type(char, delay=random.uniform(50, 150))
+                element.type(char, delay=random.uniform(50, 150), timeout=bounded_timeout(30000))
             
             # Type wrong character
-            element.type(wrong_char, delay=random.uniform(50, 150))
-            time.sleep(random.uniform(0.1, 0.3))
+            element.type(wrong_char, delay=random.uniform(50, 150), timeout=bounded_timeout(30000))
+            human_pause(0.1, 0.3)
             
             # Delete it (backspace)
-            element.press('Backspace')
-            time.sleep(random.uniform(0.05, 0.15))
+            element.press('Backspace', timeout=bounded_timeout(30000))
+            human_pause(0.05, 0.15)
             
             # Continue with correct text
             for char in text[typo_pos:]:
-                element.type(char, delay=random.uniform(50, 150))
+                element.type(char, delay=random.uniform(50, 150), timeout=bounded_timeout(30000))
         else:
             # Normal typing with variable speed
             for i, char in enumerate(text):
-                element.type(char, delay=random.uniform(50, 200))
+                element.type(char, delay=random.uniform(50, 200), timeout=bounded_timeout(30000))
                 
                 # Occasional longer pause (thinking)
                 if random.random() < 0.1:  # 10% chance
-                    time.sleep(random.uniform(0.2, 0.5))
+                    human_pause(0.2, 0.5)
                     
     except Exception as e:
         # Fallback to regular fill
         print(f"  Human typing failed, using regular fill: {str(e)}")
-        element.fill(text)
+        element.fill(text, timeout=bounded_timeout(30000))
 
 
 def random_scroll(page, direction='down', amount=None):
@@ -173,7 +194,7 @@ def random_scroll(page, direction='down', amount=None):
             else:
                 page.evaluate(f'window.scrollBy(0, -{chunk_size})')
             
-            time.sleep(random.uniform(0.05, 0.15))
+            human_pause(0.05, 0.15)
         
         # Small back-scroll (humans often do this)
         if random.random() < 0.3:
@@ -182,7 +203,7 @@ def random_scroll(page, direction='down', amount=None):
                 page.evaluate(f'window.scrollBy(0, -{back_amount})')
             else:
                 page.evaluate(f'window.scrollBy(0, {back_amount})')
-            time.sleep(random.uniform(0.1, 0.2))
+            human_pause(0.1, 0.2)
             
     except Exception as e:
         print(f"  Scroll error (non-critical): {str(e)}")
@@ -190,6 +211,9 @@ def random_scroll(page, direction='down', amount=None):
 
 def random_mouse_movement(page):
     """Move mouse randomly across the page (like a human browsing)"""
+    if IN_BACKGROUND_STEP:
+        # Nobody watches the background page; its steps must stay short
+        return
     try:
         viewport = page.viewport_size
         if viewport:
@@ -198,46 +222,51 @@ def random_mouse_movement(page):
                 x = random.randint(100, viewport['width'] - 100)
                 y = random.randint(100, viewport['height'] - 100)
                 human_mouse_move(page, x, y)
-                time.sleep(random.uniform(0.1, 0.3))
+                human_pause(0.1, 0.3)
     except Exception as e:
         print(f"  Random mouse movement error (non-critical): {str(e)}")
 
 
 def human_click(element, page=None):
-    """Click element with human-like behavior"""
+    """Click element with human-like behavior
+    
+    Every wait keeps Playwright's 30 s default but is cut to the budget that is left.
+    """
     try:
-        # Move mouse to element first
-        if page:
-            box = element.bounding_box()
+        # Move mouse to element first (not on a background page, whose steps must stay short)
+        if page and not IN_BACKGROUND_STEP:
+            box = element.bounding_box(timeout=bounded_timeout(30000))
             if box:
                 # Click slightly off-center (humans don't click exact center)
                 target_x = box['x'] + box['width'] / 2 + random.randint(-5, 5)
                 target_y = box['y'] + box['height'] / 2 + random.randint(-5, 5)
                 human_mouse_move(page, target_x, target_y)
-                time.sleep(random.uniform(0.1, 0.3))
+                human_pause(0.1, 0.3)
         
         # Slight delay before click
-        time.sleep(random.uniform(0.05, 0.15))
-        element.click()
+        human_pause(0.05, 0.15)
+        element.click(timeout=bounded_timeout(30000))
         
         # Slight delay after click
-        time.sleep(random.uniform(0.1, 0.25))
+        human_pause(0.1, 0.25)
         
     except Exception as e:
         # Fallback to regular click
         print(f"  Human click failed, using regular click: {str(e)}")
-        element.click()
+        element.click(timeout=bounded_timeout(30000))
 
 
 def random_idle_behavior(page):
     """Perform random idle behaviors like a human reading the page"""
+    if IN_BACKGROUND_STEP:
+        return
     try:
         behavior = random.choice(['scroll_tiny', 'mouse_wiggle', 'pause', 'scroll_up_down'])
         
         if behavior == 'scroll_tiny':
             # Small scroll (like reading)
             page.evaluate(f'window.scrollBy(0, {random.randint(-30, 50)})')
-            time.sleep(random.uniform(0.1, 0.3))
+            human_pause(0.1, 0.3)
             
         elif behavior == 'mouse_wiggle':
             # Small mouse movements
@@ -250,1094 +279,4943 @@ def random_idle_behavior(page):
                         current_x + random.randint(-30, 30),
                         current_y + random.randint(-30, 30)
                     )
-                    time.sleep(random.uniform(0.05, 0.15))
+                    human_pause(0.05, 0.15)
                     
         elif behavior == 'pause':
             # Just pause (reading)
-            time.sleep(random.uniform(0.5, 1.5))
+            human_pause(0.5, 1.5)
             
         elif behavior == 'scroll_up_down':
             # Scroll down then back up (checking something)
             page.evaluate(f'window.scrollBy(0, {random.randint(100, 200)})')
-            time.sleep(random.uniform(0.2, 0.5))
+            human_pause(0.2, 0.5)
             page.evaluate(f'window.scrollBy(0, -{random.randint(50, 100)})')
-            time.sleep(random.uniform(0.1, 0.3))
+            human_pause(0.1, 0.3)
             
     except Exception as e:
         print(f"  Idle behavior error (non-critical): {str(e)}")
 
 
-def load_config():
-    """Load configuration from config.json"""
-    with open('config.json', 'r') as f:
-        return json.load(f)
+# ============================================================
+# RUN METRICS (OpenMetrics textfile exporter)
+# ============================================================
 
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800)
 
-def get_password():
-    """Get password from environment variable"""
-    password = os.environ.get('MINDBODY_PASSWORD')
-    if not password:
-        raise ValueError("MINDBODY_PASSWORD environment variable not set")
-    return password
+METRIC_FAMILIES = {
+    'mindbody_booking_attempts': ('counter', 'Booking attempts started'),
+    'mindbody_booking_successes': ('counter', 'Classes booked and verified'),
+    'mindbody_booking_failures': ('counter', 'Failed booking attempts by reason'),
+    'mindbody_captcha_encounters': ('counter', 'CAPTCHA pages encountered by stage'),
+    'mindbody_retries': ('counter', 'Retries by kind'),
+    'mindbody_runs': ('counter', 'Booking runs by outcome'),
+    'mindbody_selector_demotions': ('counter', 'Cached selectors that stopped matching, by element'),
+    'mindbody_budget_cuts': ('counter', 'Classes and retries skipped for lack of time budget'),
+    'mindbody_deep_link_jumps': ('counter', 'Cached booking links opened, by outcome (ok or fallback)'),
+    'mindbody_probe_requests': ('counter', 'Availability probe requests by result'),
+    'mindbody_phase_duration_seconds': ('histogram', 'Time spent in each booking phase'),
+    'mindbody_run_duration_seconds': ('histogram', 'Total duration of a booking run'),
+    'mindbody_browser_launch_duration_seconds': ('histogram', 'Time to launch the browser'),
+    'mindbody_login_duration_seconds': ('histogram', 'Time to complete the login flow'),
+    'mindbody_time_to_first_navigation_seconds': ('histogram', 'Time from run start to the first page navigation'),
+    'mindbody_last_run_timestamp_seconds': ('gauge', 'Unix time the last run finished'),
+    'mindbody_last_run_success': ('gauge', '1 if every class of the last run was booked'),
+}
 
 
-def get_captcha_api_key(config):
-    """Get 2captcha API key from config"""
-    api_key = config.get('captcha_api_key')
-    if not api_key:
-        raise ValueError("captcha_api_key not found in config.json")
-    return api_key
+class RunMetrics:
+    """Small in-process metrics registry rendered as OpenMetrics text"""
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}      # (family, labels) -> value for counters and gauges
+        self.histograms = {}   # (family, labels) -> [bucket counts, sum, count]
 
-def human_delay(min_ms=1000, max_ms=3000):
-    """Add random human-like delay"""
-    delay = random.randint(min_ms, max_ms)
-    time.sleep(delay / 1000.0)
+    def inc(self, family, labels=None, value=1):
+        key = (family, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
 
+    def set(self, family, value, labels=None):
+        key = (family, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.samples[key] = value
 
-def extract_recaptcha_sitekey(page):
-    """Extract the reCAPTCHA sitekey from the page"""
+    def observe(self, family, seconds, labels=None):
+        key = (family, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(DURATION_BUCKETS), 0.0, 0))
+            buckets = [n + (1 if seconds <= bound else 0) for n, bound in zip(buckets, DURATION_BUCKETS)]
+            self.histograms[key] = (buckets, total + seconds, count + 1)
+
+    def render(self):
+        """Render every metric family in the OpenMetrics text exposition format"""
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(
+                f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                for k, v in pairs
+            ) + '}'
+
+        lines = []
+        with self.lock:
+            for family, (metric_type, help_text) in METRIC_FAMILIES.items():
+                lines.append(f'# TYPE {family} {metric_type}')
+                lines.append(f'# HELP {family} {help_text}')
+                if metric_type == 'histogram':
+                    for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                        if name != family:
+                            continue
+                        for bound, n in zip(DURATION_BUCKETS, buckets):
+                            lines.append(f'{family}_bucket{fmt_labels(labels, [("le", float(bound))])} {n}')
+                        lines.append(f'{family}_bucket{fmt_labels(labels, [("le", "+Inf")])} {count}')
+                        lines.append(f'{family}_sum{fmt_labels(labels)} {total:.6f}')
+                        lines.append(f'{family}_count{fmt_labels(labels)} {count}')
+                else:
+                    suffix = '_total' if metric_type == 'counter' else ''
+                    for (name, labels), value in sorted(self.samples.items()):
+                        if name == family:
+                            lines.append(f'{family}{suffix}{fmt_labels(labels)} {value}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = RunMetrics()
+CURRENT_PHASE = 'startup'
+
+
+@contextmanager
+def phase(name):
+    """Mark the current booking phase and record how long it took"""
+    global CURRENT_PHASE
+    previous = CURRENT_PHASE
+    CURRENT_PHASE = name
+    start = time.monotonic()
     try:
-        print("  Extracting reCAPTCHA sitekey...")
-        
-        # Method 1: Look for data-sitekey attribute in divs
-        sitekey_elem = page.query_selector('[data-sitekey]')
-        if sitekey_elem:
-            sitekey = sitekey_elem.get_attribute('data-sitekey')
-            if sitekey:
-                print(f"  ✓ Found sitekey via data-sitekey attribute: {sitekey}")
-                return sitekey
-        
-        # Method 2: Extract from reCAPTCHA iframe src
-        recaptcha_frames = page.query_selector_all('iframe[src*="recaptcha"]')
-        for frame in recaptcha_frames:
-            src = frame.get_attribute('src')
-            if src and 'k=' in src:
-                # Extract sitekey from URL parameter k=SITEKEY
-                import re
-                match = re.search(r'[?&]k=([^&]+)', src)
-                if match:
-                    sitekey = match.group(1)
-                    print(f"  ✓ Found sitekey from iframe URL: {sitekey}")
-                    return sitekey
-        
-        # Method 3: Search in page source for grecaptcha.render or grecaptcha.execute calls
-        page_content = page.content()
-        import re
-        patterns = [
-            r'grecaptcha\.render\([^,]+,\s*{\s*["\']?sitekey["\']?\s*:\s*["\']([^"\']+)["\']',
-            r'grecaptcha\.execute\(["\']([^"\']+)["\']',
-            r'data-sitekey=["\']([^"\']+)["\']'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, page_content)
-            if match:
-                sitekey = match.group(1)
-                print(f"  ✓ Found sitekey in page source: {sitekey}")
-                return sitekey
-        
-        print("  ✗ Could not find reCAPTCHA sitekey")
-        return None
-        
+        yield
+    finally:
+        METRICS.observe('mindbody_phase_duration_seconds', time.monotonic() - start, {'phase': name})
+        CURRENT_PHASE = previous
+
+
+def record_failure(reason):
+    """Count a failed booking attempt under a short machine-readable reason"""
+    METRICS.inc('mindbody_booking_failures', {'reason': reason})
+
+
+def write_metrics_textfile(config):
+    """Atomically write the metrics textfile (for node_exporter's textfile collector)"""
+    path = config.get('metrics', {}).get('textfile', 'metrics/mindbody_booking.prom')
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(METRICS.render())
+        os.replace(tmp_path, path)
+        print(f"Metrics written to {path}")
     except Exception as e:
-        print(f"  Error extracting sitekey: {str(e)}")
+        print(f"Could not write metrics textfile (non-critical): {str(e)}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the live metrics registry on /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """Expose /metrics from a background thread for the lifetime of the process"""
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://0.0.0.0:{port}/metrics")
+    return server
+
+
+# ============================================================
+# RUN BUDGET
+# ============================================================
+
+# Monotonic deadlines of the whole run and of the current scope (one class,
+# login); None means unlimited
+RUN_DEADLINE = None
+SCOPE_DEADLINE = None
+BUDGET_CUTS = []
+
+
+def start_run_budget(config):
+    """Start the run-wide deadline from budget.run_seconds"""
+    global RUN_DEADLINE
+    BUDGET_CUTS.clear()
+    run_seconds = config.get('budget', {}).get('run_seconds')
+    RUN_DEADLINE = time.monotonic() + run_seconds if run_seconds else None
+
+
+def budget_remaining():
+    """Seconds left before the nearest deadline, or None when no budget applies"""
+    deadlines = [d for d in (RUN_DEADLINE, SCOPE_DEADLINE) if d is not None]
+    if not deadlines:
         return None
+    return max(0.0, min(deadlines) - time.monotonic())
 
 
-def inject_recaptcha_solution(page, solution_token):
-    """Inject the reCAPTCHA solution token into the page"""
+def budget_exhausted():
+    """True once the nearest deadline has passed"""
+    remaining = budget_remaining()
+    return remaining is not None and remaining <= 0
+
+
+@contextmanager
+def budget_scope(seconds):
+    """Limit everything inside the block to `seconds` (and to the run deadline)"""
+    global SCOPE_DEADLINE
+    previous = SCOPE_DEADLINE
+    SCOPE_DEADLINE = time.monotonic() + seconds if seconds else None
+    if previous is not None:
+        SCOPE_DEADLINE = min(SCOPE_DEADLINE or previous, previous)
     try:
-        print("  Injecting reCAPTCHA solution...")
-        
-        # Method 1: Set g-recaptcha-response textarea value
-        inject_script = f"""
-        (function() {{
-            // Find all g-recaptcha-response textareas
-            var elements = document.getElementsByName('g-recaptcha-response');
-            for (var i = 0; i < elements.length; i++) {{
-                elements[i].innerHTML = '{solution_token}';
-                elements[i].value = '{solution_token}';
-            }}
-            
-            // Also set by ID if exists
-            var byId = document.getElementById('g-recaptcha-response');
-            if (byId) {{
-                byId.innerHTML = '{solution_token}';
-                byId.value = '{solution_token}';
-            }}
-            
-            // Try to trigger callback
-            if (typeof window.___grecaptcha_cfg !== 'undefined') {{
-                var clients = window.___grecaptcha_cfg.clients;
-                for (var id in clients) {{
-                    var client = clients[id];
-                    if (client && client.callback) {{
-                        try {{
-                            client.callback('{solution_token}');
-                        }} catch(e) {{
-                            console.log('Callback error:', e);
-                        }}
-                    }}
-                }}
-            }}
-            
-            // Alternative callback trigger
-            if (typeof window.recaptchaCallback !== 'undefined') {{
-                try {{
-                    window.recaptchaCallback('{solution_token}');
-                }} catch(e) {{}}
-            }}
-            
-            return true;
-        }})();
-        """
+        yield
+    finally:
+        SCOPE_DEADLINE = previous
+
+
+def bounded_timeout(timeout_ms):
+    """Shorten a Playwright timeout to the budget that is left
+    
+    Never returns 0, which Playwright treats as "no timeout"; an exhausted
+    budget makes the wait fail almost immediately instead.
+    """
+    remaining = budget_remaining()
+    if remaining is None:
+        return timeout_ms
+    return max(1, min(timeout_ms, int(remaining * 1000)))
+
+
+def save_screenshot(page, path):
+    """Save a debug screenshot, within the budget and never raising (screenshots are a side show)"""
+    try:
+        page.screenshot(path=path, timeout=bounded_timeout(10000))
+    except Exception as e:
+        print(f"  Could not save screenshot {path} (non-critical): {str(e)}")
+
+
+def budget_sleep(seconds):
+    """time.sleep() that never sleeps past the budget"""
+    remaining = budget_remaining()
+    time.sleep(seconds if remaining is None else min(seconds, remaining))
+
+
+def record_budget_cut(what, detail):
+    """Remember something that was skipped or cut short for lack of budget"""
+    print(f"  ⏱️ Out of time budget: {what} ({detail})")
+    BUDGET_CUTS.append({'what': what, 'detail': detail})
+    METRICS.inc('mindbody_budget_cuts')
+
+
+def report_budget_cuts():
+    """Print what was skipped or cut short for lack of budget"""
+    if not BUDGET_CUTS:
+        return
+    print("\nSkipped for lack of time budget:")
+    for cut in BUDGET_CUTS:
+        print(f"  {cut['what']}: {cut['detail']}")
+
+
+# ============================================================
+# PLAYWRIGHT CALL ACCOUNTING
+# ============================================================
+
+# Methods that only build selectors or register listeners locally (no driver round trip)
+LOCAL_METHODS = {
+    'locator', 'frame_locator', 'get_by_role', 'get_by_text', 'get_by_label', 'get_by_placeholder',
+    'get_by_alt_text', 'get_by_title', 'get_by_test_id', 'nth', 'filter', 'or_', 'and_',
+    'on', 'once', 'remove_listener', 'is_closed', 'expect_response', 'expect_request',
+    'expect_navigation', 'expect_event', 'expect_popup', 'expect_download'
+}
+
+
+class CallStats:
+    """Counts and latency of Playwright calls, by method, calling helper and booking phase"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # (method, caller, phase) -> [count, total seconds]
+
+    def record(self, method, caller, seconds):
+        key = (method, caller, CURRENT_PHASE)
+        with self.lock:
+            entry = self.calls.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def total_calls(self):
+        with self.lock:
+            return sum(count for count, _ in self.calls.values())
+
+    def report(self, top_n=15):
+        """Print the most expensive methods and helpers, and the calls spent in each phase"""
+        with self.lock:
+            calls = dict(self.calls)
+        if not calls:
+            return
         
-        page.evaluate(inject_script)
-        print("  ✓ Solution token injected successfully")
+        by_method = {}
+        by_caller = {}
+        by_phase = {}
+        for (method, caller, phase_name), (count, seconds) in calls.items():
+            for totals, key in ((by_method, method), (by_caller, caller), (by_phase, phase_name)):
+                entry = totals.setdefault(key, [0, 0.0])
+                entry[0] += count
+                entry[1] += seconds
         
-        # Give the page a moment to process the solution
-        time.sleep(1)
+        print("\n" + "="*60)
+        print(f"PLAYWRIGHT CALLS (top {top_n} by time)")
+        print("="*60)
+        print(f"{'method':<34}{'calls':>8}{'total':>10}{'avg':>9}")
+        for method, (count, seconds) in sorted(by_method.items(), key=lambda item: -item[1][1])[:top_n]:
+            print(f"{method:<34}{count:>8}{seconds:>9.2f}s{seconds / count * 1000:>7.1f}ms")
+        print("-"*60)
+        print(f"{'helper':<34}{'calls':>8}{'total':>10}")
+        for caller, (count, seconds) in sorted(by_caller.items(), key=lambda item: -item[1][0])[:top_n]:
+            print(f"{caller:<34}{count:>8}{seconds:>9.2f}s")
+        print("-"*60)
+        print(f"{'phase':<34}{'calls':>8}{'total':>10}")
+        for phase_name, (count, seconds) in sorted(by_phase.items(), key=lambda item: -item[1][0]):
+            print(f"{phase_name:<34}{count:>8}{seconds:>9.2f}s")
+        print(f"{'all phases':<34}{sum(c for c, _ in by_phase.values()):>8}")
+        print("="*60)
+
+
+CALL_STATS = CallStats()
+
+
+def is_playwright_object(value):
+    """True for objects of the Playwright sync API (Page, Locator, ElementHandle, Mouse...)"""
+    return type(value).__module__.startswith('playwright.sync_api')
+
+
+class InstrumentedProxy:
+    """Wrap a Playwright object so every call through it (and through the objects it returns) is timed"""
+
+    def __init__(self, target, stats, owner=None):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_stats', stats)
+        # The page this object belongs to, for the live handle counter
+        object.__setattr__(self, '_owner', target if type(target).__name__ == 'Page' else owner)
+
+    def _wrap(self, value):
+        if is_playwright_object(value):
+            if type(value).__name__ in HANDLE_TYPES:
+                LIVE_HANDLES.created(self._owner)
+            return InstrumentedProxy(value, self._stats, self._owner)
+        if isinstance(value, list) and value and all(is_playwright_object(item) for item in value):
+            return [self._wrap(item) for item in value]
+        return value
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value) or is_playwright_object(value):
+            # Properties such as page.mouse, page.frames or locator.first
+            return self._wrap(value)
         
-        return True
+        method = f"{type(self._target).__name__}.{name}"
         
-    except Exception as e:
-        print(f"  ✗ Error injecting solution: {str(e)}")
-        return False
+        def call(*args, **kwargs):
+            args = [unwrap(arg) for arg in args]
+            kwargs = {key: unwrap(arg) for key, arg in kwargs.items()}
+            if name in LOCAL_METHODS:
+                return self._wrap(value(*args, **kwargs))
+            if name == 'dispose' and type(self._target).__name__ in HANDLE_TYPES:
+                LIVE_HANDLES.disposed(self._owner)
+            caller = sys._getframe(1).f_code.co_name
+            start = time.perf_counter()
+            try:
+                return self._wrap(value(*args, **kwargs))
+            finally:
+                self._stats.record(method, caller, time.perf_counter() - start)
+        return call
 
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
 
-def solve_recaptcha_v2(page, config, max_retries=None):
-    """Solve reCAPTCHA v2 using 2captcha service"""
-    if max_retries is None:
-        max_retries = config.get('captcha_max_retries', 5)
+    def __eq__(self, other):
+        return self._target == unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __repr__(self):
+        return f"<instrumented {self._target!r}>"
+
+
+def unwrap(value):
+    """Return the real Playwright object behind an InstrumentedProxy"""
+    return value._target if isinstance(value, InstrumentedProxy) else value
+
+
+def instrument(target, stats=None):
+    """Start accounting every Playwright call made through target"""
+    return InstrumentedProxy(target, stats or CALL_STATS)
+
+
+# ============================================================
+# HANDLE LIFECYCLE
+# ============================================================
+
+# Objects that pin a browser-side object until disposed (locators do not)
+HANDLE_TYPES = {'ElementHandle', 'JSHandle'}
+
+
+class LiveHandleCounter:
+    """Debug count of element/JS handles created and not yet disposed, per page
     
-    print(f"\n{'='*60}")
-    print("🤖 ATTEMPTING AUTOMATIC CAPTCHA SOLVING WITH 2CAPTCHA")
-    print(f"{'='*60}")
+    Fed by InstrumentedProxy, so it only sees calls made through instrumented
+    objects (--trace-calls, bench soak).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def created(self, owner):
+        with self.lock:
+            self.counts[owner] = self.counts.get(owner, 0) + 1
+
+    def disposed(self, owner):
+        with self.lock:
+            self.counts[owner] = self.counts.get(owner, 0) - 1
+
+    def live(self, owner):
+        with self.lock:
+            return self.counts.get(unwrap(owner), 0)
+
+    def report(self):
+        """Print the live handles left on each page"""
+        with self.lock:
+            counts = dict(self.counts)
+        if not counts:
+            return
+        print("\nLive element handles per page:")
+        for owner, count in counts.items():
+            try:
+                url = owner.url if owner is not None else '(no page)'
+            except Exception:
+                url = '(closed page)'
+            print(f"  {url}: {count}")
+
+
+LIVE_HANDLES = LiveHandleCounter()
+
+
+class HandleScope:
+    """Dispose every handle created inside a `with` block when it ends
     
-    for attempt in range(1, max_retries + 1):
-        print(f"\n--- Attempt {attempt}/{max_retries} ---")
-        
+        with HandleScope() as handles:
+            elem = handles.track(page.query_selector(selector))
+    """
+
+    def __init__(self):
+        self.handles = []
+
+    def track(self, value):
+        """Register a handle (or a list of handles, or None) and return it unchanged"""
+        if isinstance(value, list):
+            self.handles.extend(value)
+        elif value is not None:
+            self.handles.append(value)
+        return value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            try:
+                handle.dispose()
+            except Exception:
+                # Already gone with its page or frame
+                pass
+        self.handles = []
+
+
+# ============================================================
+# SAMPLING PROFILER
+# ============================================================
+
+class SamplingProfiler:
+    """Sample the main thread's Python stack on a background thread
+    
+    Every stack is rooted at the booking phase it was taken in and at its
+    state: "cpu" when the main thread used the CPU since the previous sample,
+    "driver wait" when it was blocked in a Playwright call, "idle" otherwise
+    (human delays, sleeps).
+    """
+
+    def __init__(self, interval=0.005, phases=None):
+        self.interval = interval
+        self.phases = set(phases) if phases else None
+        self.samples = {}  # tuple of frame labels -> [count, seconds]
+        self.started = None
+        self.duration = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.main_id = threading.main_thread().ident
         try:
-            # Extract sitekey
-            sitekey = extract_recaptcha_sitekey(page)
-            if not sitekey:
-                print(f"  ✗ Could not extract sitekey (attempt {attempt}/{max_retries})")
-                if attempt < max_retries:
-                    print(f"  Waiting 3 seconds before retry...")
-                    time.sleep(3)
-                    continue
-                else:
-                    return False
-            
-            # Get page URL
-            page_url = page.url
-            print(f"  Page URL: {page_url}")
-            print(f"  Sitekey: {sitekey}")
-            
-            # Initialize 2captcha solver
-            api_key = get_captcha_api_key(config)
-            solver = TwoCaptcha(api_key)
+            self.cpu_clock = time.pthread_getcpuclockid(self.main_id)
+        except (AttributeError, OSError):
+            self.cpu_clock = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.duration = time.monotonic() - self.started
+
+    def _cpu_time(self):
+        return time.clock_gettime(self.cpu_clock) if self.cpu_clock is not None else None
+
+    def _run(self):
+        last_wall, last_cpu = time.monotonic(), self._cpu_time()
+        while not self.stop_event.wait(self.interval):
+            now, cpu = time.monotonic(), self._cpu_time()
+            elapsed = now - last_wall
+            busy = cpu is not None and cpu - last_cpu >= elapsed * 0.5
+            last_wall, last_cpu = now, cpu
             
-            print(f"  📤 Sending CAPTCHA to 2captcha service...")
-            print(f"  ⏳ This may take 30-60 seconds...")
+            phase_name = CURRENT_PHASE
+            if self.phases and phase_name not in self.phases:
+                continue
+            frame = sys._current_frames().get(self.main_id)
+            if frame is None:
+                continue
             
-            # Send CAPTCHA to 2captcha and wait for solution
-            try:
-                result = solver.recaptcha(
-                    sitekey=sitekey,
-                    url=page_url
-                )
-                
-                solution_token = result['code']
-                print(f"  ✓ Received solution from 2captcha!")
-                print(f"  Solution token: {solution_token[:50]}...")
-                
+            stack = []
+            in_driver = False
+            while frame is not None:
+                code = frame.f_code
+                if '/playwright/' in code.co_filename.replace('\\', '/'):
+                    in_driver = True
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if busy:
+                state = 'cpu'
+            else:
+                state = 'driver wait' if in_driver else 'idle'
+            key = (f"phase:{phase_name}", state) + tuple(reversed(stack))
+            entry = self.samples.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def summary(self):
+        """Print sampled seconds per phase, split into CPU, driver waits and idle time"""
+        totals = {}
+        for (phase_label, state, *_), (_, seconds) in self.samples.items():
+            totals.setdefault(phase_label[len('phase:'):], {}).setdefault(state, 0.0)
+            totals[phase_label[len('phase:'):]][state] += seconds
+        print("\n" + "="*60)
+        print(f"PYTHON PROFILE ({sum(c for c, _ in self.samples.values())} samples, {self.duration:.1f}s)")
+        print("="*60)
+        print(f"{'phase':<20}{'cpu':>10}{'driver wait':>14}{'idle':>10}")
+        for phase_name, states in sorted(totals.items(), key=lambda item: -sum(item[1].values())):
+            print(f"{phase_name:<20}{states.get('cpu', 0):>9.2f}s{states.get('driver wait', 0):>13.2f}s"
+                  f"{states.get('idle', 0):>9.2f}s")
+        print("="*60)
+
+    def write_collapsed(self, path):
+        """Write Brendan Gregg's collapsed-stack format (one 'a;b;c count' line per stack)"""
+        with open(path, 'w') as f:
+            for stack, (count, _) in sorted(self.samples.items()):
+                f.write(';'.join(label.replace(';', ':') for label in stack) + f" {count}\n")
+
+    def write_speedscope(self, path):
+        """Write a sampled speedscope profile weighted by wall time"""
+        frames, frame_index = [], {}
+        samples, weights = [], []
+        for stack, (_, seconds) in self.samples.items():
+            indexes = []
+            for label in stack:
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    frames.append({'name': label})
+                indexes.append(frame_index[label])
+            samples.append(indexes)
+            weights.append(seconds)
+        with open(path, 'w') as f:
+            json.dump({
+                '$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'shared': {'frames': frames},
+                'profiles': [{
+                    'type': 'sampled',
+                    'name': 'book_class.py',
+                    'unit': 'seconds',
+                    'startValue': 0,
+                    'endValue': sum(weights),
+                    'samples': samples,
+                    'weights': weights
+                }],
+                'exporter': 'book_class.py'
+            }, f)
+
+    def write(self, path):
+        """Write the profile, as speedscope JSON for *.json paths and collapsed stacks otherwise"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith('.json'):
+            self.write_speedscope(path)
+        else:
+            self.write_collapsed(path)
+        print(f"Profile written to {path}")
+
+
+def get_profile_path(config, path):
+    """Default profile location: next to the metrics textfile, timestamped"""
+    if path:
+        return path
+    directory = os.path.dirname(config.get('metrics', {}).get('textfile', 'metrics/mindbody_booking.prom'))
+    return os.path.join(directory, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.speedscope.json")
+
+
+# ============================================================
+# BROWSER LAUNCH PROFILES
+# ============================================================
+
+# Always passed to Chromium, whatever the profile (see ANTI_BOT_FEATURES.md)
+BASE_LAUNCH_ARGS = [
+    '--disable-blink-features=AutomationControlled',
+    '--disable-dev-shm-usage',
+    '--no-sandbox',
+    '--disable-web-security',
+    '--disable-features=IsolateOrigins,site-per-process'
+]
+
+DEFAULT_LAUNCH_PROFILE = {
+    'headless': False,
+    'disable_gpu': False,
+    'disable_extensions': False,
+    'disable_background_throttling': False,
+    'renderer_process_limit': None,
+    'extra_args': [],
+    'viewport': {'width': [1900, 1920], 'height': [1040, 1080]},
+    'device_scale_factor': 1,
+}
+
+
+def get_launch_profile(config, name=None):
+    """Return the named launch profile from config.json merged over the defaults"""
+    profiles = config.get('launch_profiles', {})
+    name = name or config.get('launch_profile', 'headed-debug')
+    if name not in profiles and name != 'headed-debug':
+        raise ValueError(f"Unknown launch profile '{name}' (available: {', '.join(sorted(profiles)) or 'none'})")
+    profile = dict(DEFAULT_LAUNCH_PROFILE)
+    profile.update(profiles.get(name, {}))
+    profile['name'] = name
+    return profile
+
+
+def get_launch_options(profile):
+    """Build chromium.launch() keyword arguments for a launch profile"""
+    args = list(BASE_LAUNCH_ARGS)
+    if profile['disable_gpu']:
+        args += ['--disable-gpu', '--disable-software-rasterizer']
+    if profile['disable_extensions']:
+        args += ['--disable-extensions', '--disable-component-extensions-with-background-pages']
+    if profile['disable_background_throttling']:
+        args += [
+            '--disable-background-timer-throttling',
+            '--disable-backgrounding-occluded-windows',
+            '--disable-renderer-backgrounding'
+        ]
+    if profile['renderer_process_limit']:
+        args.append(f"--renderer-process-limit={profile['renderer_process_limit']}")
+    args += profile['extra_args']
+    return {'headless': profile['headless'], 'args': args}
+
+
+def get_context_options(profile):
+    """Build browser.new_context() keyword arguments for a launch profile"""
+    def pick(value):
+        # A [min, max] pair randomizes the dimension slightly on every run
+        return random.randint(value[0], value[1]) if isinstance(value, list) else value
+    
+    return {
+        'viewport': {'width': pick(profile['viewport']['width']), 'height': pick(profile['viewport']['height'])},
+        'device_scale_factor': profile['device_scale_factor'],
+        'user_agent': get_random_user_agent(),
+        'locale': 'en-US',
+        'timezone_id': 'America/Toronto',
+        'permissions': ['geolocation'],
+        'geolocation': {'latitude': 45.5017, 'longitude': -73.5673},  # Montreal
+    }
+
+
+def process_tree_pids(root_pid):
+    """Return root_pid and all of its descendants (Linux /proc only)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, so split after its closing parenthesis
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+
+def process_rss_bytes(pid):
+    """Return the resident set size of a process in bytes, or 0 if it has exited"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class PeakRssSampler:
+    """Track the peak RSS of this process tree from a background thread
+    
+    Subclasses extend sample(), which is called with the tree's pids on every tick.
+    """
+    thread_name = 'rss-sampler'
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.available = os.path.exists('/proc/self/statm')
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.sample(process_tree_pids(os.getpid()))
+            self.stop_event.wait(self.interval)
+
+    def sample(self, pids):
+        total = sum(process_rss_bytes(pid) for pid in pids)
+        self.peak = max(self.peak, total)
+        return total
+
+    def __enter__(self):
+        if self.available:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        if self.available:
+            self.thread.join()
+
+
+def process_cpu_seconds(pid):
+    """Return the user + system CPU time of a process in seconds, or None if it has exited"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_role(pid):
+    """Classify a process of the run: python, driver, browser, renderer, gpu, utility or other"""
+    if pid == os.getpid():
+        return 'python'
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            args = f.read().split(b'\0')
+    except OSError:
+        return 'other'
+    command = os.path.basename(args[0].decode(errors='replace')) if args else ''
+    process_type = next((arg[len(b'--type='):].decode() for arg in args if arg.startswith(b'--type=')), None)
+    if command == 'node' or command.startswith('node'):
+        return 'driver'
+    if 'chrom' in command or 'headless_shell' in command:
+        if process_type is None:
+            return 'browser'
+        if process_type == 'gpu-process':
+            return 'gpu'
+        return process_type if process_type in ('renderer', 'utility') else 'other'
+    return 'other'
+
+
+class ResourceSampler(PeakRssSampler):
+    """Sample CPU and RSS of this process tree by role, tagged with the booking phase
+    
+    Each sample is {'t', 'phase', 'roles': {role: {'rss', 'cpu', 'processes'}},
+    'rss', 'cpu'} with cpu in percent of one core since the previous sample.
+    The first tick only records the CPU baseline.
+    """
+    thread_name = 'resource-sampler'
+
+    def __init__(self, interval=0.5):
+        super().__init__(interval)
+        self.samples = []
+        self.roles = {}
+        self.started = None
+        self.last_wall, self.last_cpu = None, {}
+
+    def sample(self, pids):
+        now = time.monotonic()
+        roles, cpu_now = {}, {}
+        for pid in pids:
+            cpu = process_cpu_seconds(pid)
+            if cpu is None:
+                continue
+            cpu_now[pid] = cpu
+            if pid not in self.roles:
+                self.roles[pid] = process_role(pid)
+            totals = roles.setdefault(self.roles[pid], {'rss': 0, 'cpu': 0.0, 'processes': 0})
+            totals['rss'] += process_rss_bytes(pid)
+            if self.last_wall is not None:
+                totals['cpu'] += (cpu - self.last_cpu.get(pid, cpu)) * 100.0 / (now - self.last_wall)
+            totals['processes'] += 1
+        total = sum(r['rss'] for r in roles.values())
+        self.peak = max(self.peak, total)
+        if self.started is None:
+            self.started = now
+        else:
+            self.samples.append({
+                't': round(now - self.started, 3),
+                'phase': CURRENT_PHASE,
+                'roles': roles,
+                'rss': total,
+                'cpu': round(sum(r['cpu'] for r in roles.values()), 1)
+            })
+        self.last_wall, self.last_cpu = now, cpu_now
+        return total
+
+    def summary(self):
+        """Print peak and average RSS/CPU per process role and per booking phase"""
+        if not self.samples:
+            return
+        by_role, by_phase = {}, {}
+        for sample in self.samples:
+            for role, totals in sample['roles'].items():
+                by_role.setdefault(role, []).append(totals)
+            by_phase.setdefault(sample['phase'], []).append(sample)
+        
+        print("\n" + "="*60)
+        print(f"RESOURCES ({len(self.samples)} samples every {self.interval * 1000:.0f} ms)")
+        print("="*60)
+        print(f"{'process':<14}{'count':>7}{'peak RSS':>12}{'avg RSS':>12}{'peak CPU':>10}{'avg CPU':>9}")
+        for role, series in sorted(by_role.items(), key=lambda item: -max(t['rss'] for t in item[1])):
+            print(f"{role:<14}{max(t['processes'] for t in series):>7}"
+                  f"{format_mb(max(t['rss'] for t in series)):>12}{format_mb(statistics.mean(t['rss'] for t in series)):>12}"
+                  f"{max(t['cpu'] for t in series):>9.0f}%{statistics.mean(t['cpu'] for t in series):>8.0f}%")
+        print("-"*60)
+        print(f"{'phase':<14}{'samples':>7}{'peak RSS':>12}{'avg RSS':>12}{'peak CPU':>10}{'avg CPU':>9}")
+        for phase_name, series in by_phase.items():
+            print(f"{phase_name:<14}{len(series):>7}"
+                  f"{format_mb(max(s['rss'] for s in series)):>12}{format_mb(statistics.mean(s['rss'] for s in series)):>12}"
+                  f"{max(s['cpu'] for s in series):>9.0f}%{statistics.mean(s['cpu'] for s in series):>8.0f}%")
+        print(f"{'whole run':<14}{len(self.samples):>7}{format_mb(max(s['rss'] for s in self.samples)):>12}"
+              f"{format_mb(statistics.mean(s['rss'] for s in self.samples)):>12}"
+              f"{max(s['cpu'] for s in self.samples):>9.0f}%{statistics.mean(s['cpu'] for s in self.samples):>8.0f}%")
+        print("="*60)
+
+    def write(self, path):
+        """Write the raw samples as JSON lines"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for sample in self.samples:
+                f.write(json.dumps(sample) + '\n')
+        print(f"Resource samples written to {path}")
+
+
+# Chromium lock files left behind when a run is killed; a stale one blocks the next launch
+PROFILE_LOCK_FILES = ['SingletonLock', 'SingletonCookie', 'SingletonSocket']
+# Site data a persistent profile would otherwise carry between runs; only the caches should
+PROFILE_SITE_DATA_DIRS = ['Local Storage', 'Session Storage', 'IndexedDB', 'Service Worker',
+                          'WebStorage', 'Shared Storage', 'File System', 'databases']
+
+
+def directory_size(path):
+    """Total size in bytes of the files below path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def clear_profile_site_data(path):
+    """Delete localStorage, IndexedDB, service workers and other site data from a closed profile"""
+    for name in PROFILE_SITE_DATA_DIRS:
+        shutil.rmtree(os.path.join(path, 'Default', name), ignore_errors=True)
+
+
+def prepare_user_data_dir(settings):
+    """Get the persistent profile directory ready for launch, wiping it when it is over max_size_mb"""
+    path = settings.get('user_data_dir', 'browser_profile')
+    if os.path.isdir(path):
+        size = directory_size(path)
+        # The HTTP cache is capped by --disk-cache-size, but the code cache is not
+        if size > settings.get('max_size_mb', 300) * 1024 * 1024:
+            print(f"  Browser profile is {format_mb(size)}, over the limit - starting from a clean profile")
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            print(f"  Reusing browser profile {path} ({format_mb(size)})")
+            clear_profile_site_data(path)
+    for name in PROFILE_LOCK_FILES:
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def launch_browser_context(p, config, profile):
+    """Launch Chromium and return (browser, context)
+    
+    With browser_cache.enabled the context uses a persistent user-data directory,
+    so the HTTP and code caches survive between runs; browser is then None.
+    Cookies are cleared and site data (localStorage, IndexedDB, service workers)
+    is deleted before launch and after close, so only the caches carry over. If
+    the profile cannot be launched it is deleted and retried once, then a fresh
+    context is used.
+    """
+    settings = config.get('browser_cache', {})
+    if settings.get('enabled'):
+        launch_options = get_launch_options(profile)
+        launch_options['args'] = launch_options['args'] + [
+            f"--disk-cache-size={settings.get('max_size_mb', 300) * 1024 * 1024 // 2}"
+        ]
+        for attempt in (1, 2):
+            path = prepare_user_data_dir(settings)
+            try:
+                context = p.chromium.launch_persistent_context(
+                    path, **launch_options, **get_context_options(profile))
+                context.clear_cookies()
+                return None, context
+            except Exception as e:
+                print(f"  Could not launch with browser profile {path} (attempt {attempt}): {str(e)}")
+                shutil.rmtree(path, ignore_errors=True)
+        print("  ⚠️ Falling back to a fresh browser context")
+    
+    browser = p.chromium.launch(**get_launch_options(profile))
+    return browser, browser.new_context(**get_context_options(profile))
+
+
+def close_browser_context(browser, context, config):
+    """Close what launch_browser_context() opened, leaving no cookies or site data in a persistent profile"""
+    if browser is None:
+        try:
+            context.clear_cookies()
+        except Exception:
+            pass
+        context.close()
+        clear_profile_site_data(config.get('browser_cache', {}).get('user_data_dir', 'browser_profile'))
+    else:
+        browser.close()
+
+
+# ============================================================
+# SELECTOR REGISTRY
+# ============================================================
+
+# Candidate selectors for every logical element, in default priority order
+SELECTOR_REGISTRY = {
+    'sign_in_button': [
+        'button:has-text("Sign in")',
+        'a:has-text("Sign in")',
+        'button:has-text("Log in")',
+        'a:has-text("Log in")',
+        '[data-testid*="sign-in"]',
+        '[data-testid*="login"]'
+    ],
+    'email_input': [
+        'input[type="email"]',
+        'input[name="email"]',
+        'input#email',
+        'input[id="EmailAddress"]',
+        'input[placeholder*="email"]'
+    ],
+    'continue_button': [
+        'button:has-text("Continue")',
+        'button[type="submit"]',
+        'input[type="submit"]'
+    ],
+    'password_input': [
+        'input[type="password"]',
+        'input[name="password"]',
+        'input[id="Password"]'
+    ],
+    'submit_button': [
+        'button[type="submit"]',
+        'button:has-text("Sign in")',
+        'button:has-text("Log in")',
+        'input[type="submit"]'
+    ],
+    'book_button': [
+        'button:has-text("Book Now")',
+        'button:has-text("Book")',
+        'button:has-text("Reserve")'
+    ],
+    'buy_button': [
+        'button:has-text("Buy")',
+        'button:has-text("Complete Purchase")',
+        'button:has-text("Confirm")',
+        'button:has-text("Complete")',
+        'button:has-text("Checkout")'
+    ],
+    'confirm_button': [
+        'button:has-text("Confirm")',
+        'button:has-text("Yes")',
+        'button:has-text("Done")'
+    ],
+    'confirmation_message': [
+        'text=/booking confirmed/i',
+        'text=/reservation confirmed/i',
+        "text=/you're all set/i",
+        '[data-testid*="confirmation"]',
+        '[class*="confirmation"]'
+    ],
+    'checkout_error': [
+        '[role="alert"]:has-text("error")',
+        'text=/something went wrong/i',
+        'text=/unable to (book|complete|process)/i',
+        '[class*="error-message"]'
+    ],
+}
+
+SELECTOR_CACHE_FILE = 'selector_cache.json'
+SELECTOR_CACHE = None
+SELECTOR_DEMOTIONS = []
+
+
+def load_selector_cache():
+    """Load the per-host winning selector cache (once per process)"""
+    global SELECTOR_CACHE
+    if SELECTOR_CACHE is None:
+        try:
+            with open(SELECTOR_CACHE_FILE, 'r') as f:
+                SELECTOR_CACHE = json.load(f)
+        except (OSError, ValueError):
+            SELECTOR_CACHE = {}
+    return SELECTOR_CACHE
+
+
+def save_selector_cache():
+    """Persist the winning selector cache"""
+    try:
+        with open(SELECTOR_CACHE_FILE, 'w') as f:
+            json.dump(SELECTOR_CACHE or {}, f, indent=2, sort_keys=True)
+    except OSError as e:
+        print(f"  Could not save selector cache (non-critical): {str(e)}")
+
+
+def selector_candidates(host, key):
+    """Return the candidates for an element, last run's winner on this host first"""
+    candidates = list(SELECTOR_REGISTRY[key])
+    cached = load_selector_cache().get(host, {}).get(key)
+    if cached in candidates:
+        candidates.remove(cached)
+        candidates.insert(0, cached)
+    return candidates
+
+
+def selector_list(key):
+    """Return every candidate of an element as one comma-joined selector"""
+    return ', '.join(SELECTOR_REGISTRY[key])
+
+
+def find_element(page, key, timeout=10000, scope=None):
+    """Race all candidate selectors of a logical element and return a locator for the winner
+    
+    All candidates are waited for at once (a single comma-joined selector), so a
+    miss costs one timeout instead of one per candidate. The winning selector is
+    cached per host and tried first next time. Raises PlaywrightTimeout if no
+    candidate becomes visible in time.
+    """
+    root = scope or page
+    host = urlparse(page.url).hostname or ''
+    candidates = selector_candidates(host, key)
+    timeout = bounded_timeout(timeout)
+    
+    root.locator(', '.join(candidates) + ' >> visible=true').first.wait_for(state='visible', timeout=timeout)
+    
+    # Identify which candidate won the race (count() does not wait)
+    for selector in candidates:
+        locator = root.locator(selector + ' >> visible=true')
+        if locator.count() > 0:
+            break
+    else:
+        return root.locator(', '.join(candidates) + ' >> visible=true').first
+    
+    cache = load_selector_cache()
+    previous = cache.get(host, {}).get(key)
+    if previous != selector:
+        if previous:
+            print(f"  ⚠️ Selector demoted for {key} on {host}: '{previous}' → '{selector}'")
+            SELECTOR_DEMOTIONS.append({'host': host, 'element': key, 'demoted': previous, 'winner': selector})
+            METRICS.inc('mindbody_selector_demotions', {'element': key})
+        cache.setdefault(host, {})[key] = selector
+        save_selector_cache()
+    
+    return locator.first
+
+
+def report_selector_demotions():
+    """Print the selectors that stopped matching during this run"""
+    if not SELECTOR_DEMOTIONS:
+        return
+    print("\nSelector changes detected (the site markup may have changed):")
+    for demotion in SELECTOR_DEMOTIONS:
+        print(f"  {demotion['host']} {demotion['element']}: '{demotion['demoted']}' → '{demotion['winner']}'")
+
+
+# ============================================================
+# COOKIE CONSENT
+# ============================================================
+
+# TrustArc overlays; removed as soon as they are inserted into any page
+CONSENT_OVERLAY_SELECTORS = '.truste_overlay, .truste_cm_outerdiv, .truste_box_overlay, [class*="truste_"], div[id^="pop-div"]'
+
+CONSENT_BUTTON_SELECTOR = 'button:has-text("AGREE AND PROCEED"), button:has-text("PROCEED")'
+
+# Contexts whose consent has been resolved (state installed or button clicked)
+CONSENT_RESOLVED = set()
+# Contexts with the overlay sweeper installed; only once consent is given, since the
+# overlays it removes hold the AGREE button
+CONSENT_SWEEPING = set()
+
+
+def get_consent_observer_script():
+    """Return JavaScript that removes consent overlays whenever they appear"""
+    return """
+    (() => {
+        if (window.__mbbConsentSweeper) return;
+        window.__mbbConsentSweeper = true;
+        const selector = '%s';
+        const sweep = () => document.querySelectorAll(selector).forEach(el => el.remove());
+        const start = () => {
+            sweep();
+            new MutationObserver(sweep).observe(document.documentElement, { childList: true, subtree: true });
+        };
+        if (document.documentElement) {
+            start();
+        } else {
+            document.addEventListener('DOMContentLoaded', start);
+        }
+    })();
+    """ % CONSENT_OVERLAY_SELECTORS
+
+
+def is_consent_cookie(cookie, config):
+    """True if a cookie records the visitor's consent choice"""
+    prefixes = config.get('consent', {}).get('cookie_prefixes', ['notice_', 'cmapi_', 'TAconsent', 'truste'])
+    return any(cookie['name'].startswith(prefix) for prefix in prefixes)
+
+
+def install_consent_sweeper(context, pages=()):
+    """Remove leftover consent overlays from now on, in every later document and in open pages"""
+    if context not in CONSENT_SWEEPING:
+        context.add_init_script(get_consent_observer_script())
+        CONSENT_SWEEPING.add(context)
+    for page in pages:
+        try:
+            page.evaluate(get_consent_observer_script())
+        except Exception:
+            pass
+
+
+def install_consent_state(context, config):
+    """Restore the saved consent cookies before the first navigation
+    
+    The overlay sweeper is only installed along with saved consent; without it the
+    popup must stay intact so dismiss_consent() can click AGREE and save the cookies.
+    """
+    state_file = config.get('consent', {}).get('state_file', 'consent_state.json')
+    try:
+        with open(state_file, 'r') as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        print("No saved consent state, the consent popup will be handled on the first page that shows it")
+        return
+    
+    now = time.time()
+    cookies = [c for c in cookies if c.get('expires', -1) == -1 or c['expires'] > now]
+    if cookies:
+        context.add_cookies(cookies)
+        CONSENT_RESOLVED.add(context)
+        install_consent_sweeper(context)
+        print(f"Restored {len(cookies)} consent cookie(s)")
+    else:
+        print("Saved consent state has expired, the consent popup will be handled on the first page that shows it")
+
+
+def save_consent_state(context, config):
+    """Persist the consent cookies the site set so later runs skip the popup"""
+    state_file = config.get('consent', {}).get('state_file', 'consent_state.json')
+    try:
+        cookies = [c for c in context.cookies() if is_consent_cookie(c, config)]
+        if cookies:
+            with open(state_file, 'w') as f:
+                json.dump(cookies, f, indent=2)
+            print(f"Saved {len(cookies)} consent cookie(s) to {state_file}")
+    except Exception as e:
+        print(f"Could not save consent state (non-critical): {str(e)}")
+
+
+def dismiss_consent(page, config):
+    """Click the consent button if the popup shows up, once per context
+    
+    Fallback for contexts without saved consent state: every frame (main page
+    included) is polled against one short shared deadline instead of a wait
+    per frame.
+    """
+    return run_steps(dismiss_consent_steps(page, config))
+
+
+def dismiss_consent_steps(page, config):
+    """dismiss_consent() as a step generator that yields its pauses between polls"""
+    context = page.context
+    if context in CONSENT_RESOLVED:
+        return
+    
+    deadline_ms = bounded_timeout(config.get('consent', {}).get('fallback_deadline_ms', 3000))
+    deadline = time.monotonic() + deadline_ms / 1000.0
+    print(f"Looking for consent button in frames (up to {deadline_ms} ms)...")
+    
+    while True:
+        for frame in page.frames:
+            try:
+                button = frame.locator(CONSENT_BUTTON_SELECTOR).first
+                if button.is_visible():
+                    print(f"Found button in frame: {frame.url}")
+                    button.click(timeout=max(500, int((deadline - time.monotonic()) * 1000)))
+                    print("Clicked AGREE AND PROCEED button")
+                    CONSENT_RESOLVED.add(context)
+                    human_delay(500, 1000)
+                    save_consent_state(context, config)
+                    install_consent_sweeper(context, [page])
+                    return
+            except Exception:
+                continue
+        if time.monotonic() >= deadline:
+            break
+        yield 0.25
+    
+    # Nothing showed up in time; the overlay sweeper removes it if it appears later
+    print("No consent popup found, continuing...")
+    CONSENT_RESOLVED.add(context)
+    install_consent_sweeper(context, [page])
+
+
+def load_config():
+    """Load configuration from config.json"""
+    with open('config.json', 'r') as f:
+        return json.load(f)
+
+
+def get_password():
+    """Get password from environment variable"""
+    password = os.environ.get('MINDBODY_PASSWORD')
+    if not password:
+        raise ValueError("MINDBODY_PASSWORD environment variable not set")
+    return password
+
+
+def get_captcha_api_key(config):
+    """Get 2captcha API key from config"""
+    api_key = config.get('captcha_api_key')
+    if not api_key:
+        raise ValueError("captcha_api_key not found in config.json")
+    return api_key
+
+
+# Multiplier for human_delay(); HAR replays set it to 0 for repeatable timings
+HUMAN_DELAY_SCALE = 1.0
+
+
+def human_delay(min_ms=1000, max_ms=3000):
+    """Add random human-like delay, spent on queued background steps first (see LOGIN PIPELINE)"""
+    delay = random.randint(min_ms, max_ms)
+    if IN_BACKGROUND_STEP:
+        # The foreground flow already paces the run; background steps never wait
+        return
+    deadline = time.monotonic() + delay * HUMAN_DELAY_SCALE / 1000.0
+    run_background_tasks(deadline)
+    budget_sleep(max(0.0, deadline - time.monotonic()))
+
+
+def extract_recaptcha_sitekey(page):
+    """Extract the reCAPTCHA sitekey from the page"""
+    try:
+        print("  Extracting reCAPTCHA sitekey...")
+        
+        with HandleScope() as handles:
+            # Method 1: Look for data-sitekey attribute in divs
+            sitekey_elem = handles.track(page.query_selector('[data-sitekey]'))
+            if sitekey_elem:
+                sitekey = sitekey_elem.get_attribute('data-sitekey')
+                if sitekey:
+                    print(f"  ✓ Found sitekey via data-sitekey attribute: {sitekey}")
+                    return sitekey
+            
+            # Method 2: Extract from reCAPTCHA iframe src
+            recaptcha_frames = handles.track(page.query_selector_all('iframe[src*="recaptcha"]'))
+            for frame in recaptcha_frames:
+                src = frame.get_attribute('src')
+                if src and 'k=' in src:
+                    # Extract sitekey from URL parameter k=SITEKEY
+                    import re
+                    match = re.search(r'[?&]k=([^&]+)', src)
+                    if match:
+                        sitekey = match.group(1)
+                        print(f"  ✓ Found sitekey from iframe URL: {sitekey}")
+                        return sitekey
+        
+        # Method 3: Search in page source for grecaptcha.render or grecaptcha.execute calls
+        page_content = page.content()
+        import re
+        patterns = [
+            r'grecaptcha\.render\([^,]+,\s*{\s*["\']?sitekey["\']?\s*:\s*["\']([^"\']+)["\']',
+            r'grecaptcha\.execute\(["\']([^"\']+)["\']',
+            r'data-sitekey=["\']([^"\']+)["\']'
+        ]
+        
+        for pattern in patterns:
+            match = re.search(pattern, page_content)
+            if match:
+                sitekey = match.group(1)
+                print(f"  ✓ Found sitekey in page source: {sitekey}")
+                return sitekey
+        
+        print("  ✗ Could not find reCAPTCHA sitekey")
+        return None
+        
+    except Exception as e:
+        print(f"  Error extracting sitekey: {str(e)}")
+        return None
+
+
+def inject_recaptcha_solution(page, solution_token):
+    """Inject the reCAPTCHA solution token into the page"""
+    try:
+        print("  Injecting reCAPTCHA solution...")
+        
+        # Method 1: Set g-recaptcha-response textarea value
+        inject_script = f"""
+        (function() {{
+            // Find all g-recaptcha-response textareas
+            var elements = document.getElementsByName('g-recaptcha-response');
+            for (var i = 0; i < elements.length; i++) {{
+                elements[i].innerHTML = '{solution_token}';
+                elements[i].value = '{solution_token}';
+            }}
+            
+            // Also set by ID if exists
+            var byId = document.getElementById('g-recaptcha-response');
+            if (byId) {{
+                byId.innerHTML = '{solution_token}';
+                byId.value = '{solution_token}';
+            }}
+            
+            // Try to trigger callback
+            if (typeof window.___grecaptcha_cfg !== 'undefined') {{
+                var clients = window.___grecaptcha_cfg.clients;
+                for (var id in clients) {{
+                    var client = clients[id];
+                    if (client && client.callback) {{
+                        try {{
+                            client.callback('{solution_token}');
+                        }} catch(e) {{
+                            console.log('Callback error:', e);
+                        }}
+                    }}
+                }}
+            }}
+            
+            // Alternative callback trigger
+            if (typeof window.recaptchaCallback !== 'undefined') {{
+                try {{
+                    window.recaptchaCallback('{solution_token}');
+                }} catch(e) {{}}
+            }}
+            
+            return true;
+        }})();
+        """
+        
+        page.evaluate(inject_script)
+        print("  ✓ Solution token injected successfully")
+        
+        # Give the page a moment to process the solution
+        time.sleep(1)
+        
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Error injecting solution: {str(e)}")
+        return False
+
+
+def solve_recaptcha_v2(page, config, max_retries=None):
+    """Solve reCAPTCHA v2 using 2captcha service"""
+    if max_retries is None:
+        max_retries = config.get('captcha_max_retries', 5)
+    
+    print(f"\n{'='*60}")
+    print("🤖 ATTEMPTING AUTOMATIC CAPTCHA SOLVING WITH 2CAPTCHA")
+    print(f"{'='*60}")
+    
+    for attempt in range(1, max_retries + 1):
+        if budget_exhausted():
+            record_budget_cut('CAPTCHA solving', f"attempts {attempt}-{max_retries} not tried")
+            return False
+        print(f"\n--- Attempt {attempt}/{max_retries} ---")
+        if attempt > 1:
+            METRICS.inc('mindbody_retries', {'kind': 'captcha'})
+        
+        try:
+            # Extract sitekey
+            sitekey = extract_recaptcha_sitekey(page)
+            if not sitekey:
+                print(f"  ✗ Could not extract sitekey (attempt {attempt}/{max_retries})")
+                if attempt < max_retries:
+                    print(f"  Waiting 3 seconds before retry...")
+                    budget_sleep(3)
+                    continue
+                else:
+                    return False
+            
+            # Get page URL
+            page_url = page.url
+            print(f"  Page URL: {page_url}")
+            print(f"  Sitekey: {sitekey}")
+            
+            # Initialize 2captcha solver
+            api_key = get_captcha_api_key(config)
+            # 2captcha waits up to 10 minutes for a worker; never wait past the budget
+            solver = TwoCaptcha(api_key, recaptchaTimeout=max(1, bounded_timeout(600000) // 1000))
+            
+            print(f"  📤 Sending CAPTCHA to 2captcha service...")
+            print(f"  ⏳ This may take 30-60 seconds...")
+            
+            # Send CAPTCHA to 2captcha and wait for solution
+            try:
+                result = solver.recaptcha(
+                    sitekey=sitekey,
+                    url=page_url
+                )
+                
+                solution_token = result['code']
+                print(f"  ✓ Received solution from 2captcha!")
+                print(f"  Solution token: {solution_token[:50]}...")
+                
                 # Check account balance
                 try:
-                    balance = solver.balance()
-                    print(f"  💰 2captcha balance: ${balance}")
-                    if float(balance) < 1.0:
-                        print(f"  ⚠️ WARNING: Low balance! Consider adding funds.")
-                except:
-                    pass
-                
-            except Exception as e:
-                error_msg = str(e).lower()
-                print(f"  ✗ 2captcha error: {str(e)}")
-                
-                # Handle specific errors
-                if 'insufficient' in error_msg or 'balance' in error_msg:
-                    print(f"  ❌ INSUFFICIENT BALANCE - Cannot continue")
-                    return False
-                elif 'key' in error_msg or 'api' in error_msg:
-                    print(f"  ❌ API KEY ERROR - Check your configuration")
+                    balance = solver.balance()
+                    print(f"  💰 2captcha balance: ${balance}")
+                    if float(balance) < 1.0:
+                        print(f"  ⚠️ WARNING: Low balance! Consider adding funds.")
+                except:
+                    pass
+                
+            except Exception as e:
+                error_msg = str(e).lower()
+                print(f"  ✗ 2captcha error: {str(e)}")
+                
+                # Handle specific errors
+                if 'insufficient' in error_msg or 'balance' in error_msg:
+                    print(f"  ❌ INSUFFICIENT BALANCE - Cannot continue")
+                    return False
+                elif 'key' in error_msg or 'api' in error_msg:
+                    print(f"  ❌ API KEY ERROR - Check your configuration")
+                    return False
+                elif 'timeout' in error_msg:
+                    print(f"  ⏱️ Timeout waiting for solution")
+                    if attempt < max_retries:
+                        print(f"  Retrying...")
+                        budget_sleep(2)
+                        continue
+                    else:
+                        return False
+                else:
+                    # Generic error - retry
+                    if attempt < max_retries:
+                        print(f"  Retrying in 5 seconds...")
+                        budget_sleep(5)
+                        continue
+                    else:
+                        return False
+            
+            # Inject solution into page
+            if inject_recaptcha_solution(page, solution_token):
+                print(f"  ✓ CAPTCHA solution applied successfully!")
+                
+                # Wait for page to process the solution
+                budget_sleep(2)
+                
+                # Verify CAPTCHA is gone
+                if not detect_captcha(page):
+                    print(f"  ✓✓ CAPTCHA SOLVED AND VERIFIED!")
+                    print(f"{'='*60}\n")
+                    return True
+                else:
+                    print(f"  ⚠️ Solution applied but CAPTCHA still visible")
+                    if attempt < max_retries:
+                        print(f"  Retrying...")
+                        budget_sleep(2)
+                        continue
+                    else:
+                        return False
+            else:
+                print(f"  ✗ Failed to inject solution")
+                if attempt < max_retries:
+                    budget_sleep(2)
+                    continue
+                else:
+                    return False
+                    
+        except Exception as e:
+            print(f"  ✗ Unexpected error in attempt {attempt}: {str(e)}")
+            print(f"  {traceback.format_exc()}")
+            if attempt < max_retries:
+                print(f"  Retrying in 3 seconds...")
+                budget_sleep(3)
+                continue
+            else:
+                return False
+    
+    print(f"\n❌ Failed to solve CAPTCHA after {max_retries} attempts")
+    print(f"{'='*60}\n")
+    return False
+
+
+def detect_captcha(page):
+    """Detect if we're on a CAPTCHA or verification page"""
+    try:
+        # Check for common CAPTCHA indicators in URL first (most reliable)
+        page_url = page.url.lower()
+        url_indicators = ['recaptcha', 'captcha', 'challenge', 'verify']
+        
+        for indicator in url_indicators:
+            if indicator in page_url:
+                print(f"  CAPTCHA detected in URL: {indicator}")
+                return True
+        
+        # Check for visible CAPTCHA elements (iframes)
+        captcha_selectors = [
+            'iframe[src*="recaptcha"]',
+            'iframe[src*="captcha"]',
+            'iframe[title*="reCAPTCHA"]',
+            '[class*="recaptcha"]',
+            '[id*="recaptcha"]'
+        ]
+        
+        with HandleScope() as handles:
+            for selector in captcha_selectors:
+                elem = handles.track(page.query_selector(selector))
+                if elem:
+                    try:
+                        if elem.is_visible():
+                            print(f"  CAPTCHA detected: visible element with selector {selector}")
+                            return True
+                    except:
+                        pass
+        
+        # Check page content for CAPTCHA indicators
+        page_content = page.content().lower()
+        content_indicators = [
+            'verify you are human',
+            'verify you\'re human',
+            'security check',
+            'please verify',
+            'select all images',
+            'image verification',
+            'i\'m not a robot',
+            'prove you are human'
+        ]
+        
+        for indicator in content_indicators:
+            if indicator in page_content:
+                print(f"  CAPTCHA detected in content: '{indicator}'")
+                return True
+        
+        # Check page title
+        try:
+            page_title = page.title().lower()
+            if 'captcha' in page_title or 'verify' in page_title:
+                print(f"  CAPTCHA detected in page title: {page_title}")
+                return True
+        except:
+            pass
+                
+        return False
+    except Exception as e:
+        print(f"  Error in CAPTCHA detection: {str(e)}")
+        return False
+
+
+def get_target_classes(config):
+    """Determine which classes to book based on current day"""
+    today = datetime.now()
+    day_name = today.strftime('%A').lower()
+    
+    if day_name == 'friday':
+        return config['booking_schedule']['friday']
+    elif day_name == 'saturday':
+        return config['booking_schedule']['saturday']
+    elif day_name == 'sunday':
+        # TEST MODE: Allow Sunday for testing Monday bookings
+        return config['booking_schedule'].get('sunday')
+    elif day_name == 'monday':
+        # TEMPORARY: Allow Monday for testing 2captcha integration
+        print("⚠️ RUNNING IN TEST MODE (Monday) - Using Sunday config for Tuesday booking")
+        return config['booking_schedule'].get('sunday')
+    else:
+        print(f"Not a booking day (today is {day_name}). Script should run on Friday, Saturday, or Sunday (test mode).")
+        return None
+
+
+def get_studio(config, key=None):
+    """Return the studio a class belongs to as {'key', 'name', 'url'}"""
+    studios = config.get('studios')
+    if not studios:
+        # Legacy single-studio config; the name defaults to the URL's last segment,
+        # so ".../locations/studio-locomotion" reads "Studio Locomotion"
+        url = config['studio_url']
+        slug = urlparse(url).path.rstrip('/').rsplit('/', 1)[-1]
+        name = config.get('studio_name') or slug.replace('-', ' ').title() or url
+        return {'key': 'default', 'name': name, 'url': url}
+    
+    key = key or config.get('default_studio') or next(iter(studios))
+    if key not in studios:
+        raise ValueError(f"Unknown studio '{key}' in booking_schedule (known studios: {', '.join(studios)})")
+    return dict(studios[key], key=key)
+
+
+def plan_bookings(config, classes):
+    """Group the classes of a run by studio, keeping config order within each studio"""
+    plan = {}
+    for class_info in classes:
+        studio = get_studio(config, class_info.get('studio'))
+        plan.setdefault(studio['key'], {'studio': studio, 'classes': []})['classes'].append(class_info)
+    return plan
+
+
+def calculate_target_date(target_day):
+    """Calculate the target date for booking"""
+    today = datetime.now()
+    target_day_lower = target_day.lower()
+    current_weekday = today.weekday()  # Monday is 0, Sunday is 6
+    
+    # Map day names to weekday numbers
+    day_mapping = {
+        'monday': 0,
+        'tuesday': 1,
+        'wednesday': 2,
+        'thursday': 3,
+        'friday': 4,
+        'saturday': 5,
+        'sunday': 6
+    }
+    
+    target_weekday = day_mapping.get(target_day_lower)
+    
+    if target_weekday is None:
+        # Default to tomorrow
+        days_to_add = 1
+    else:
+        # Calculate days until target day
+        days_to_add = (target_weekday - current_weekday) % 7
+        
+        # If it's 0, we want next week (not today)
+        if days_to_add == 0:
+            days_to_add = 7
+    
+    target_date = today + timedelta(days=days_to_add)
+    return target_date
+
+
+# ============================================================
+# SCHEDULE CARD MATCHING
+# ============================================================
+
+# Start times as printed on class cards ("9:30 am", "9:30AM", "10am"); the
+# lookbehind keeps "9:30 am" from matching inside "19:30 am"
+TIME_PATTERN = re.compile(r'(?<![\d:])(\d{1,2})(?::(\d{2}))?\s*([ap])\.?\s?m\b', re.IGNORECASE)
+
+# Text of the buttons that sit on schedule cards (booking or not)
+CARD_BUTTON_LABELS = ['Book', 'Reserve', 'Waitlist', 'Join waitlist', 'Full', 'Sold out']
+BOOKABLE_BUTTON_LABELS = ['Book', 'Reserve']
+
+READ_CARDS_SCRIPT = """
+([labels, bookable]) => {
+    const buttonText = new RegExp('^\\\\s*(' + labels.join('|') + ')\\\\b', 'i');
+    const bookableText = new RegExp('^\\\\s*(' + bookable.join('|') + ')\\\\b', 'i');
+    const buttons = Array.from(document.querySelectorAll('button, a[role="button"]'))
+        .filter(b => buttonText.test(b.innerText || ''));
+    
+    // Count the card buttons below every ancestor in one pass up from each button
+    const counts = new Map();
+    for (const button of buttons) {
+        for (let el = button.parentElement; el; el = el.parentElement) {
+            counts.set(el, (counts.get(el) || 0) + 1);
+        }
+    }
+    
+    // A card is the largest ancestor that holds exactly one card button and no
+    // extra times (so a lone class does not swallow its section header)
+    const timeText = /(^|[^\\d:])\\d{1,2}(:\\d{2})?\\s*[ap]\\.?\\s?m\\b/gi;
+    const timeCount = el => ((el.innerText || '').match(timeText) || []).length;
+    document.querySelectorAll('[data-mbb-card]').forEach(el => el.removeAttribute('data-mbb-card'));
+    return buttons.map((button, index) => {
+        let card = button;
+        while (card.parentElement && counts.get(card.parentElement) === 1 &&
+               (card === button || timeCount(card.parentElement) === timeCount(card))) {
+            card = card.parentElement;
+        }
+        card.setAttribute('data-mbb-card', String(index));
+        const label = (button.innerText || '').trim();
+        return {
+            index: index,
+            text: card.innerText || '',
+            button: label,
+            bookable: bookableText.test(label) && !button.disabled && button.getAttribute('aria-disabled') !== 'true'
+        };
+    });
+}
+"""
+
+
+# Where the schedule scrolls (the window or an inner list holding the cards) and
+# whether it is at the bottom; scrolls an inner list by `amount` pixels first
+SCROLL_STATE_SCRIPT = """
+(amount) => {
+    const cards = document.querySelectorAll('[data-mbb-card]');
+    let box = null;
+    for (let el = cards.length ? cards[cards.length - 1].parentElement : null; el; el = el.parentElement) {
+        if (/(auto|scroll)/.test(getComputedStyle(el).overflowY) && el.scrollHeight > el.clientHeight + 1) {
+            box = el;
+            break;
+        }
+    }
+    if (box && amount) box.scrollBy(0, amount);
+    const scroller = box || document.scrollingElement || document.documentElement;
+    const viewport = box ? box.clientHeight : window.innerHeight;
+    return {
+        window: !box,
+        atEnd: scroller.scrollTop + viewport >= scroller.scrollHeight - 2,
+        height: scroller.scrollHeight
+    };
+}
+"""
+
+
+def find_times(text):
+    """Return every (hour, minute) start time printed in a piece of text, 24-hour"""
+    times = []
+    for hour, minute, meridiem in TIME_PATTERN.findall(text):
+        hour = int(hour) % 12 + (12 if meridiem.lower() == 'p' else 0)
+        times.append((hour, int(minute or 0)))
+    return times
+
+
+def normalize_text(text):
+    """Fold text for comparison: accents removed (NFKD), casefolded, single-spaced
+    
+    "Athlétique", "ATHLETIQUE" and a decomposed "Athle\u0301tique" all become "athletique".
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
+
+
+def text_tokens(text):
+    """Return the set of normalized words in a piece of text"""
+    return frozenset(re.findall(r'\w+', normalize_text(text)))
+
+
+def instructor_matches(instructor, text):
+    """True if an instructor appears in text, allowing abbreviated first names
+    
+    "Pat Houde" and "P. Houde" both match "with Patricia Houde"; the last name must match in full.
+    """
+    wanted = re.findall(r'\w+', normalize_text(instructor))
+    if not wanted:
+        return False
+    *given, surname = wanted
+    words = re.findall(r'\w+', normalize_text(text))
+    for i, word in enumerate(words):
+        if word != surname or i < len(given):
+            continue
+        if all(a.startswith(b) or b.startswith(a) for a, b in zip(given, words[i - len(given):i])):
+            return True
+    return False
+
+
+def name_on_line(name, line):
+    """True if a card line shows exactly this class name, possibly with a suffix like "(60 min)"
+
+    "Composition" must not match a "Composition Express" line.
+    """
+    return re.match(re.escape(name) + r'(\s*[-–—(|•·:,].*)?$', line) is not None
+
+
+def card_matches(card_text, class_info):
+    """True if a card's text describes the class: its first time is the class start time and a line names it"""
+    times = find_times(card_text)
+    wanted = find_times(class_info['time'])
+    if not times or not wanted or times[0] != wanted[0]:
+        return False
+    
+    name = normalize_text(class_info['name'])
+    return any(name_on_line(name, normalize_text(line)) for line in card_text.split('\n'))
+
+
+def read_schedule_cards(page):
+    """Read every class card on the schedule in a single round trip
+    
+    Each card is tagged with a data-mbb-card attribute so the matched card can be
+    addressed directly afterwards with card_locator().
+    """
+    return page.evaluate(READ_CARDS_SCRIPT, [CARD_BUTTON_LABELS, BOOKABLE_BUTTON_LABELS])
+
+
+def card_locator(page, card):
+    """Return a locator for a card returned by read_schedule_cards()"""
+    return page.locator(f'[data-mbb-card="{card["index"]}"]')
+
+
+def match_class_card(page, class_info, cards=None):
+    """Return (card, locator) for the requested class on the rendered schedule, or (None, None)"""
+    if cards is None:
+        cards = read_schedule_cards(page)
+    matches = [card for card in cards if card_matches(card['text'], class_info)]
+    if not matches:
+        return None, None
+    
+    # Several sessions of the same class at the same time: prefer the listed instructor
+    instructor = class_info.get('instructor')
+    if instructor:
+        matches.sort(key=lambda card: not instructor_matches(instructor, card['text']))
+    card = matches[0]
+    return card, card_locator(page, card)
+
+
+# ============================================================
+# CLASS CATALOGUE
+# ============================================================
+
+# Card lines that are never a class name: durations, spot counts, prices
+CARD_NOISE_PATTERN = re.compile(r'^(\d+\s*(min|mins|minutes|h|hr|hrs|hour|hours)\b|\d+\s+spots?\b|\$|free\b)', re.IGNORECASE)
+
+CATALOGUE = None
+CATALOGUE_INDEX = {}
+
+
+def parse_card_lines(card):
+    """Split a schedule card into (class name, instructor or None) from its printed lines
+    
+    The class name is the first line that is not a time, the button or a
+    duration/spots line; the instructor is the line printed as "with <name>".
+    """
+    name, instructor = None, None
+    for line in card['text'].split('\n'):
+        line = line.strip()
+        if not line or line == card['button'] or find_times(line) or CARD_NOISE_PATTERN.match(line):
+            continue
+        if line.lower().startswith('with '):
+            instructor = instructor or line[5:].strip()
+        elif name is None:
+            name = line
+    return name, instructor
+
+
+def get_catalogue_file(config):
+    """Return the path of the class catalogue cache"""
+    return config.get('catalogue', {}).get('file', 'class_catalogue.json')
+
+
+def load_catalogue(config):
+    """Load the per-studio class catalogue (once per process)"""
+    global CATALOGUE
+    if CATALOGUE is None:
+        try:
+            with open(get_catalogue_file(config), 'r') as f:
+                CATALOGUE = json.load(f)
+        except (OSError, ValueError):
+            CATALOGUE = {}
+        CATALOGUE.setdefault('studios', {})
+    return CATALOGUE
+
+
+def save_catalogue(config):
+    """Persist the class catalogue"""
+    if CATALOGUE is None:
+        return
+    try:
+        with open(get_catalogue_file(config), 'w') as f:
+            json.dump(CATALOGUE, f, indent=2, sort_keys=True, ensure_ascii=False)
+    except OSError as e:
+        print(f"  Could not save class catalogue (non-critical): {str(e)}")
+
+
+def fresh_catalogue_entry(config, studio_key):
+    """Return a studio's catalogue entry, or None if it is missing or older than catalogue.ttl_hours"""
+    entry = load_catalogue(config)['studios'].get(studio_key)
+    ttl_hours = config.get('catalogue', {}).get('ttl_hours', 168)
+    if not entry or time.time() - entry.get('updated_at', 0) > ttl_hours * 3600:
+        return None
+    return entry
+
+
+def record_schedule_reading(config, studio_key, cards, class_info=None, card=None):
+    """Add the classes and instructors of a schedule reading to the studio's catalogue
+    
+    When the card matched a config entry, that entry's type is recorded and its
+    instructor is recorded as printed on the card.
+    """
+    studio = fresh_catalogue_entry(config, studio_key)
+    if studio is None:
+        # Missing or expired: start over from this reading
+        studio = load_catalogue(config)['studios'][studio_key] = {'classes': {}}
+    studio['updated_at'] = int(time.time())
+    classes = studio['classes']
+    
+    for reading in cards:
+        name, instructor = parse_card_lines(reading)
+        if not name:
+            continue
+        entry = classes.setdefault(name, {'types': [], 'instructors': []})
+        if instructor and instructor not in entry['instructors']:
+            entry['instructors'].append(instructor)
+        if reading is card and class_info:
+            if class_info.get('type') and class_info['type'] not in entry['types']:
+                entry['types'].append(class_info['type'])
+    CATALOGUE_INDEX.pop(studio_key, None)
+
+
+def get_catalogue_index(config, studio_key):
+    """Return the normalized lookup index of a studio's catalogue, or None without fresh data
+    
+    The index maps normalized names and word sets to the catalogue spelling, so
+    resolving a config entry never rescans the catalogue.
+    """
+    if studio_key not in CATALOGUE_INDEX:
+        entry = fresh_catalogue_entry(config, studio_key)
+        if entry is None:
+            return None
+        index = {'names': {}, 'tokens': {}, 'instructors': {}}
+        for name, details in entry['classes'].items():
+            index['names'][normalize_text(name)] = name
+            index['tokens'].setdefault(text_tokens(name), name)
+            index['instructors'][name] = list(details.get('instructors', []))
+        index['all_instructors'] = sorted({i for names in index['instructors'].values() for i in names})
+        CATALOGUE_INDEX[studio_key] = index
+    return CATALOGUE_INDEX[studio_key]
+
+
+def resolve_class(index, class_info):
+    """Resolve a config entry to catalogue spellings, returning (class_info, warnings)"""
+    resolved = dict(class_info)
+    warnings = []
+    
+    normalized = normalize_text(class_info['name'])
+    name = index['names'].get(normalized) or index['tokens'].get(text_tokens(class_info['name']))
+    if name:
+        resolved['name'] = name
+    else:
+        suggestion = difflib.get_close_matches(normalized, list(index['names']), n=1, cutoff=0.75)
+        hint = f" (did you mean '{index['names'][suggestion[0]]}'?)" if suggestion else ''
+        warnings.append(f"class '{class_info['name']}' is not in the catalogue{hint}")
+    
+    instructor = class_info.get('instructor')
+    if instructor:
+        candidates = index['instructors'].get(name) or index['all_instructors']
+        found = [known for known in candidates
+                 if instructor_matches(instructor, known) or instructor_matches(known, instructor)]
+        if len(found) == 1:
+            resolved['instructor'] = found[0]
+        elif found:
+            warnings.append(f"instructor '{instructor}' is ambiguous ({', '.join(found)})")
+        else:
+            warnings.append(f"instructor '{instructor}' is not in the catalogue")
+    
+    return resolved, warnings
+
+
+def resolve_plan(config, plan):
+    """Resolve every planned class to its catalogue entry before the browser starts
+    
+    Entries are rewritten to the catalogue spelling and tagged with their studio
+    key; unresolvable entries are kept as configured and warned about.
+    """
+    for studio_key, studio_plan in plan.items():
+        index = get_catalogue_index(config, studio_key)
+        if index is None:
+            print(f"  No fresh class catalogue for {studio_plan['studio']['name']} yet (built during this run)")
+        resolved_classes = []
+        for class_info in studio_plan['classes']:
+            class_info = dict(class_info, studio=studio_key)
+            if index is not None:
+                class_info, warnings = resolve_class(index, class_info)
+                for warning in warnings:
+                    print(f"  ⚠️ {studio_plan['studio']['name']} {class_info['time']}: {warning}")
+            resolved_classes.append(class_info)
+        studio_plan['classes'] = resolved_classes
+    return plan
+
+
+# ============================================================
+# CLASS DEMAND
+# ============================================================
+
+# "5 spots left", "1 spot remaining", "12 places available"
+SPOTS_PATTERN = re.compile(r'(\d+)\s+(?:spots?|places?|openings?)\s+(?:left|remaining|available|open)', re.IGNORECASE)
+
+DEMAND_HISTORY = None
+
+
+def get_demand_file(config):
+    """Return the path of the spots-left history"""
+    return config.get('demand', {}).get('file', 'demand_history.json')
+
+
+def load_demand_history(config):
+    """Load the spots-left history of every class (once per process)"""
+    global DEMAND_HISTORY
+    if DEMAND_HISTORY is None:
+        try:
+            with open(get_demand_file(config), 'r') as f:
+                DEMAND_HISTORY = json.load(f)
+        except (OSError, ValueError):
+            DEMAND_HISTORY = {}
+    return DEMAND_HISTORY
+
+
+def save_demand_history(config):
+    """Persist the spots-left history"""
+    if DEMAND_HISTORY is None:
+        return
+    try:
+        with open(get_demand_file(config), 'w') as f:
+            json.dump(DEMAND_HISTORY, f, indent=2, sort_keys=True, ensure_ascii=False)
+    except OSError as e:
+        print(f"  Could not save demand history (non-critical): {str(e)}")
+
+
+def demand_key(studio_key, name, weekday, start):
+    """Identify a weekly class slot: studio, normalized name, weekday and (hour, minute)"""
+    return f"{studio_key}|{normalize_text(name)}|{weekday.lower()}|{start[0]:02d}:{start[1]:02d}"
+
+
+def read_spots_left(card):
+    """Spots left printed on a card, 0 for a full/waitlist card, None if not shown"""
+    match = SPOTS_PATTERN.search(card['text'])
+    if match:
+        return int(match.group(1))
+    if not card['bookable']:
+        return 0
+    return None
+
+
+def record_spots_left(config, studio_key, cards, target_date):
+    """Add the spots left of every card in a schedule reading to the demand history"""
+    history = load_demand_history(config)
+    keep = config.get('demand', {}).get('max_observations', 100)
+    now = int(time.time())
+    for card in cards:
+        name, _ = parse_card_lines(card)
+        times = find_times(card['text'])
+        spots = read_spots_left(card)
+        if not name or not times or spots is None:
+            continue
+        key = demand_key(studio_key, name, target_date.strftime('%A'), times[0])
+        observations = history.setdefault(key, [])
+        observations.append({'session': target_date.strftime('%Y-%m-%d'), 'at': now, 'spots': spots})
+        del observations[:-keep]
+
+
+def estimate_demand(observations):
+    """Summarize a class slot's history as {'spots', 'fill_per_hour', 'hours_to_full'}
+    
+    spots is the median of the first reading of each session (what is usually
+    left when the run gets there). fill_per_hour is the median rate at which
+    spots went between readings of the same session. hours_to_full is
+    None without a measured fill rate.
+    """
+    sessions = {}
+    for observation in sorted(observations, key=lambda o: o['at']):
+        sessions.setdefault(observation['session'], []).append(observation)
+    if not sessions:
+        return {'spots': None, 'fill_per_hour': None, 'hours_to_full': None}
+    
+    spots = statistics.median(readings[0]['spots'] for readings in sessions.values())
+    rates = []
+    for readings in sessions.values():
+        first, last = readings[0], readings[-1]
+        if last['at'] > first['at']:
+            rates.append((first['spots'] - last['spots']) * 3600.0 / (last['at'] - first['at']))
+    fill_per_hour = statistics.median(rates) if rates else None
+    
+    if spots == 0:
+        hours_to_full = 0.0
+    elif fill_per_hour and fill_per_hour > 0:
+        hours_to_full = spots / fill_per_hour
+    else:
+        hours_to_full = None
+    return {'spots': spots, 'fill_per_hour': fill_per_hour, 'hours_to_full': hours_to_full}
+
+
+def order_by_demand(config, plan, target_date):
+    """Return [(studio_key, class_info)] with the classes most likely to sell out first
+    
+    Order: explicit "priority" (higher first), then estimated hours until the
+    class fills, then fewest spots usually left, then config order. Classes
+    without history keep their config order after those with evidence of demand.
+    """
+    history = load_demand_history(config)
+    weekday = target_date.strftime('%A')
+    ranked = []
+    for studio_key, studio_plan in plan.items():
+        for class_info in studio_plan['classes']:
+            start = (find_times(class_info['time']) or [(0, 0)])[0]
+            demand = estimate_demand(history.get(demand_key(studio_key, class_info['name'], weekday, start), []))
+            rank = (
+                -class_info.get('priority', 0),
+                demand['hours_to_full'] if demand['hours_to_full'] is not None else float('inf'),
+                demand['spots'] if demand['spots'] is not None else float('inf'),
+                len(ranked),
+            )
+            ranked.append((rank, studio_key, class_info, demand))
+    ranked.sort(key=lambda item: item[0])
+    
+    print("Booking order (highest demand first):")
+    for rank, studio_key, class_info, demand in ranked:
+        reasons = []
+        if class_info.get('priority'):
+            reasons.append(f"priority {class_info['priority']}")
+        if demand['hours_to_full'] is not None:
+            reasons.append(f"fills in ~{demand['hours_to_full']:.1f}h")
+        if demand['spots'] is not None:
+            reasons.append(f"~{demand['spots']:g} spots usually left")
+        print(f"  {class_info['name']} at {class_info['time']}: {', '.join(reasons) or 'no history'}")
+    return [(studio_key, class_info) for _, studio_key, class_info, _ in ranked]
+
+
+# ============================================================
+# CLASS IDENTITY CACHE
+# ============================================================
+
+# What identifies a class card: id-like data attributes and the links it holds
+CARD_IDENTITY_SCRIPT = """
+card => {
+    const ids = {};
+    const links = [];
+    for (const el of [card, ...card.querySelectorAll('*')]) {
+        for (const attr of el.attributes) {
+            if (/^data-(?!mbb).*(id|class|schedule|session|visit)/i.test(attr.name) && attr.value) {
+                ids[attr.name] = attr.value;
+            }
+        }
+        const href = el.getAttribute('href');
+        if (href && !href.startsWith('#') && !href.startsWith('javascript:')) {
+            links.push(new URL(href, document.baseURI).href);
+        }
+    }
+    return {ids, links};
+}
+"""
+
+# How a date can appear in a URL or request body, most specific first
+URL_DATE_FORMATS = ['%Y-%m-%d', '%m%%2F%d%%2F%Y', '%m/%d/%Y', '%m-%d-%Y', '%Y%m%d']
+# {date:%Y-%m-%d} is the class date, {date+6:%Y-%m-%d} six days later
+URL_DATE_TOKEN = re.compile(r'\{date([+-]\d+)?:([^}]+)\}')
+# Parameter names an all-digit date (20261019) must sit under before it is taken for a date
+DATE_PARAMETER_NAME = re.compile(r'date|day|start|end|from|until', re.IGNORECASE)
+
+CLASS_IDENTITIES = None
+
+
+def get_identity_file(config):
+    """Return the path of the class identity cache"""
+    return config.get('class_identity', {}).get('file', 'class_identity.json')
+
+
+def load_class_identities(config):
+    """Load the identifiers and booking links of every weekly class (once per process)"""
+    global CLASS_IDENTITIES
+    if CLASS_IDENTITIES is None:
+        try:
+            with open(get_identity_file(config), 'r') as f:
+                CLASS_IDENTITIES = json.load(f)
+        except (OSError, ValueError):
+            CLASS_IDENTITIES = {}
+    return CLASS_IDENTITIES
+
+
+def save_class_identities(config):
+    """Persist the class identity cache"""
+    if CLASS_IDENTITIES is None:
+        return
+    try:
+        with open(get_identity_file(config), 'w') as f:
+            json.dump(CLASS_IDENTITIES, f, indent=2, sort_keys=True, ensure_ascii=False)
+    except OSError as e:
+        print(f"  Could not save class identity cache (non-critical): {str(e)}")
+
+
+def identity_key(class_info, target_date):
+    """Identify a weekly class: studio, weekday, start time, name and instructor"""
+    start = (find_times(class_info['time']) or [(0, 0)])[0]
+    key = demand_key(class_info.get('studio') or 'default', class_info['name'], target_date.strftime('%A'), start)
+    return f"{key}|{normalize_text(class_info.get('instructor', ''))}"
+
+
+def read_card_identity(card):
+    """Ids and links of a matched card ({'ids': {...}, 'links': [...]}); empty if unreadable"""
+    try:
+        return card.evaluate(CARD_IDENTITY_SCRIPT)
+    except Exception:
+        return {'ids': {}, 'links': []}
+
+
+def date_template(text, target_date, offsets=(0,)):
+    """Turn a URL or body into a template with {date...} tokens in place of dates, or None
+    
+    offsets are the days around target_date to look for (date ranges in API requests).
+    Only whole values are replaced: a query, form or JSON value, or a path segment.
+    An all-digit date must also follow a date-like name, so numeric ids stay as they are.
+    """
+    template = text
+    for offset in offsets:
+        token = 'date' if offset == 0 else f'date{offset:+d}'
+        for date_format in URL_DATE_FORMATS:
+            rendered = (target_date + timedelta(days=offset)).strftime(date_format)
+            if rendered not in template:
+                continue
+            # (name)(separator)date, ending the value or followed by a time ("T06:00")
+            pattern = re.compile(r'([\w.\[\]-]*)(=|"\s*:\s*"?|/)' + re.escape(rendered) + r'(?=$|[&/"\'?#T,}\s])')
+            
+            def replace(match, rendered=rendered, tag='{' + token + ':' + date_format + '}'):
+                if rendered.isdigit() and not DATE_PARAMETER_NAME.search(match.group(1)):
+                    return match.group(0)
+                return match.group(1) + match.group(2) + tag
+            template = pattern.sub(replace, template)
+    return template if template != text else None
+
+
+def fill_date_template(template, target_date):
+    """Fill a date template in for another date"""
+    return URL_DATE_TOKEN.sub(
+        lambda m: (target_date + timedelta(days=int(m.group(1) or 0))).strftime(m.group(2)), template)
+
+
+def remember_class_identity(config, class_info, target_date, card_identity, url):
+    """Cache a class's card ids and the booking URL its Book button led to"""
+    studio = get_studio(config, class_info.get('studio'))
+    lowered = url.lower()
+    if url.split('?')[0].rstrip('/') == studio['url'].rstrip('/') or 'signin.' in lowered or 'captcha' in lowered:
+        # The Book button opened a dialog or a sign-in detour; no deep link to learn
+        template = None
+    else:
+        template = date_template(url, target_date)
+    identities = load_class_identities(config)
+    key = identity_key(class_info, target_date)
+    entry = identities.get(key, {})
+    entry.update({
+        'name': class_info['name'],
+        'ids': card_identity.get('ids', {}),
+        'links': card_identity.get('links', [])[:10],
+        'booking_url': url,
+        'captured_at': time.time(),
+    })
+    if template:
+        entry['checkout_template'] = template
+        entry['failures'] = 0
+    identities[key] = entry
+    print(f"  Cached class identity ({'deep link' if template else 'ids only'}) for {class_info['name']}")
+
+
+def validate_checkout_page(page, class_info, target_date):
+    """True if the page is the booking page of this class on this date, with a Buy button"""
+    try:
+        text = normalize_text(page.locator('body').inner_text(timeout=bounded_timeout(5000)))
+    except Exception:
+        return False
+    tokens = text_tokens(text)
+    if not text_tokens(class_info['name']) <= tokens:
+        print(f"  ✗ Class name '{class_info['name']}' not on the page")
+        return False
+    start = (find_times(class_info['time']) or [None])[0]
+    if start and start not in find_times(text):
+        print(f"  ✗ Start time {class_info['time']} not on the page")
+        return False
+    month, day = target_date.strftime('%B').lower(), target_date.day
+    dates = [f"{month} {day}", f"{month[:3]} {day}", f"{day} {month}", f"{day} {month[:3]}",
+             f"{target_date.month}/{day}", target_date.strftime('%m/%d')]
+    if not any(re.search(r'(?<!\w)' + re.escape(d) + r'(?!\d)', text) for d in dates):
+        print(f"  ✗ Date {target_date.strftime('%B %d')} not on the page")
+        return False
+    try:
+        find_element(page, 'buy_button', timeout=5000)
+    except Exception:
+        print("  ✗ No Buy button on the page")
+        return False
+    return True
+
+
+def jump_to_checkout(page, config, class_info, target_date, password):
+    """Open the cached booking link of a class for the target date; False means do the full search"""
+    settings = config.get('class_identity', {})
+    if not settings.get('deep_link', True):
+        return False
+    entry = load_class_identities(config).get(identity_key(class_info, target_date))
+    if not entry or not entry.get('checkout_template'):
+        return False
+    
+    url = fill_date_template(entry['checkout_template'], target_date)
+    print(f"Jumping straight to the cached booking link: {url}")
+    try:
+        response = page.goto(url, wait_until='load', timeout=bounded_timeout(30000))
+        ok = not response or response.status < 400
+        if ok and ('signin.mindbodyonline.com' in page.url or 'login' in page.url.lower()):
+            ok = login_after_book(page, config, password)
+        ok = ok and validate_checkout_page(page, class_info, target_date)
+    except Exception as e:
+        print(f"  ✗ Booking link failed: {str(e)}")
+        ok = False
+    
+    if ok:
+        print("  ✓ Booking page validated, skipping the schedule search")
+        entry['failures'] = 0
+        METRICS.inc('mindbody_deep_link_jumps', {'outcome': 'ok'})
+        return True
+    
+    entry['failures'] = entry.get('failures', 0) + 1
+    if entry['failures'] >= settings.get('max_failures', 3):
+        # Keep the ids, forget a link that keeps failing until a search captures a new one
+        entry.pop('checkout_template', None)
+    METRICS.inc('mindbody_deep_link_jumps', {'outcome': 'fallback'})
+    print("  Falling back to the full schedule search")
+    return False
+
+
+# ============================================================
+# AVAILABILITY PROBE
+# ============================================================
+
+# Key names (lower-case, no underscores) of the fields read from schedule JSON
+RECORD_NAME_KEYS = ('classname', 'name', 'title', 'coursename')
+RECORD_NESTED_NAME_KEYS = ('classdescription', 'course', 'class')
+RECORD_START_KEYS = ('startdatetime', 'starttime', 'startsat', 'start', 'startdate')
+RECORD_SPOTS_KEYS = ('spotsleft', 'spotsavailable', 'availablespots', 'remainingcapacity', 'openings')
+RECORD_BOOKABLE_KEYS = ('isavailable', 'bookable', 'isbookable', 'canbook', 'available')
+RECORD_BOOKED_KEYS = ('isbooked', 'booked', 'isenrolled', 'userbooked', 'isuserbooked')
+RECORD_ID_KEYS = ('classscheduleid', 'classid', 'scheduleid', 'id')
+RECORD_OPENS_KEYS = ('bookingopens', 'bookingopensat', 'bookingwindowstart', 'registrationopens', 'opensat')
+
+# Recent xhr/fetch responses of each studio page, searched for schedule data
+SCHEDULE_RESPONSES = {}
+# Studios whose endpoint is still to be learned: studio key -> (responses, class_info, target_date)
+PENDING_ENDPOINTS = {}
+SCHEDULE_ENDPOINTS = None
+# The probe of the current run; None when it is off or no browser is running
+AVAILABILITY_PROBE = None
+
+
+def get_endpoint_file(config):
+    """Return the path of the learned schedule endpoints"""
+    return config.get('probe', {}).get('file', 'schedule_api.json')
+
+
+def load_schedule_endpoints(config):
+    """Load the schedule data endpoint learned for each studio (once per process)"""
+    global SCHEDULE_ENDPOINTS
+    if SCHEDULE_ENDPOINTS is None:
+        try:
+            with open(get_endpoint_file(config), 'r') as f:
+                SCHEDULE_ENDPOINTS = json.load(f)
+        except (OSError, ValueError):
+            SCHEDULE_ENDPOINTS = {}
+    return SCHEDULE_ENDPOINTS
+
+
+def save_schedule_endpoints(config):
+    """Persist the learned schedule endpoints"""
+    if SCHEDULE_ENDPOINTS is None:
+        return
+    try:
+        with open(get_endpoint_file(config), 'w') as f:
+            json.dump(SCHEDULE_ENDPOINTS, f, indent=2, sort_keys=True, ensure_ascii=False)
+    except OSError as e:
+        print(f"  Could not save schedule endpoints (non-critical): {str(e)}")
+
+
+def watch_schedule_responses(page):
+    """Keep the last xhr/fetch responses of a page so the schedule endpoint can be learned"""
+    responses = SCHEDULE_RESPONSES.setdefault(page, deque(maxlen=40))
+    page.on('response', lambda response: responses.append(response)
+            if response.request.resource_type in ('xhr', 'fetch') else None)
+
+
+def iter_dicts(node):
+    """Every dict inside a JSON document, outermost first"""
+    if isinstance(node, dict):
+        yield node
+        node = list(node.values())
+    if isinstance(node, list):
+        for item in node:
+            yield from iter_dicts(item)
+
+
+def as_number(value):
+    """A JSON number or numeric string as a float, else None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_field(fields, keys):
+    """First present, non-empty value among keys of a lower-cased record"""
+    for key in keys:
+        value = fields.get(key)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def parse_record_start(value, tz=None):
+    """Start of a class from an ISO date-time as naive wall-clock time, or None
+    
+    A value with an offset ("Z", "+00:00") is converted to tz (the studio's timezone)
+    first; a value without one is taken as studio time already.
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        start = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if start.tzinfo is not None and tz is not None:
+        start = start.astimezone(tz)
+    return start.replace(tzinfo=None)
+
+
+def parse_availability(payload, target_date, tz=None):
+    """Class availability records for target_date found anywhere in a schedule JSON payload
+    
+    Times are read in tz, the studio's timezone. Each record is {'id', 'name', 'instructor', 'start': (hour, minute), 'spots_left',
+    'bookable', 'booked', 'cancelled', 'opens_at'}; unknown values are None.
+    """
+    records = []
+    for item in iter_dicts(payload):
+        fields = {key.lower().replace('_', ''): value for key, value in item.items()}
+        start = parse_record_start(record_field(fields, RECORD_START_KEYS), tz)
+        name = record_field(fields, RECORD_NAME_KEYS)
+        for key in RECORD_NESTED_NAME_KEYS:
+            if not isinstance(name, str) and isinstance(fields.get(key), dict):
+                name = {k.lower(): v for k, v in fields[key].items()}.get('name')
+        if not start or not isinstance(name, str) or start.date() != target_date.date():
+            continue
+        
+        spots = as_number(record_field(fields, RECORD_SPOTS_KEYS))
+        capacity, booked_count = as_number(fields.get('maxcapacity')), as_number(fields.get('totalbooked'))
+        if spots is None and capacity is not None and booked_count is not None:
+            spots = capacity - booked_count
+        spots = max(0, int(spots)) if spots is not None else None
+        cancelled = bool(fields.get('iscanceled') or fields.get('iscancelled') or fields.get('cancelled'))
+        bookable = record_field(fields, RECORD_BOOKABLE_KEYS)
+        if not isinstance(bookable, bool):
+            bookable = spots > 0 if spots is not None else None
+        booked = record_field(fields, RECORD_BOOKED_KEYS)
+        staff = fields.get('staff') or fields.get('instructor') or fields.get('staffname')
+        if isinstance(staff, dict):
+            staff = {k.lower(): v for k, v in staff.items()}.get('name')
+        
+        records.append({
+            'id': record_field(fields, RECORD_ID_KEYS),
+            'name': name,
+            'instructor': staff if isinstance(staff, str) else None,
+            'start': (start.hour, start.minute),
+            'spots_left': spots,
+            'bookable': bookable and not cancelled if bookable is not None else None,
+            'booked': booked if isinstance(booked, bool) else None,
+            'cancelled': cancelled,
+            'opens_at': parse_record_start(record_field(fields, RECORD_OPENS_KEYS), tz),
+        })
+    return records
+
+
+def match_availability(records, class_info):
+    """The availability record of a configured class, or None"""
+    start = (find_times(class_info['time']) or [None])[0]
+    wanted = text_tokens(class_info['name'])
+    for record in records:
+        if record['start'] != start or not wanted <= text_tokens(record['name']):
+            continue
+        if class_info.get('instructor') and not instructor_matches(class_info['instructor'], record['instructor'] or ''):
+            continue
+        return record
+    return None
+
+
+def queue_endpoint_learning(page, config, class_info, target_date):
+    """Note the responses a studio page received so far, to look for schedule data later
+    
+    Costs no round trip: the bodies are only read by learn_schedule_endpoints(),
+    which runs off the critical path (during login or after checkout).
+    """
+    studio_key = get_studio(config, class_info.get('studio'))['key']
+    if studio_key in load_schedule_endpoints(config) or studio_key in PENDING_ENDPOINTS:
+        return
+    PENDING_ENDPOINTS[studio_key] = (list(SCHEDULE_RESPONSES.get(page, ())), class_info, target_date)
+
+
+def learn_schedule_endpoints(config):
+    """Find which noted response held the schedule and remember how to repeat it
+    
+    A generator that yields before every response body it reads, so it can be
+    stepped from the login pipeline; exhaust it to run it in one go.
+    """
+    endpoints = load_schedule_endpoints(config)
+    while PENDING_ENDPOINTS:
+        studio_key, (responses, class_info, target_date) = PENDING_ENDPOINTS.popitem()
+        for response in reversed(responses):
+            yield
+            try:
+                if 'json' not in (response.headers.get('content-type') or ''):
+                    continue
+                payload = json.loads(response.text())
+                tz = ZoneInfo(get_studio(config, studio_key).get('timezone', 'America/Toronto'))
+                if not match_availability(parse_availability(payload, target_date, tz), class_info):
+                    continue
+                request = response.request
+                offsets = range(-1, 15)
+                endpoints[studio_key] = {
+                    'method': request.method,
+                    'url': date_template(request.url, target_date, offsets) or request.url,
+                    'post_data': (date_template(request.post_data, target_date, offsets) or request.post_data
+                                  if request.post_data else None),
+                    'content_type': request.headers.get('content-type'),
+                    'learned_at': time.time(),
+                }
+                print(f"  Learned the schedule data endpoint of {get_studio(config, studio_key)['name']}: "
+                      f"{request.method} {urlparse(request.url).path}")
+                break
+            except Exception:
+                # Bodies go away once the page navigates; the next run tries again
+                continue
+
+
+class AvailabilityProbe:
+    """Schedule data for one date, fetched over the context's request API
+    
+    The request API shares the browser context's cookies and keeps its connections
+    alive between calls. Responses are revalidated with ETag/Last-Modified, and an
+    unchanged body (same SHA-1) is not parsed again.
+    """
+    
+    def __init__(self, context, config):
+        self.request = context.request
+        self.config = config
+        self.cache = {}   # (studio key, date) -> {'etag', 'last_modified', 'hash', 'records'}
+    
+    def fetch(self, studio_key, target_date):
+        """Availability records of a studio for a date, or None without a learned endpoint or on error"""
+        endpoint = load_schedule_endpoints(self.config).get(studio_key)
+        if not endpoint:
+            return None
+        key = (studio_key, target_date.strftime('%Y-%m-%d'))
+        cached = self.cache.get(key)
+        headers = {'accept': 'application/json'}
+        if endpoint.get('content_type'):
+            headers['content-type'] = endpoint['content_type']
+        if cached and cached.get('etag'):
+            headers['if-none-match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['if-modified-since'] = cached['last_modified']
+        
+        try:
+            response = self.request.fetch(
+                fill_date_template(endpoint['url'], target_date),
+                method=endpoint.get('method', 'GET'),
+                headers=headers,
+                data=fill_date_template(endpoint['post_data'], target_date) if endpoint.get('post_data') else None,
+                timeout=bounded_timeout(self.config.get('probe', {}).get('timeout_ms', 10000))
+            )
+            try:
+                if response.status == 304 and cached:
+                    METRICS.inc('mindbody_probe_requests', {'result': 'not_modified'})
+                    return cached['records']
+                if not response.ok:
+                    print(f"  Availability probe got HTTP {response.status} (non-critical)")
+                    METRICS.inc('mindbody_probe_requests', {'result': 'error'})
+                    return None
+                body = response.body()
+                response_headers = response.headers
+            finally:
+                response.dispose()
+        except Exception as e:
+            print(f"  Availability probe failed (non-critical): {str(e)}")
+            METRICS.inc('mindbody_probe_requests', {'result': 'error'})
+            return None
+        
+        digest = hashlib.sha1(body).hexdigest()
+        if cached and cached['hash'] == digest:
+            METRICS.inc('mindbody_probe_requests', {'result': 'unchanged'})
+            return cached['records']
+        try:
+            tz = ZoneInfo(get_studio(self.config, studio_key).get('timezone', 'America/Toronto'))
+            records = parse_availability(json.loads(body), target_date, tz)
+        except Exception:
+            METRICS.inc('mindbody_probe_requests', {'result': 'error'})
+            return None
+        self.cache[key] = {
+            'etag': response_headers.get('etag'),
+            'last_modified': response_headers.get('last-modified'),
+            'hash': digest,
+            'records': records,
+        }
+        METRICS.inc('mindbody_probe_requests', {'result': 'fresh'})
+        return records
+    
+    def check(self, config, class_info, target_date):
+        """(data available, record of the class or None) in one request"""
+        records = self.fetch(get_studio(config, class_info.get('studio'))['key'], target_date)
+        if records is None:
+            return False, None
+        return True, match_availability(records, class_info)
+
+
+def describe_availability(record):
+    """One-line summary of an availability record"""
+    if record['cancelled']:
+        return "cancelled"
+    spots = f"{record['spots_left']} spot(s) left" if record['spots_left'] is not None else "spots unknown"
+    state = {True: "bookable", False: "not bookable", None: "bookability unknown"}[record['bookable']]
+    return f"{spots}, {state}"
+
+
+def latest_release(config, class_info, target_date, record):
+    """Latest time booking for a class opens (aware, studio timezone), or None if unknown
+    
+    Taken from the schedule data when it says, else from the rule inferred by discover.
+    """
+    studio = get_studio(config, class_info.get('studio'))
+    tz = ZoneInfo(studio.get('timezone', 'America/Toronto'))
+    if record.get('opens_at'):
+        return record['opens_at'].replace(tzinfo=tz)
+    try:
+        with open(config.get('discovery', {}).get('plan_file', 'booking_plan.json'), 'r') as f:
+            rules = json.load(f).get('classes', [])
+    except (OSError, ValueError):
+        return None
+    for rule in rules:
+        if rule.get('studio') == studio['key'] and normalize_text(rule.get('name', '')) == normalize_text(class_info['name']) \
+                and find_times(rule.get('time', '')) == find_times(class_info['time']):
+            lead = (rule.get('lead_hours') or {}).get('min')
+            if lead is not None:
+                return session_start(target_date, class_info, tz) - timedelta(hours=lead)
+    return None
+
+
+def preflight_class(config, class_info, target_date):
+    """Check a class with the probe before the page flow, polling while its release is still ahead
+    
+    Returns the last availability record, or None when the probe has nothing to say.
+    """
+    if AVAILABILITY_PROBE is None:
+        return None
+    settings = config.get('probe', {})
+    deadline = time.monotonic() + settings.get('wait_seconds', 120)
+    while True:
+        available, record = AVAILABILITY_PROBE.check(config, class_info, target_date)
+        if not available:
+            return None
+        if not record:
+            print(f"  Pre-flight: {class_info['name']} at {class_info['time']} is not in the schedule data")
+            return None
+        if record['booked']:
+            print(f"  Pre-flight: {class_info['name']} at {class_info['time']} is already booked")
+            return record
+        print(f"  Pre-flight: {class_info['name']} at {class_info['time']}: {describe_availability(record)}")
+        # Only a class that is neither open, full nor cancelled, and whose release is
+        # known to be still ahead, is worth waiting for
+        if record['bookable'] is not False or record['spots_left'] == 0 or record['cancelled']:
+            return record
+        opens = latest_release(config, class_info, target_date, record)
+        if opens is None or datetime.now(opens.tzinfo) >= opens or time.monotonic() >= deadline or budget_exhausted():
+            return record
+        print(f"  Not open for booking yet (opens by {opens.strftime('%H:%M')}), "
+              f"checking again in {settings.get('poll_seconds', 5)}s...")
+        budget_sleep(settings.get('poll_seconds', 5))
+
+
+def confirm_booking_by_probe(config, class_info, target_date):
+    """True/False if the schedule data says whether the class is booked, None if it cannot tell"""
+    if AVAILABILITY_PROBE is None:
+        return None
+    _, record = AVAILABILITY_PROBE.check(config, class_info, target_date)
+    if not record or record['booked'] is None:
+        return None
+    return record['booked']
+
+
+def login(page, config, password):
+    """Handle login flow"""
+    print("Navigating to MindBody homepage...")
+    page.goto(config['homepage'], wait_until='load', timeout=bounded_timeout(60000))
+    human_delay(2000, 4000)
+    
+    # Random browsing behavior
+    random_mouse_movement(page)
+    if random.random() < 0.5:
+        random_idle_behavior(page)
+    
+    # Restored consent already sweeps the overlays; on a cold run the popup covers
+    # Sign In, so accept it here (or sweep it if it never shows) before going on
+    if page.context not in CONSENT_RESOLVED:
+        dismiss_consent(page, config)
+    
+    print("Looking for Sign In button...")
+    # Race all Sign In candidates at once instead of waiting on each in turn
+    try:
+        sign_in_button = find_element(page, 'sign_in_button', timeout=10000)
+        print("Found Sign In button")
+    except Exception:
+        sign_in_button = None
+    
+    if sign_in_button:
+        print("Clicking Sign In button...")
+        random_mouse_movement(page)  # Move mouse naturally first
+        human_click(sign_in_button, page)
+        print("Waiting for login page to load...")
+        page.wait_for_load_state('load', timeout=bounded_timeout(30000))
+        human_delay(2000, 3000)
+    else:
+        print("Sign In button not found, may already be logged in or on login page")
+    
+    # Check if we need to login
+    print(f"Current URL: {page.url}")
+    
+    # If we're already on the signin page, skip the button clicking
+    if 'signin.mindbodyonline.com' in page.url or 'login' in page.url.lower():
+        print("Already on login page, proceeding with login...")
+    else:
+        print("Not on login page yet, need to navigate there...")
+    
+    print(f"Entering email: {config['email']}")
+    
+    # Random mouse movement (like browsing)
+    random_mouse_movement(page)
+    human_delay(500, 1000)
+    
+    # Take screenshot for debugging
+    save_screenshot(page, 'debug_login_page.png')
+    print("Screenshot saved as debug_login_page.png")
+    
+    # Try to find email input
+    try:
+        email_input = find_element(page, 'email_input', timeout=5000)
+    except:
+        print("Standard email input not found. Trying alternative selectors...")
+        # Try finding any input field (locators hold no handles in the page)
+        print(f"Found {page.locator('input').count()} input fields")
+        email_input = page.locator('input').first
+        email_input.wait_for(timeout=bounded_timeout(10000))
+    
+    # Click on email input first
+    human_click(email_input, page)
+    human_delay(200, 500)
+    
+    # Type email in human-like way
+    human_type(email_input, config['email'], page)
+    human_delay(300, 700)
+    
+    print("Clicking continue button...")
+    continue_button = find_element(page, 'continue_button', timeout=10000)
+    human_click(continue_button, page)
+    human_delay(1500, 2500)
+    
+    print("Entering password...")
+    password_input = find_element(page, 'password_input', timeout=10000)
+    
+    # Click on password input first
+    human_click(password_input, page)
+    human_delay(200, 500)
+    
+    # Type password in human-like way
+    human_type(password_input, password, page)
+    human_delay(300, 700)
+    
+    print("Submitting login form...")
+    submit_button = find_element(page, 'submit_button', timeout=10000)
+    human_click(submit_button, page)
+    
+    print("Waiting for authentication to complete...")
+    page.wait_for_load_state('load', timeout=bounded_timeout(30000))
+    human_delay(2000, 4000)
+    print("Login successful!")
+
+
+def book_class(page, config, class_info, target_date, password, max_retries=5, attempt_fn=None):
+    """Book a specific class with retry logic; returns True, False, or None when unverified
+    
+    An attempt that returns None reached checkout without a clear answer, so it is
+    not retried. attempt_fn replaces _attempt_booking (same arguments); fault rehearsals use it
+    to drive this retry loop with a read-only attempt.
+    """
+    attempt_fn = attempt_fn or _attempt_booking
+    print(f"\n{'='*60}")
+    print(f"Attempting to book: {class_info['name']} at {class_info['time']}")
+    print(f"Target date: {target_date.strftime('%A, %B %d, %Y')}")
+    print(f"{'='*60}\n")
+    
+    for attempt in range(1, max_retries + 1):
+        if budget_exhausted():
+            record_budget_cut(f"{class_info['name']} at {class_info['time']}",
+                              f"attempts {attempt}-{max_retries} not tried")
+            return False
+        print(f"Booking attempt {attempt}/{max_retries}...")
+        METRICS.inc('mindbody_booking_attempts')
+        if attempt > 1:
+            METRICS.inc('mindbody_retries', {'kind': 'booking'})
+        try:
+            with phase('attempt'):
+                success = attempt_fn(page, config, class_info, target_date, password, attempt)
+            if success:
+                METRICS.inc('mindbody_booking_successes')
+                return True
+            if success is None:
+                print("⚠️ Check your MindBody account for this class before booking it again")
+                return None
+            else:
+                if attempt < max_retries:
+                    print(f"Attempt {attempt} failed, retrying...")
+                    human_delay(2000, 4000)
+        except Exception as e:
+            print(f"Attempt {attempt} error: {str(e)}")
+            record_failure('exception')
+            if attempt < max_retries:
+                print(f"Retrying after error...")
+                human_delay(2000, 4000)
+    
+    print(f"Failed to book after {max_retries} attempts")
+    return False
+
+
+# Studio pages whose navigation was started up front by preload_studio_page()
+PRELOADED_PAGES = set()
+
+
+def preload_studio_page(page, studio):
+    """Start loading a studio page without waiting, so several studios load side by side"""
+    print(f"Preloading {studio['name']} page...")
+    page.goto(studio['url'], wait_until='commit', timeout=bounded_timeout(60000))
+    PRELOADED_PAGES.add(page)
+
+
+def open_studio_page(page, config, studio):
+    """Navigate to the studio page and dismiss the cookie consent popup"""
+    if page in PRELOADED_PAGES:
+        PRELOADED_PAGES.discard(page)
+        print(f"Finishing preloaded {studio['name']} page...")
+        page.wait_for_load_state('load', timeout=bounded_timeout(60000))
+    else:
+        print(f"Navigating to {studio['name']} page...")
+        page.goto(studio['url'], wait_until='load', timeout=bounded_timeout(60000))
+    human_delay(2000, 4000)  # Human-like delay
+    
+    # Random mouse movement (simulate browsing)
+    random_mouse_movement(page)
+    
+    # Handle cookie consent popup on studio page (only until this context has consent)
+    with phase('consent'):
+        try:
+            dismiss_consent(page, config)
+        except Exception as e:
+            print(f"Cookie popup handling: {str(e)}")
+    
+    # Simulate reading the page
+    if random.random() < 0.4:
+        random_idle_behavior(page)
+    human_delay(500, 1000)
+
+
+# Reads the calendar strip in one round trip: every day control (weekday name plus
+# day number, e.g. "MON\n24") is tagged with data-mbb-date, and the week paging
+# controls with data-mbb-date-nav="next"/"prev"
+READ_DATE_STRIP_SCRIPT = """
+() => {
+    const dayText = /^\\s*(?:(mon|tue|wed|thu|fri|sat|sun)[a-z]*\\.?[\\s,]*(\\d{1,2})|(\\d{1,2})[\\s,]*(mon|tue|wed|thu|fri|sat|sun)[a-z]*\\.?)(?:[\\s,]+([a-z]{3,9}))?\\s*$/i;
+    const clickable = el => el.closest('button, a, [role="button"], [role="tab"], [role="option"], li') || el;
+    document.querySelectorAll('[data-mbb-date]').forEach(el => el.removeAttribute('data-mbb-date'));
+    document.querySelectorAll('[data-mbb-date-nav]').forEach(el => el.removeAttribute('data-mbb-date-nav'));
+    
+    // Smallest elements whose whole text is a day label
+    const labels = Array.from(document.querySelectorAll('body *')).filter(el => {
+        // textContent is a cheap pre-filter; innerText needs layout
+        if ((el.textContent || '').length > 60) return false;
+        const text = el.innerText || '';
+        return text.length <= 30 && dayText.test(text) &&
+            !Array.from(el.children).some(child => dayText.test(child.innerText || ''));
+    });
+    const days = [];
+    const seen = new Set();
+    for (const label of labels) {
+        const control = clickable(label);
+        if (seen.has(control)) continue;
+        seen.add(control);
+        const match = (label.innerText || '').match(dayText);
+        control.setAttribute('data-mbb-date', String(days.length));
+        days.push({
+            index: days.length,
+            weekday: (match[1] || match[4]).toLowerCase(),
+            day: parseInt(match[2] || match[3], 10),
+            month: match[5] || null,
+            selected: control.getAttribute('aria-selected') === 'true' || control.getAttribute('aria-pressed') === 'true'
+        });
+    }
+    
+    const navText = {next: /^(next|›|>|»|→)|next (week|days)/i, prev: /^(prev|previous|‹|<|«|←)|previous (week|days)/i};
+    const nav = {next: false, prev: false};
+    for (const el of document.querySelectorAll('button, a, [role="button"]')) {
+        const label = ((el.getAttribute('aria-label') || '') + ' ' + (el.innerText || '')).trim();
+        for (const direction of ['next', 'prev']) {
+            if (!nav[direction] && navText[direction].test(label) && !el.disabled) {
+                el.setAttribute('data-mbb-date-nav', direction);
+                nav[direction] = true;
+            }
+        }
+    }
+    return {days: days, nav: nav};
+}
+"""
+
+
+def resolve_strip_dates(days, today=None):
+    """Map the day controls of a date strip to real dates: {date: control index}
+    
+    A control only shows a weekday and a day number (sometimes a month), so the
+    date is the one within two months of today that has both.
+    """
+    today = (today or datetime.now()).date()
+    dates = {}
+    for day in days:
+        month = None
+        if day['month']:
+            for fmt in ('%b', '%B'):
+                try:
+                    month = datetime.strptime(day['month'][:3] if fmt == '%b' else day['month'], fmt).month
+                    break
+                except ValueError:
+                    continue
+        for offset in range(-14, 62):
+            candidate = today + timedelta(days=offset)
+            if (candidate.day == day['day'] and candidate.strftime('%a').lower() == day['weekday'][:3]
+                    and (month is None or candidate.month == month)):
+                dates.setdefault(candidate, day['index'])
+                break
+    return dates
+
+
+def read_date_strip(page):
+    """Parse the visible calendar strip: returns ({date: locator}, {'next': bool, 'prev': bool})"""
+    strip = page.evaluate(READ_DATE_STRIP_SCRIPT)
+    dates = resolve_strip_dates(strip['days'])
+    controls = {date: page.locator(f'[data-mbb-date="{index}"]') for date, index in dates.items()}
+    return controls, strip['nav']
+
+
+def select_date(page, target_date, max_weeks=8):
+    """Click the target date in the studio calendar strip, paging weeks until it is shown"""
+    return run_steps(select_date_steps(page, target_date, max_weeks))
+
+
+def select_date_steps(page, target_date, max_weeks=8):
+    """select_date() as a step generator that yields after every week it pages"""
+    target = target_date.date() if isinstance(target_date, datetime) else target_date
+    print(f"Looking for date: {target.strftime('%a %d %B').upper()}")
+    
+    try:
+        for week_page in range(max_weeks + 1):
+            controls, nav = read_date_strip(page)
+            if target in controls:
+                print(f"Clicking date {target.strftime('%a %d')} in the calendar strip")
+                human_click(controls[target], page)
+                print(f"Successfully clicked on date {target.day}")
+                human_delay(3000, 4000)
+                return True
+            
+            if not controls:
+                print("Calendar strip not found on the page")
+                break
+            direction = 'next' if target > max(controls) else 'prev'
+            if week_page == max_weeks or not nav[direction]:
+                print(f"Date {target} is outside the strip ({min(controls)} - {max(controls)}) and cannot page further")
+                break
+            print(f"  {target} is outside {min(controls)} - {max(controls)}, paging {direction}...")
+            human_click(page.locator(f'[data-mbb-date-nav="{direction}"]').first, page)
+            human_delay(800, 1500)
+            yield
+        
+        print(f"Could not find clickable date for {target}")
+        print("Taking screenshot for debugging...")
+        save_screenshot(page, f'error_date_not_found_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return False
+    
+    except Exception as e:
+        print(f"Error finding date: {str(e)}")
+        save_screenshot(page, f'error_date_search_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return False
+
+
+def scan_schedule(page, config, class_infos):
+    """Scroll the schedule until every class in class_infos is rendered or the list ends
+    
+    Returns (cards, matches) where matches[i] is the (card, locator) of
+    class_infos[i], or (None, None) if it never showed up.
+    """
+    return run_steps(scan_schedule_steps(page, config, class_infos))
+
+
+def scan_schedule_steps(page, config, class_infos):
+    """scan_schedule() as a step generator that yields while waiting and after every scroll"""
+    # Wait for classes to load in short waits (a locator, so no element handle is left pinned)
+    first_card = page.locator('[class*="class"], [data-testid*="class"], .schedule-item').first
+    wait_deadline = time.monotonic() + 10
+    while True:
+        try:
+            # The foreground waits in one go; a background step waits briefly and hands back control
+            wait_ms = 50 if IN_BACKGROUND_STEP else max(1, int((wait_deadline - time.monotonic()) * 1000))
+            first_card.wait_for(timeout=bounded_timeout(wait_ms))
+            break
+        except PlaywrightTimeout:
+            if time.monotonic() >= wait_deadline or budget_exhausted():
+                raise
+        yield 0.2
+    human_delay(500, 1000)
+    
+    # Scroll one screen at a time, reading the cards after every increment, until the
+    # classes show up or the list stops growing at the bottom
+    max_passes = config.get('schedule', {}).get('max_scroll_passes', 40)
+    last_height, stalled = None, 0
+    for scroll_pass in range(max_passes + 1):
+        # Read every card in one round trip, then match time and name in Python
+        cards = read_schedule_cards(page)
+        matches = [match_class_card(page, class_info, cards) for class_info in class_infos]
+        if all(card for card, _ in matches):
+            print(f"  Found among {len(cards)} class cards after {scroll_pass} scroll(s)")
+            break
+        
+        state = page.evaluate(SCROLL_STATE_SCRIPT, 0)
+        if state['atEnd']:
+            # Lazily loaded lists grow once the bottom is reached, so give them a moment
+            stalled = stalled + 1 if state['height'] == last_height else 0
+            if stalled >= 2:
+                print(f"  Reached the end of the schedule ({len(cards)} class cards) after {scroll_pass} scroll(s)")
+                break
+        else:
+            stalled = 0
+        last_height = state['height']
+        if scroll_pass == max_passes or budget_exhausted():
+            print(f"  Stopped scrolling after {scroll_pass} scroll(s) ({len(cards)} class cards)")
+            break
+        
+        if not state['atEnd']:
+            amount = random.randint(600, 900)
+            if state['window']:
+                random_scroll(page, direction='down', amount=amount)
+            else:
+                page.evaluate(SCROLL_STATE_SCRIPT, amount)
+        human_delay(400, 800)
+        # Occasional mouse movement while scrolling (very human)
+        if random.random() < 0.3:
+            random_mouse_movement(page)
+        yield
+    
+    return cards, matches
+
+
+def find_class_card(page, config, class_info, target_date):
+    """Locate the card of the requested class on the schedule, or None"""
+    return run_steps(find_class_card_steps(page, config, class_info, target_date))
+
+
+def find_class_card_steps(page, config, class_info, target_date):
+    """find_class_card() as a step generator (see scan_schedule_steps)"""
+    print(f"Searching for class: {class_info['name']} at {class_info['time']}")
+    cards, [(card, target_class)] = yield from scan_schedule_steps(page, config, [class_info])
+    if class_info.get('studio'):
+        record_schedule_reading(config, class_info['studio'], cards, class_info, card)
+        record_spots_left(config, class_info['studio'], cards, target_date)
+    
+    if target_class and page in SCHEDULE_RESPONSES:
+        queue_endpoint_learning(page, config, class_info, target_date)
+    
+    if not target_class:
+        print(f"Could not find class: {class_info['name']} at {class_info['time']}")
+        print("Taking screenshot for debugging...")
+        save_screenshot(page, f'error_class_not_found_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return None
+    
+    preview = ' | '.join(line.strip() for line in card['text'].split('\n') if line.strip())
+    print(f"  ✓ FOUND! {class_info['name']} at {class_info['time']}")
+    print(f"    Text preview: {preview[:150]}...")
+    if not card['bookable']:
+        print(f"Class found but not bookable (button: '{card['button']}') - might be full or already booked")
+        return None
+    
+    return target_class
+
+
+def click_book_button(page, target_class):
+    """Click the Book button inside the matched class card and wait for the next page"""
+    # Look for "Book Now" button within the class container
+    print("Looking for Book Now button...")
+    try:
+        book_button = find_element(page, 'book_button', timeout=5000, scope=target_class)
+    except Exception:
+        print("Class found but no Book button available (might be full or already booked)")
+        save_screenshot(page, f'error_no_book_button_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return False
+    
+    print("Clicking Book Now button...")
+    # Scroll to the button first (human behavior)
+    book_button.scroll_into_view_if_needed(timeout=bounded_timeout(5000))
+    human_delay(300, 600)
+    random_mouse_movement(page)  # Move mouse around a bit
+    human_click(book_button, page)
+    
+    # Wait for page to start loading
+    print("Waiting for page to load after clicking Book Now...")
+    human_delay(2000, 3000)
+    
+    # Wait for network to be idle (page fully loaded)
+    try:
+        page.wait_for_load_state('networkidle', timeout=bounded_timeout(15000))
+        print("Page loaded successfully")
+    except:
+        print("Network idle timeout, continuing anyway...")
+        page.wait_for_load_state('load', timeout=bounded_timeout(10000))
+    
+    # Additional delay to ensure everything is rendered
+    human_delay(3000, 5000)
+    
+    # Check if we're being asked to login after clicking Book Now
+    print(f"After clicking Book Now - Current URL: {page.url}")
+    return True
+
+
+def login_after_book(page, config, password):
+    """Sign in again when clicking Book Now redirected to the sign-in page"""
+    print("⚠️ Login required after clicking Book Now. Logging in...")
+    
+    try:
+        # Wait for the page to fully load
+        page.wait_for_load_state('load', timeout=bounded_timeout(10000))
+        human_delay(2000, 3000)
+        
+        # Enter email
+        print(f"Entering email: {config['email']}")
+        email_input = find_element(page, 'email_input', timeout=10000)
+        human_click(email_input, page)
+        human_delay(200, 500)
+        human_type(email_input, config['email'], page)
+        human_delay(500, 1000)
+        
+        # Click continue
+        print("Clicking continue button...")
+        continue_button = find_element(page, 'continue_button', timeout=10000)
+        human_click(continue_button, page)
+        human_delay(2000, 3000)
+        
+        # Enter password
+        print("Entering password...")
+        password_input = find_element(page, 'password_input', timeout=10000)
+        human_click(password_input, page)
+        human_delay(200, 500)
+        human_type(password_input, password, page)
+        human_delay(500, 1000)
+        
+        # Submit
+        print("Submitting login form...")
+        submit_button = find_element(page, 'submit_button', timeout=10000)
+        human_click(submit_button, page)
+        
+        print("Waiting for authentication to complete...")
+        page.wait_for_load_state('networkidle', timeout=bounded_timeout(30000))
+        human_delay(3000, 5000)
+        print(f"Login completed - New URL: {page.url}")
+        return True
+    except Exception as e:
+        print(f"❌ Error during login after Book Now: {str(e)}")
+        save_screenshot(page, f'error_login_after_book_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return False
+
+
+def handle_captcha(page, config, stage):
+    """Detect a CAPTCHA and solve it with 2captcha; False means the attempt should be retried"""
+    if not detect_captcha(page):
+        return True
+    
+    METRICS.inc('mindbody_captcha_encounters', {'stage': stage})
+    print(f"⚠ CAPTCHA detected ({stage})! Attempting to solve with 2captcha...")
+    save_screenshot(page, f'captcha_{stage}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+    
+    # Try to solve with 2captcha
+    if not solve_recaptcha_v2(page, config):
+        print(f"❌ Failed to solve CAPTCHA ({stage}), going back to retry booking...")
+        try:
+            page.go_back(timeout=bounded_timeout(30000))
+            human_delay(2000, 3000)
+        except:
+            pass
+        return False  # Retry this booking
+    
+    print(f"✓ CAPTCHA solved successfully ({stage}), continuing...")
+    return True
+
+
+# Path segments of the purchase/visit-booking endpoints (whole segments: "book" never matches "bookmarks")
+CHECKOUT_ENDPOINT_SEGMENTS = ['purchase', 'purchases', 'checkout', 'booking', 'bookings',
+                              'reservation', 'reservations', 'enrollment', 'enrollments', 'visits']
+# Body keys whose presence confirms a purchase/booking, and status values that do
+CHECKOUT_CONFIRMATION_KEYS = ('confirmationnumber', 'confirmationid', 'confirmation', 'visitid', 'bookingid',
+                              'reservationid', 'orderid', 'purchaseid', 'saleid')
+CHECKOUT_CONFIRMED_STATUSES = ('confirmed', 'booked', 'completed', 'complete', 'success', 'succeeded', 'enrolled')
+
+
+class CheckoutWatcher:
+    """Collect the purchase/booking responses a page receives once Buy is clicked"""
+
+    def __init__(self, page, config):
+        checkout_config = config.get('checkout', {})
+        self.page = page
+        self.hosts = checkout_config.get('hosts', ['mindbodyonline.com', 'mindbody.io'])
+        self.segments = set(checkout_config.get('endpoint_segments', CHECKOUT_ENDPOINT_SEGMENTS))
+        self.responses = []
+        # Responses before this index were already read by await_checkout_outcome()
+        self.next_index = 0
+        page.on('response', self._on_response)
+
+    def _on_response(self, response):
+        # Only note the response here; reading bodies happens in await_checkout_outcome()
+        try:
+            if response.request.method not in ('POST', 'PUT', 'PATCH'):
+                return
+            parsed = urlparse(response.url)
+            host = parsed.hostname or ''
+            segments = set(parsed.path.lower().split('/'))
+            if any(host == h or host.endswith('.' + h) for h in self.hosts) and segments & self.segments:
+                self.responses.append(response)
+        except Exception:
+            pass
+
+    def stop(self):
+        try:
+            self.page.remove_listener('response', self._on_response)
+        except Exception:
+            pass
+
+
+def read_checkout_response(response):
+    """Classify a purchase/booking response as ('success' | 'failure' | None, detail)
+    
+    Only an HTTP error, an explicit error in the body or a positive confirmation in
+    the body is an answer; anything else (unparseable or unrelated 2xx) is None.
+    """
+    detail = f"{response.request.method} {urlparse(response.url).path} → {response.status}"
+    if response.status >= 400:
+        return 'failure', detail
+    try:
+        body = response.json()
+    except Exception:
+        return None, detail
+    if not isinstance(body, dict):
+        return None, detail
+    if body.get('success') is False or body.get('error') or body.get('errors'):
+        message = body.get('error') or body.get('errors') or body.get('message')
+        return 'failure', f"{detail} ({str(message)[:120]})"
+    for item in iter_dicts(body):
+        fields = {key.lower().replace('_', ''): value for key, value in item.items()}
+        if any(fields.get(key) for key in CHECKOUT_CONFIRMATION_KEYS):
+            return 'success', detail
+        status = fields.get('status')
+        if isinstance(status, str) and status.lower() in CHECKOUT_CONFIRMED_STATUSES:
+            return 'success', detail
+    if body.get('success') is True:
+        return 'success', detail
+    return None, detail
+
+
+def await_checkout_outcome(page, config, watcher, timeout_ms=None, watch_captcha=True):
+    """Wait for the site to confirm or reject the purchase, returning (outcome, detail)
+    
+    outcome is 'success', 'failure', 'captcha' (a challenge must be solved first)
+    or 'unknown' when neither a response nor a confirmation element showed up
+    before timeout_ms (checkout.timeout_ms by default). Once a CAPTCHA has been
+    solved its frame may stay on the page, so watch_captcha=False ignores it.
+    """
+    timeout_ms = bounded_timeout(timeout_ms or config.get('checkout', {}).get('timeout_ms', 20000))
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    confirmation = page.locator(selector_list('confirmation_message')).first
+    error_message = page.locator(selector_list('checkout_error')).first
+    # Only confirm inside a dialog, so the Buy button itself ("Confirm") is never clicked twice
+    confirm_button = page.locator('[role="dialog"], [role="alertdialog"], [class*="modal"]').locator(
+        selector_list('confirm_button')).first
+    captcha_frame = page.locator('iframe[src*="recaptcha"], iframe[title*="reCAPTCHA"]').first
+    confirm_clicked = False
+    
+    while time.monotonic() < deadline:
+        # The purchase/booking response the page sent is the most direct answer
+        if watcher.next_index < len(watcher.responses):
+            outcome, detail = read_checkout_response(watcher.responses[watcher.next_index])
+            watcher.next_index += 1
+            print(f"  Checkout response: {detail}{'' if outcome else ' (no confirmation in the body)'}")
+            if outcome:
+                return outcome, detail
+        
+        try:
+            if confirmation.is_visible():
+                return 'success', f"confirmation shown: {confirmation.inner_text(timeout=bounded_timeout(1000))[:80]!r}"
+            if error_message.is_visible():
+                return 'failure', f"error shown: {error_message.inner_text(timeout=bounded_timeout(1000))[:80]!r}"
+            if not confirm_clicked and confirm_button.is_visible():
+                print("Clicking final confirmation button...")
+                human_click(confirm_button, page)
+                confirm_clicked = True
+            if watch_captcha and ('captcha' in page.url.lower() or captcha_frame.is_visible()):
+                return 'captcha', 'CAPTCHA shown after Buy'
+        except Exception:
+            # The page may be navigating; try again on the next tick
+            pass
+        page.wait_for_timeout(250)
+    
+    return 'unknown', f"no confirmation within {timeout_ms} ms"
+
+
+def click_buy_button(page, config):
+    """Click the Buy button and return a CheckoutWatcher listening for the outcome, or None"""
+    print("Waiting for Buy button...")
+    try:
+        buy_button = find_element(page, 'buy_button', timeout=15000)
+    except PlaywrightTimeout:
+        print("⚠️ Buy button not found within 15 seconds")
+        print(f"Current URL: {page.url}")
+        save_screenshot(page, f'no_buy_button_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return None
+    
+    print(f"✓ Found Buy button! Text: {buy_button.inner_text(timeout=bounded_timeout(5000))}")
+    print("Clicking Buy button to complete booking...")
+    # Scroll to button and move mouse naturally
+    buy_button.scroll_into_view_if_needed(timeout=bounded_timeout(5000))
+    human_delay(500, 1000)
+    random_mouse_movement(page)
+    
+    # Listen before clicking so the purchase response cannot be missed
+    watcher = CheckoutWatcher(page, config)
+    human_click(buy_button, page)
+    print("Waiting for the site to confirm the booking...")
+    return watcher
+
+
+def verify_booking(page, class_info, outcome, detail):
+    """Turn the checkout outcome into True (booked), False (rejected) or None (unknown)
+    
+    An unknown outcome is not guessed from the page text: inline scripts nearly
+    always contain words like "error", and a retry could buy the class twice.
+    """
+    # Take screenshot of final page
+    save_screenshot(page, f'booking_result_{class_info["name"]}_{class_info["time"].replace(":", "")}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+    
+    if outcome == 'success':
+        print(f"✓ Booking SUCCESS - {detail}")
+        return True
+    if outcome == 'failure':
+        print(f"❌ Booking FAILED - {detail}")
+        record_failure('checkout_rejected')
+        return False
+    
+    # Neither a response nor a confirmation element: leave it for the account to show
+    print(f"⚠️ Checkout outcome unknown ({detail}) - not retrying, the purchase may have gone through")
+    print(f"Final URL: {page.url}")
+    record_failure('unverified')
+    return None
+
+
+def _attempt_booking(page, config, class_info, target_date, password, attempt_num):
+    """Single attempt to book a class"""
+    target_class = take_prepared_card(page, class_info)
+    jumped = False
+    if not target_class and attempt_num == 1:
+        with phase('deep_link'):
+            jumped = jump_to_checkout(page, config, class_info, target_date, password)
+    if not target_class and not jumped:
+        with phase('navigate'):
+            open_studio_page(page, config, get_studio(config, class_info.get('studio')))
+        
+        with phase('date_select'):
+            if not select_date(page, target_date):
+                record_failure('date_not_found')
+                return False
+    
+    try:
+        if not jumped:
+            if not target_class:
+                with phase('class_search'):
+                    target_class = find_class_card(page, config, class_info, target_date)
+            if not target_class:
+                record_failure('class_not_found')
+                return False
+            
+            with phase('book'):
+                card_identity = read_card_identity(target_class)
+                if not click_book_button(page, target_class):
+                    record_failure('no_book_button')
                     return False
-                elif 'timeout' in error_msg:
-                    print(f"  ⏱️ Timeout waiting for solution")
-                    if attempt < max_retries:
-                        print(f"  Retrying...")
-                        time.sleep(2)
-                        continue
-                    else:
-                        return False
-                else:
-                    # Generic error - retry
-                    if attempt < max_retries:
-                        print(f"  Retrying in 5 seconds...")
-                        time.sleep(5)
-                        continue
-                    else:
-                        return False
             
-            # Inject solution into page
-            if inject_recaptcha_solution(page, solution_token):
-                print(f"  ✓ CAPTCHA solution applied successfully!")
-                
-                # Wait for page to process the solution
-                time.sleep(2)
-                
-                # Verify CAPTCHA is gone
-                if not detect_captcha(page):
-                    print(f"  ✓✓ CAPTCHA SOLVED AND VERIFIED!")
-                    print(f"{'='*60}\n")
-                    return True
-                else:
-                    print(f"  ⚠️ Solution applied but CAPTCHA still visible")
-                    if attempt < max_retries:
-                        print(f"  Retrying...")
-                        time.sleep(2)
-                        continue
-                    else:
+            # Check if we're on a sign-in page
+            if 'signin.mindbodyonline.com' in page.url or 'login' in page.url.lower():
+                with phase('login'):
+                    if not login_after_book(page, config, password):
+                        record_failure('login_after_book')
                         return False
-            else:
-                print(f"  ✗ Failed to inject solution")
-                if attempt < max_retries:
-                    time.sleep(2)
-                    continue
-                else:
+            remember_class_identity(config, class_info, target_date, card_identity, page.url)
+        
+        # Check for CAPTCHA and solve with 2captcha if detected
+        print("Checking for CAPTCHA...")
+        print(f"Current URL before CAPTCHA check: {page.url}")
+        
+        # Only check for CAPTCHA if we're not already on a booking/confirmation page
+        current_url = page.url.lower()
+        if 'book' in current_url or 'purchase' in current_url or 'checkout' in current_url or 'confirm' in current_url:
+            print("On booking/checkout page, skipping CAPTCHA check")
+        else:
+            with phase('captcha'):
+                if not handle_captcha(page, config, 'before_buy'):
+                    record_failure('captcha_unsolved')
                     return False
-                    
-        except Exception as e:
-            print(f"  ✗ Unexpected error in attempt {attempt}: {str(e)}")
-            print(f"  {traceback.format_exc()}")
-            if attempt < max_retries:
-                print(f"  Retrying in 3 seconds...")
-                time.sleep(3)
-                continue
-            else:
+        
+        print(f"Current URL after CAPTCHA check: {page.url}")
+        
+        # Click Buy, then move on as soon as the site confirms or rejects the purchase
+        with phase('checkout'):
+            watcher = click_buy_button(page, config)
+            if not watcher:
+                record_failure('no_buy_button')
                 return False
+            try:
+                outcome, detail = await_checkout_outcome(page, config, watcher)
+                if outcome == 'captcha':
+                    print("⚠ CAPTCHA shown after clicking Buy")
+                    with phase('captcha'):
+                        if not handle_captcha(page, config, 'after_buy'):
+                            record_failure('captcha_unsolved')
+                            return False
+                    # The solved widget's callback may resubmit the purchase; wait for that
+                    # first, and click Buy again only if the page still offers it
+                    settle_ms = config.get('checkout', {}).get('captcha_settle_ms', 5000)
+                    outcome, detail = await_checkout_outcome(page, config, watcher, settle_ms, watch_captcha=False)
+                    if outcome == 'unknown' and page.locator(selector_list('buy_button')).first.is_visible():
+                        print("Clicking Buy again now that the CAPTCHA is solved...")
+                        watcher.stop()
+                        watcher = click_buy_button(page, config)
+                        if not watcher:
+                            record_failure('no_buy_button')
+                            return False
+                        outcome, detail = await_checkout_outcome(page, config, watcher, watch_captcha=False)
+            finally:
+                if watcher:
+                    watcher.stop()
+        
+        with phase('verify'):
+            if outcome not in ('success', 'failure'):
+                booked = confirm_booking_by_probe(config, class_info, target_date)
+                if booked is not None:
+                    outcome = 'success' if booked else 'failure'
+                    detail = f"schedule data shows the class as {'booked' if booked else 'not booked'}"
+            verdict = verify_booking(page, class_info, outcome, detail)
+            if not verdict:
+                # None: the purchase may have gone through, so it must not be retried
+                return verdict
+        
+        print(f"✓ Successfully booked and VERIFIED: {class_info['name']} at {class_info['time']}")
+        return True
+        
+    except Exception as e:
+        print(f"Error during class booking: {str(e)}")
+        print(traceback.format_exc())
+        record_failure('exception')
+        save_screenshot(page, f'error_booking_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        return False
+
+
+# ============================================================
+# LOGIN PIPELINE
+# ============================================================
+
+# Step generators advanced one short step at a time while the foreground flow waits
+# in human_delay(); all of it stays on this thread, as the sync Playwright API requires.
+# A step may yield a pause in seconds before it wants to run again.
+BACKGROUND_TASKS = []   # [{'page': page, 'steps': generator, 'resume_at': monotonic time}]
+IN_BACKGROUND_STEP = False
+# Cards located ahead of time: page -> (class_info, card locator)
+PREPARED_CARDS = {}
+
+
+def run_steps(steps):
+    """Drive a step generator to completion in the foreground, honouring its pauses; returns its result"""
+    try:
+        while True:
+            pause = next(steps)
+            if pause:
+                budget_sleep(pause)
+    except StopIteration as stop:
+        return stop.value
+
+
+def run_background_tasks(deadline, page=None):
+    """Advance queued background generators, one short step at a time, until the deadline
     
-    print(f"\n❌ Failed to solve CAPTCHA after {max_retries} attempts")
-    print(f"{'='*60}\n")
-    return False
+    With page, stops as soon as that page's task is done.
+    """
+    global IN_BACKGROUND_STEP
+    while BACKGROUND_TASKS:
+        if page is not None and not any(task['page'] is page for task in BACKGROUND_TASKS):
+            return
+        now = time.monotonic()
+        if now >= deadline or budget_exhausted():
+            return
+        task = min(BACKGROUND_TASKS, key=lambda t: t['resume_at'])
+        if task['resume_at'] > now:
+            budget_sleep(min(task['resume_at'], deadline) - now)
+            continue
+        IN_BACKGROUND_STEP = True
+        try:
+            with phase('pipeline'):
+                pause = next(task['steps'])
+            task['resume_at'] = time.monotonic() + (pause or 0)
+        except StopIteration:
+            BACKGROUND_TASKS.remove(task)
+        except Exception as e:
+            print(f"Background schedule step failed (non-critical): {str(e)}")
+            BACKGROUND_TASKS.remove(task)
+        finally:
+            IN_BACKGROUND_STEP = False
 
 
-def detect_captcha(page):
-    """Detect if we're on a CAPTCHA or verification page"""
+def finish_background_task(page):
+    """Run a page's queued steps to completion before the foreground takes that page over
+    
+    Other pages' steps keep running in between. If the budget runs out first the
+    task is dropped, so it never resumes on a page the foreground is driving.
+    """
+    run_background_tasks(float('inf'), page)
+    BACKGROUND_TASKS[:] = [task for task in BACKGROUND_TASKS if task['page'] is not page]
+
+
+def prepare_schedule(page, config, studio, class_info, target_date):
+    """Load a studio schedule, pick the date and locate one class card, in short steps
+    
+    Meant to run as a background task, during login or while another studio books:
+    the public schedule needs no sign-in, and every yield hands control back to the
+    foreground flow.
+    """
+    print(f"Preparing {studio['name']} schedule on its own page in the background...")
+    page.goto(studio['url'], wait_until='commit', timeout=bounded_timeout(60000))
+    yield
+    
+    # Short waits, so a slow page load never holds up the login flow for long
+    load_deadline = time.monotonic() + 60
+    while True:
+        try:
+            page.wait_for_load_state('load', timeout=bounded_timeout(50))
+            break
+        except Exception:
+            if time.monotonic() > load_deadline or budget_exhausted():
+                raise
+        yield 0.2
+    
+    # No phase() around steps that yield: the foreground would run inside it
     try:
-        # Check for common CAPTCHA indicators in URL first (most reliable)
-        page_url = page.url.lower()
-        url_indicators = ['recaptcha', 'captcha', 'challenge', 'verify']
+        yield from dismiss_consent_steps(page, config)
+    except Exception as e:
+        print(f"Cookie popup handling: {str(e)}")
+    yield
+    
+    if not (yield from select_date_steps(page, target_date)):
+        return
+    yield
+    
+    card = yield from find_class_card_steps(page, config, class_info, target_date)
+    if card:
+        PREPARED_CARDS[page] = (class_info, card)
+        print(f"  ✓ {class_info['name']} at {class_info['time']} is ready to book on its {studio['name']} page")
+        yield
+        # The schedule responses are still on this page; read them while login goes on
+        yield from learn_schedule_endpoints(config)
+
+
+def start_schedule_pipeline(page, config, studio, class_info, target_date):
+    """Queue prepare_schedule() for one studio page to run during the next human delays"""
+    BACKGROUND_TASKS.append({'page': page,
+                             'steps': prepare_schedule(page, config, studio, class_info, target_date),
+                             'resume_at': time.monotonic()})
+
+
+def take_prepared_card(page, class_info):
+    """Hand over the card located during login for this class, if it is still on the page"""
+    entry = PREPARED_CARDS.pop(page, None)
+    if not entry:
+        return None
+    prepared_info, card = entry
+    if (prepared_info['name'], prepared_info['time']) != (class_info['name'], class_info['time']):
+        return None
+    try:
+        if card.count() == 0:
+            return None
+    except Exception:
+        return None
+    print("Using the class card located during login")
+    return card
+
+
+# ============================================================
+# STARTUP
+# ============================================================
+
+# Hosts the first minute of a run talks to: the explore homepage and the sign-in app
+DEFAULT_PRECONNECT_ORIGINS = ['https://www.mindbodyonline.com', 'https://signin.mindbodyonline.com']
+
+
+def get_preconnect_origins(config):
+    """Origins whose connections are warmed at startup (config, homepage and every studio)"""
+    origins = list(config.get('startup', {}).get('preconnect_origins', DEFAULT_PRECONNECT_ORIGINS))
+    urls = [config['homepage']] + [studio['url'] for studio in config.get('studios', {}).values()]
+    for url in urls:
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        if origin not in origins:
+            origins.append(origin)
+    return origins
+
+
+def warm_dns(origins):
+    """Resolve every origin's host so the browser's first lookups hit the system cache"""
+    timings = {}
+    for origin in origins:
+        host = urlparse(origin).hostname
+        start = time.monotonic()
+        try:
+            socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP)
+            timings[host] = time.monotonic() - start
+        except OSError as e:
+            print(f"  DNS warm-up for {host} failed (non-critical): {str(e)}")
+    return timings
+
+
+def get_preconnect_script(origins):
+    """Init script that adds <link rel="preconnect"> hints, so the browser opens the
+    TLS connections (e.g. to the sign-in app) while the first page is still loading"""
+    return """
+(origins => {
+    if (window.top !== window) return;
+    const add = () => {
+        for (const origin of origins) {
+            if (origin === location.origin) continue;
+            const link = document.createElement('link');
+            link.rel = 'preconnect';
+            link.href = origin;
+            link.crossOrigin = 'anonymous';
+            document.head.appendChild(link);
+        }
+    };
+    if (document.head) add(); else document.addEventListener('DOMContentLoaded', add);
+})(%s);
+""" % json.dumps(origins)
+
+
+def prepare_run(config, booking_info):
+    """Validate the config and plan the run: returns (target_date, plan, booking_order)
+    
+    Pure Python and file reads only, so it runs on a worker thread while the
+    browser launches; config errors are raised from here.
+    """
+    target_date = calculate_target_date(booking_info['target_day'])
+    plan = resolve_plan(config, plan_bookings(config, booking_info['classes']))
+    booking_order = order_by_demand(config, plan, target_date)
+    # Studios are opened in the order their first class is booked
+    plan = {key: plan[key] for key in dict.fromkeys(key for key, _ in booking_order)}
+    get_launch_profile(config)
+    load_selector_cache()
+    return target_date, plan, booking_order
+
+
+def record_run(results, duration):
+    """Record the outcome and duration of one booking run"""
+    METRICS.observe('mindbody_run_duration_seconds', duration)
+    METRICS.set('mindbody_last_run_timestamp_seconds', int(time.time()))
+    if results is None:
+        METRICS.inc('mindbody_runs', {'outcome': 'error'})
+        METRICS.set('mindbody_last_run_success', 0)
+        return
+    all_success = all(r['success'] for r in results)
+    METRICS.inc('mindbody_runs', {'outcome': 'success' if all_success else 'failed'})
+    METRICS.set('mindbody_last_run_success', 1 if all_success else 0)
+
+
+def run_booking(config, password, booking_info):
+    """Launch the browser, log in once and book every class, returning the results"""
+    global AVAILABILITY_PROBE
+    startup_start = time.monotonic()
+    target_day = booking_info['target_day']
+    classes = booking_info['classes']
+    budget = config.get('budget', {})
+    start_run_budget(config)
+    BACKGROUND_TASKS.clear()
+    PREPARED_CARDS.clear()
+    origins = get_preconnect_origins(config)
+    
+    # Start browser automation
+    with sync_playwright() as p, ThreadPoolExecutor(max_workers=2) as pool:
+        # Planning and DNS warm-up run on worker threads while Chromium starts;
+        # all Playwright calls stay on this thread
+        planning = pool.submit(prepare_run, config, booking_info)
+        dns = pool.submit(warm_dns, origins)
+        
+        # Launch with extra args to appear more human
+        profile = get_launch_profile(config)
+        print(f"Launching browser with profile '{profile['name']}'...")
+        launch_start = time.monotonic()
+        with phase('launch'):
+            browser, context = launch_browser_context(p, config, profile)
+        METRICS.observe('mindbody_browser_launch_duration_seconds', time.monotonic() - launch_start)
+        
+        if config.get('instrumentation', {}).get('enabled'):
+            # Every page created from the context, and everything they return, is accounted
+            context = instrument(context)
+        
+        # Inject stealth scripts into every page of the shared context
+        context.add_init_script(get_stealth_scripts())
+        context.add_init_script(get_preconnect_script(origins))
+        install_consent_state(context, config)
+        
+        # A persistent context opens with a blank page already
+        page = context.pages[0] if context.pages else context.new_page()
+        
+        # Config errors surface here, before anything is navigated
+        target_date, plan, booking_order = planning.result()
+        print(f"\nBooking {len(classes)} class(es) for {target_day}, {target_date.strftime('%B %d, %Y')}")
+        for studio_plan in plan.values():
+            print(f"  {studio_plan['studio']['name']}: {len(studio_plan['classes'])} class(es)")
+        warmed = dns.result()
+        if warmed:
+            print(f"  DNS warmed for {', '.join(warmed)}")
         
-        for indicator in url_indicators:
-            if indicator in page_url:
-                print(f"  CAPTCHA detected in URL: {indicator}")
-                return True
+        time_to_navigation = time.monotonic() - startup_start
+        METRICS.observe('mindbody_time_to_first_navigation_seconds', time_to_navigation)
+        print(f"Time to first navigation: {time_to_navigation:.2f}s")
         
-        # Check for visible CAPTCHA elements (iframes)
-        captcha_selectors = [
-            'iframe[src*="recaptcha"]',
-            'iframe[src*="captcha"]',
-            'iframe[title*="reCAPTCHA"]',
-            '[class*="recaptcha"]',
-            '[id*="recaptcha"]'
-        ]
+        # The first class's schedule is loaded, dated and searched on a second page
+        # while this one signs in, so its Book button is ready when login completes
+        pipelined = config.get('startup', {}).get('pipeline_schedule', True)
+        pipeline_studio = None
+        if pipelined and booking_order:
+            pipeline_studio, first_class = booking_order[0]
+            pipeline_page = context.new_page()
+            watch_schedule_responses(pipeline_page)
+            start_schedule_pipeline(pipeline_page, config, plan[pipeline_studio]['studio'], first_class, target_date)
         
-        for selector in captcha_selectors:
-            elem = page.query_selector(selector)
-            if elem:
-                try:
-                    if elem.is_visible():
-                        print(f"  CAPTCHA detected: visible element with selector {selector}")
-                        return True
-                except:
-                    pass
+        # Login once for all studios
+        login_start = time.monotonic()
+        with phase('login'), budget_scope(budget.get('login_seconds')):
+            login(page, config, password)
+        METRICS.observe('mindbody_login_duration_seconds', time.monotonic() - login_start)
+        if pipeline_studio:
+            finish_background_task(pipeline_page)
         
-        # Check page content for CAPTCHA indicators
-        page_content = page.content().lower()
-        content_indicators = [
-            'verify you are human',
-            'verify you\'re human',
-            'security check',
-            'please verify',
-            'select all images',
-            'image verification',
-            'i\'m not a robot',
-            'prove you are human'
-        ]
+        # One page per studio, all sharing the authenticated context. Every other studio's
+        # schedule is loaded, dated and searched for its first class on its own page as a
+        # background task, stepped alongside the bookings that run before it.
+        studio_pages = {}
+        spare_pages = [page]
+        first_classes = {}
+        for studio_key, class_info in booking_order:
+            first_classes.setdefault(studio_key, class_info)
+        for studio_key, studio_plan in plan.items():
+            if studio_key == pipeline_studio:
+                studio_pages[studio_key] = pipeline_page
+                continue
+            studio_pages[studio_key] = spare_pages.pop() if spare_pages else context.new_page()
+            watch_schedule_responses(studio_pages[studio_key])
+            if pipelined and studio_key in first_classes:
+                start_schedule_pipeline(studio_pages[studio_key], config, studio_plan['studio'],
+                                        first_classes[studio_key], target_date)
+                continue
+            try:
+                preload_studio_page(studio_pages[studio_key], studio_plan['studio'])
+            except Exception as e:
+                print(f"Preloading {studio_plan['studio']['name']} failed (non-critical): {str(e)}")
+        for spare_page in spare_pages:
+            spare_page.close()
         
-        for indicator in content_indicators:
-            if indicator in page_content:
-                print(f"  CAPTCHA detected in content: '{indicator}'")
-                return True
+        # One small signed-in request per check instead of a page load, once an
+        # earlier run has learned where the schedule data comes from
+        if config.get('probe', {}).get('enabled', True):
+            AVAILABILITY_PROBE = AvailabilityProbe(context, config)
         
-        # Check page title
-        try:
-            page_title = page.title().lower()
-            if 'captcha' in page_title or 'verify' in page_title:
-                print(f"  CAPTCHA detected in page title: {page_title}")
-                return True
-        except:
-            pass
+        # Book each class, most in-demand first. Checkout runs for one class at a time; the
+        # other studios' schedule steps run during its human delays on their own pages.
+        # Each class gets at most class_seconds and no more than its fair share of what is left,
+        # so a bad class cannot starve later ones.
+        results = []
+        classes_left = len(classes)
+        for studio_key, class_info in booking_order:
+            studio_plan = plan[studio_key]
+            studio_page = studio_pages[studio_key]
+            class_seconds = budget.get('class_seconds')
+            remaining = budget_remaining()
+            if remaining is not None:
+                if remaining < budget.get('min_class_seconds', 30):
+                    record_budget_cut(f"{class_info['name']} at {class_info['time']}",
+                                      f"not attempted, {remaining:.0f}s of run budget left")
+                    record_failure('budget_exhausted')
+                    results.append({
+                        'studio': studio_plan['studio'],
+                        'class': class_info,
+                        'success': False,
+                        'skipped': True
+                    })
+                    classes_left -= 1
+                    continue
+                share = remaining / classes_left
+                class_seconds = min(class_seconds, share) if class_seconds else share
+            classes_left -= 1
+            try:
+                with budget_scope(class_seconds):
+                    # This studio's page stops being a background page from here on
+                    finish_background_task(studio_page)
+                    with phase('preflight'):
+                        preflight_class(config, class_info, target_date)
+                    success = book_class(studio_page, config, class_info, target_date, password)
+                # Checkout is over for this class, so reading noted responses costs no race time
+                for _ in learn_schedule_endpoints(config):
+                    pass
+                results.append({
+                    'studio': studio_plan['studio'],
+                    'class': class_info,
+                    'success': success
+                })
                 
-        return False
-    except Exception as e:
-        print(f"  Error in CAPTCHA detection: {str(e)}")
-        return False
+                # Wait between bookings to avoid rate limiting
+                if len(classes) > 1:
+                    human_delay(3000, 5000)
+            except Exception as e:
+                print(f"Error booking {class_info['name']}: {str(e)}")
+                results.append({
+                    'studio': studio_plan['studio'],
+                    'class': class_info,
+                    'success': False
+                })
+        
+        # Summary
+        print("\n" + "="*60)
+        print("BOOKING SUMMARY")
+        print("="*60)
+        for studio_key, studio_plan in plan.items():
+            print(f"{studio_plan['studio']['name']}:")
+            for result in results:
+                if result['studio']['key'] != studio_key:
+                    continue
+                if result.get('skipped'):
+                    status = "⏭ SKIPPED (out of time budget)"
+                elif result['success'] is None:
+                    status = "? UNVERIFIED (check your account)"
+                else:
+                    status = "✓ SUCCESS" if result['success'] else "✗ FAILED"
+                print(f"  {status}: {result['class']['name']} at {result['class']['time']}")
+        print("="*60)
+        report_selector_demotions()
+        report_budget_cuts()
+        save_catalogue(config)
+        save_demand_history(config)
+        save_class_identities(config)
+        save_schedule_endpoints(config)
+        
+        AVAILABILITY_PROBE = None
+        BACKGROUND_TASKS.clear()
+        PREPARED_CARDS.clear()
+        SCHEDULE_RESPONSES.clear()
+        PENDING_ENDPOINTS.clear()
+        close_browser_context(browser, context, config)
+    
+    return results
 
 
-def get_target_classes(config):
-    """Determine which classes to book based on current day"""
-    today = datetime.now()
-    day_name = today.strftime('%A').lower()
+def run_once(config):
+    """Run today's bookings (if any) and write the metrics textfile; returns the results or None"""
+    booking_info = get_target_classes(config)
+    if not booking_info:
+        return []
     
-    if day_name == 'friday':
-        return config['booking_schedule']['friday']
-    elif day_name == 'saturday':
-        return config['booking_schedule']['saturday']
-    elif day_name == 'sunday':
-        # TEST MODE: Allow Sunday for testing Monday bookings
-        return config['booking_schedule'].get('sunday')
-    elif day_name == 'monday':
-        # TEMPORARY: Allow Monday for testing 2captcha integration
-        print("⚠️ RUNNING IN TEST MODE (Monday) - Using Sunday config for Tuesday booking")
-        return config['booking_schedule'].get('sunday')
-    else:
-        print(f"Not a booking day (today is {day_name}). Script should run on Friday, Saturday, or Sunday (test mode).")
-        return None
+    run_start = time.monotonic()
+    results = None
+    resources = config.get('resources', {})
+    sampler = ResourceSampler(resources.get('interval_ms', 500) / 1000.0) if resources.get('enabled') else nullcontext()
+    try:
+        with sampler:
+            password = get_password()
+            results = run_booking(config, password, booking_info)
+        return results
+    finally:
+        record_run(results, time.monotonic() - run_start)
+        write_metrics_textfile(config)
+        if config.get('instrumentation', {}).get('enabled'):
+            CALL_STATS.report(config['instrumentation'].get('top_n', 15))
+            LIVE_HANDLES.report()
+        if resources.get('enabled'):
+            sampler.summary()
+            sampler.write(resources.get('file', 'metrics/resources.jsonl'))
 
 
-def calculate_target_date(target_day):
-    """Calculate the target date for booking"""
-    today = datetime.now()
-    target_day_lower = target_day.lower()
-    current_weekday = today.weekday()  # Monday is 0, Sunday is 6
-    
-    # Map day names to weekday numbers
-    day_mapping = {
-        'monday': 0,
-        'tuesday': 1,
-        'wednesday': 2,
-        'thursday': 3,
-        'friday': 4,
-        'saturday': 5,
-        'sunday': 6
-    }
+def run_daemon(config):
+    """Keep serving metrics and run the booking once per booking day at the configured time"""
+    metrics_config = config.get('metrics', {})
+    serve_metrics(metrics_config.get('listen_port', 9464))
+    run_at = datetime.strptime(metrics_config.get('daemon_run_at', '05:00'), '%H:%M').time()
+    last_run_date = None
     
-    target_weekday = day_mapping.get(target_day_lower)
+    print(f"Daemon mode: bookings run daily at {run_at.strftime('%H:%M')} on booking days")
+    while True:
+        now = datetime.now()
+        if now.date() != last_run_date and now.time() >= run_at:
+            last_run_date = now.date()
+            try:
+                run_once(config)
+            except Exception as e:
+                print(f"Run failed: {str(e)}")
+                print(traceback.format_exc())
+        time.sleep(30)
+
+
+# ============================================================
+# HAR RECORD AND REPLAY
+# ============================================================
+
+def run_timed_step(steps, name, func, *args):
+    """Run one step of a record/replay pass and note its duration and outcome"""
+    print(f"\n--- {name} ---")
+    start = time.monotonic()
+    step = {'step': name, 'ok': True, 'error': None}
+    result = None
+    try:
+        result = func(*args)
+        if result is False:
+            step['ok'] = False
+    except Exception as e:
+        step['ok'] = False
+        step['error'] = str(e)
+        print(f"  ✗ {name} failed: {str(e)}")
+    step['seconds'] = round(time.monotonic() - start, 3)
+    steps.append(step)
+    return result
+
+
+def print_step_report(title, steps):
+    """Print the duration and outcome of every step of a record/replay pass"""
+    print("\n" + "="*60)
+    print(title)
+    print("="*60)
+    for step in steps:
+        status = "✓" if step['ok'] else "✗"
+        print(f"{status} {step['step']:<40}{step['seconds']:>9.2f}s")
+    print(f"  {'total':<40}{sum(s['seconds'] for s in steps):>9.2f}s")
+    print("="*60)
+
+
+def open_sign_in_form(page, config):
+    """Read-only part of the sign-in flow: open the form and submit the email only"""
+    find_element(page, 'sign_in_button').click()
+    email_input = find_element(page, 'email_input', timeout=15000)
+    email_input.fill(config['email'])
+    find_element(page, 'continue_button').click()
+    find_element(page, 'password_input', timeout=15000)
+
+
+def record_har(config, har_path):
+    """Save the traffic of a read-only pass (homepage, sign-in, studio schedules) to a HAR"""
+    booking_info = get_target_classes(config) or next(iter(config['booking_schedule'].values()))
+    target_date = calculate_target_date(booking_info['target_day'])
+    plan = resolve_plan(config, plan_bookings(config, booking_info['classes']))
+    steps = []
     
-    if target_weekday is None:
-        # Default to tomorrow
-        days_to_add = 1
-    else:
-        # Calculate days until target day
-        days_to_add = (target_weekday - current_weekday) % 7
+    print(f"Recording read-only pass for {target_date.strftime('%A, %B %d, %Y')} to {har_path}")
+    with sync_playwright() as p:
+        profile = get_launch_profile(config)
+        browser = p.chromium.launch(**get_launch_options(profile))
+        context = browser.new_context(record_har_path=har_path, record_har_content='embed',
+                                      **get_context_options(profile))
+        context.add_init_script(get_stealth_scripts())
+        install_consent_state(context, config)
+        page = context.new_page()
         
-        # If it's 0, we want next week (not today)
-        if days_to_add == 0:
-            days_to_add = 7
+        run_timed_step(steps, 'homepage', lambda: page.goto(config['homepage'], wait_until='load', timeout=60000))
+        run_timed_step(steps, 'sign_in_form', open_sign_in_form, page, config)
+        for studio_plan in plan.values():
+            studio = studio_plan['studio']
+            run_timed_step(steps, f"open_studio_page:{studio['key']}", open_studio_page, page, config, studio)
+            run_timed_step(steps, f"select_date:{studio['key']}", select_date, page, target_date)
+            for class_info in studio_plan['classes']:
+                run_timed_step(steps, f"find_class_card:{class_info['name']} {class_info['time']}",
+                               lambda: find_class_card(page, config, class_info, target_date) is not None)
+        
+        # Closing the context flushes the HAR to disk
+        context.close()
+        browser.close()
+    save_catalogue(config)
+    save_demand_history(config)
     
-    target_date = today + timedelta(days=days_to_add)
-    return target_date
+    with open(f'{har_path}.meta.json', 'w') as f:
+        json.dump({
+            'recorded_at': datetime.now().isoformat(),
+            'target_date': target_date.isoformat(),
+            'booking_info': booking_info
+        }, f, indent=2, ensure_ascii=False)
+    
+    print_step_report("HAR RECORDING", steps)
+    return all(step['ok'] for step in steps)
 
 
-def login(page, config, password):
-    """Handle login flow"""
-    print("Navigating to MindBody homepage...")
-    page.goto(config['homepage'], wait_until='load', timeout=60000)
-    human_delay(2000, 4000)
-    
-    # Random browsing behavior
-    random_mouse_movement(page)
-    if random.random() < 0.5:
-        random_idle_behavior(page)
+def replay_har(config, har_path):
+    """Replay login, the schedule steps and CAPTCHA detection from a HAR with no network"""
+    global HUMAN_DELAY_SCALE
+    with open(f'{har_path}.meta.json', 'r') as f:
+        meta = json.load(f)
+    target_date = datetime.fromisoformat(meta['target_date'])
+    plan = plan_bookings(config, meta['booking_info']['classes'])
+    steps = []
     
-    # Handle cookie consent popup - remove ALL overlays
-    print("Removing any cookie consent overlays...")
-    try:
-        page.evaluate('''() => {
-            // Remove all trust-e / cookie consent overlays
-            const overlays = document.querySelectorAll('.truste_overlay, .truste_cm_outerdiv, [id*="pop-"], [class*="truste"]');
-            overlays.forEach(el => el.remove());
-            console.log('Removed', overlays.length, 'overlay elements');
-        }''')
-        human_delay(800, 1500)
-        print("Removed cookie consent overlays")
-    except Exception as e:
-        print(f"Cookie popup handling: {str(e)}")
+    # Human pacing only adds noise to offline timings
+    HUMAN_DELAY_SCALE = 0.0
+    random.seed(0)
     
-    print("Looking for Sign In button...")
-    # Try to find and click the Sign In button
-    sign_in_selectors = [
-        'button:has-text("Sign in")',
-        'a:has-text("Sign in")',
-        'button:has-text("Log in")',
-        'a:has-text("Log in")',
-        '[data-testid*="sign-in"]',
-        '[data-testid*="login"]'
-    ]
+    print(f"Replaying {har_path} (recorded {meta['recorded_at']})")
+    with sync_playwright() as p:
+        profile = get_launch_profile(config)
+        browser = p.chromium.launch(**get_launch_options(profile))
+        context = browser.new_context(**get_context_options(profile))
+        # Anything missing from the recording is aborted, so nothing reaches the network
+        context.route_from_har(har_path, not_found='abort')
+        context.add_init_script(get_stealth_scripts())
+        install_consent_state(context, config)
+        page = context.new_page()
+        
+        run_timed_step(steps, 'login', login, page, config, os.environ.get('MINDBODY_PASSWORD', 'replay'))
+        for studio_plan in plan.values():
+            studio = studio_plan['studio']
+            run_timed_step(steps, f"open_studio_page:{studio['key']}", open_studio_page, page, config, studio)
+            run_timed_step(steps, f"select_date:{studio['key']}", select_date, page, target_date)
+            for class_info in studio_plan['classes']:
+                run_timed_step(steps, f"find_class_card:{class_info['name']} {class_info['time']}",
+                               lambda: find_class_card(page, config, class_info, target_date) is not None)
+        run_timed_step(steps, 'detect_captcha', lambda: not detect_captcha(page))
+        
+        browser.close()
     
-    sign_in_button = None
-    for selector in sign_in_selectors:
-        try:
-            sign_in_button = page.wait_for_selector(selector, timeout=5000)
-            if sign_in_button:
-                print(f"Found Sign In button: {selector}")
-                break
-        except:
-            continue
+    print_step_report("HAR REPLAY", steps)
+    with open(f'{har_path}.replays.jsonl', 'a') as f:
+        f.write(json.dumps({'replayed_at': datetime.now().isoformat(), 'steps': steps}) + '\n')
+    return all(step['ok'] for step in steps)
+
+
+# ============================================================
+# FAULT INJECTION
+# ============================================================
+
+# Pages served in place of a real response by 'captcha' and 'error_page' faults
+FAULT_CAPTCHA_HTML = (
+    '<html><head><title>Security check</title></head><body>'
+    '<h1>Please verify you are human</h1>'
+    '<div class="g-recaptcha" id="recaptcha-fault" data-sitekey="fault-site-key"></div>'
+    '<iframe title="reCAPTCHA" src="about:blank" width="304" height="78"></iframe>'
+    '</body></html>'
+)
+FAULT_ERROR_HTML = (
+    '<html><head><title>Error</title></head><body>'
+    '<h1>Something went wrong</h1><p>We are having trouble loading this page. Please try again.</p>'
+    '</body></html>'
+)
+
+
+class FaultInjector:
+    """Network-layer faults for a browser context, applied on top of a HAR replay
     
-    if sign_in_button:
-        print("Clicking Sign In button...")
-        random_mouse_movement(page)  # Move mouse naturally first
-        human_click(sign_in_button, page)
-        print("Waiting for login page to load...")
-        page.wait_for_load_state('load', timeout=30000)
-        human_delay(2000, 3000)
-    else:
-        print("Sign In button not found, may already be logged in or on login page")
+    Each scenario dict may set:
+      fault           latency | status | drop | captcha | error_page
+      phase           booking phase(s) it applies in (see phase()); default any
+      url             regex searched in the request URL; default any
+      resource_types  e.g. ["document", "xhr"]; default any
+      count           how many matching requests to hit (default 1, 0 = all)
+      latency_ms      delay before the response (latency)
+      status          HTTP status to return (status, default 503)
+      error           abort reason (drop, default "failed")
     
-    # Check if we need to login
-    print(f"Current URL: {page.url}")
+    Requests that no scenario hits fall through to the HAR router.
+    """
     
-    # If we're already on the signin page, skip the button clicking
-    if 'signin.mindbodyonline.com' in page.url or 'login' in page.url.lower():
-        print("Already on login page, proceeding with login...")
-    else:
-        print("Not on login page yet, need to navigate there...")
+    def __init__(self, scenario):
+        self.scenario = scenario
+        phases = scenario.get('phase')
+        self.phases = [phases] if isinstance(phases, str) else phases
+        self.url = re.compile(scenario['url']) if scenario.get('url') else None
+        self.events = []
     
-    print(f"Entering email: {config['email']}")
+    def install(self, context):
+        """Route every request of the context through the injector (after route_from_har)"""
+        context.route('**/*', self.handle)
+        return self
     
-    # Random mouse movement (like browsing)
-    random_mouse_movement(page)
-    human_delay(500, 1000)
+    def matches(self, request):
+        """True if this request should be hit by the scenario's fault"""
+        count = self.scenario.get('count', 1)
+        if count and len(self.events) >= count:
+            return False
+        if self.phases and CURRENT_PHASE not in self.phases:
+            return False
+        if self.url and not self.url.search(request.url):
+            return False
+        resource_types = self.scenario.get('resource_types')
+        return not resource_types or request.resource_type in resource_types
     
-    # Take screenshot for debugging
-    page.screenshot(path='debug_login_page.png')
-    print("Screenshot saved as debug_login_page.png")
+    def handle(self, route):
+        """Inject the fault into a matching request, or pass it on to the HAR"""
+        request = route.request
+        if not self.matches(request):
+            route.fallback()
+            return
+        
+        fault = self.scenario['fault']
+        self.events.append({'at': time.monotonic(), 'phase': CURRENT_PHASE, 'url': request.url})
+        print(f"  💥 Injecting {fault} into {request.resource_type} {request.url[:80]}")
+        if fault == 'latency':
+            # Route handlers run on the script's thread, so the whole run waits like the browser does
+            time.sleep(self.scenario.get('latency_ms', 5000) / 1000.0)
+            route.fallback()
+        elif fault == 'status':
+            status = self.scenario.get('status', 503)
+            route.fulfill(status=status, content_type='text/html',
+                          body=f'<html><body><h1>{status} Service Unavailable</h1></body></html>')
+        elif fault == 'drop':
+            route.abort(self.scenario.get('error', 'failed'))
+        elif fault == 'captcha':
+            route.fulfill(status=200, content_type='text/html', body=FAULT_CAPTCHA_HTML)
+        elif fault == 'error_page':
+            route.fulfill(status=200, content_type='text/html', body=FAULT_ERROR_HTML)
+        else:
+            raise ValueError(f"Unknown fault '{fault}' in scenario {self.scenario.get('name')}")
+
+
+def rehearse_attempt(page, config, class_info, target_date, password, attempt_num):
+    """Read-only stand-in for _attempt_booking: the steps up to the Book click, then a CAPTCHA check
     
-    # Try to find email input
-    try:
-        email_input = page.wait_for_selector('input[type="email"], input[name="email"], input#email, input[id="EmailAddress"], input[placeholder*="email"]', timeout=5000)
-    except:
-        print("Standard email input not found. Trying alternative selectors...")
-        # Try finding any input field
-        all_inputs = page.query_selector_all('input')
-        print(f"Found {len(all_inputs)} input fields")
-        email_input = page.wait_for_selector('input', timeout=10000)
+    A CAPTCHA counts as a failed attempt; rehearsals never pay for a 2captcha solve.
+    """
+    with phase('navigate'):
+        open_studio_page(page, config, get_studio(config, class_info.get('studio')))
+    with phase('date_select'):
+        if not select_date(page, target_date):
+            return False
+    with phase('class_search'):
+        if not find_class_card(page, config, class_info, target_date):
+            return False
+    with phase('captcha'):
+        return not detect_captcha(page)
+
+
+def rehearse_scenario(config, har_path, meta, scenario):
+    """Run login and every class's retry loop against the HAR with one fault scenario
     
-    # Click on email input first
-    human_click(email_input, page)
-    human_delay(200, 500)
+    Returns the steps (each with its monotonic start/end) and the injected fault events.
+    """
+    target_date = datetime.fromisoformat(meta['target_date'])
+    plan = plan_bookings(config, meta['booking_info']['classes'])
+    budget = config.get('budget', {})
+    password = os.environ.get('MINDBODY_PASSWORD', 'replay')
+    injector = FaultInjector(scenario)
+    steps = []
     
-    # Type email in human-like way
-    human_type(email_input, config['email'], page)
-    human_delay(300, 700)
+    def timed(name, func, *args):
+        started = time.monotonic()
+        run_timed_step(steps, name, func, *args)
+        steps[-1]['window'] = (started, time.monotonic())
     
-    print("Clicking continue button...")
-    continue_button = page.wait_for_selector('button:has-text("Continue"), button[type="submit"], input[type="submit"]', timeout=10000)
-    human_click(continue_button, page)
-    human_delay(1500, 2500)
+    def login_step():
+        with phase('login'), budget_scope(budget.get('login_seconds')):
+            login(page, config, password)
     
-    print("Entering password...")
-    password_input = page.wait_for_selector('input[type="password"], input[name="password"], input[id="Password"]', timeout=10000)
+    def class_step(studio_key, class_info):
+        class_info = dict(class_info, studio=studio_key)
+        with budget_scope(budget.get('class_seconds')):
+            return book_class(page, config, class_info, target_date, password, attempt_fn=rehearse_attempt)
     
-    # Click on password input first
-    human_click(password_input, page)
-    human_delay(200, 500)
+    random.seed(0)
+    with sync_playwright() as p:
+        profile = get_launch_profile(config)
+        browser = p.chromium.launch(**get_launch_options(profile))
+        context = browser.new_context(**get_context_options(profile))
+        context.route_from_har(har_path, not_found='abort')
+        if scenario.get('fault'):
+            # Registered last, so it sees every request before the HAR router
+            injector.install(context)
+        context.add_init_script(get_stealth_scripts())
+        install_consent_state(context, config)
+        page = context.new_page()
+        
+        timed('login', login_step)
+        for studio_key, studio_plan in plan.items():
+            for class_info in studio_plan['classes']:
+                timed(f"class:{class_info['name']} {class_info['time']}", class_step, studio_key, class_info)
+        
+        browser.close()
+    return steps, injector.events
+
+
+def summarize_scenario(name, steps, events, baseline_seconds=None):
+    """Time to recover from (or give up on) the first injected fault, and the cost of the scenario"""
+    total = sum(step['seconds'] for step in steps)
+    summary = {
+        'scenario': name,
+        'faults': len(events),
+        'ok': all(step['ok'] for step in steps),
+        'seconds': round(total, 3),
+        'extra_seconds': round(total - baseline_seconds, 3) if baseline_seconds is not None else None,
+        'first_fault_phase': None,
+        'outcome': 'no fault',
+        'seconds_to_outcome': None
+    }
+    if events:
+        first = events[0]['at']
+        summary['first_fault_phase'] = events[0]['phase']
+        # The step that was running when the first fault fired either got past it or gave up
+        hit = next((step for step in steps if step['window'][0] <= first <= step['window'][1]), steps[-1])
+        summary['outcome'] = 'recovered' if hit['ok'] else 'gave up'
+        summary['seconds_to_outcome'] = round(hit['window'][1] - first, 3)
+    return summary
+
+
+def print_fault_report(har_path, summaries):
+    """Print one line per scenario: what it cost and how long recovery or giving up took"""
+    print("\n" + "="*78)
+    print(f"FAULT INJECTION ({har_path})")
+    print("="*78)
+    print(f"{'scenario':<24}{'faults':>7}  {'first fault in':<15}{'outcome':<11}{'to outcome':>11}{'run':>9}{'extra':>9}")
+    for s in summaries:
+        to_outcome = f"{s['seconds_to_outcome']:.1f}s" if s['seconds_to_outcome'] is not None else '-'
+        extra = f"{s['extra_seconds']:+.1f}s" if s['extra_seconds'] is not None else '-'
+        print(f"{s['scenario']:<24}{s['faults']:>7}  {s['first_fault_phase'] or '-':<15}{s['outcome']:<11}"
+              f"{to_outcome:>11}{s['seconds']:>8.1f}s{extra:>9}")
+    print("="*78)
+
+
+def bench_faults(config, har_path, names=None):
+    """Replay the HAR once without faults and once per fault scenario; report recovery latency
     
-    # Type password in human-like way
-    human_type(password_input, password, page)
-    human_delay(300, 700)
+    Returns False if a scenario gave up or a run failed.
+    """
+    global HUMAN_DELAY_SCALE
+    with open(f'{har_path}.meta.json', 'r') as f:
+        meta = json.load(f)
+    faults = config.get('faults', {})
+    scenarios = faults.get('scenarios', [])
+    if names:
+        unknown = set(names) - {scenario['name'] for scenario in scenarios}
+        if unknown:
+            raise ValueError(f"Unknown fault scenario(s): {', '.join(sorted(unknown))}")
+        scenarios = [scenario for scenario in scenarios if scenario['name'] in names]
     
-    print("Submitting login form...")
-    submit_button = page.wait_for_selector('button[type="submit"], button:has-text("Sign in"), button:has-text("Log in"), input[type="submit"]', timeout=10000)
-    human_click(submit_button, page)
+    # Retry back-off is part of what a fault costs, so human pacing stays on unless scaled down
+    HUMAN_DELAY_SCALE = faults.get('delay_scale', 1.0)
+    summaries = []
+    baseline_seconds = None
+    for scenario in [{'name': 'baseline'}] + scenarios:
+        print(f"\n{'='*60}\nFault scenario: {scenario['name']}\n{'='*60}")
+        with budget_scope(faults.get('scenario_seconds', 600)):
+            steps, events = rehearse_scenario(config, har_path, meta, scenario)
+        summary = summarize_scenario(scenario['name'], steps, events, baseline_seconds)
+        if baseline_seconds is None:
+            baseline_seconds = summary['seconds']
+        summaries.append(summary)
+        with open(f'{har_path}.faults.jsonl', 'a') as f:
+            for step in steps:
+                step.pop('window')
+            f.write(json.dumps(dict(summary, ran_at=datetime.now().isoformat(), fault=scenario,
+                                    steps=steps)) + '\n')
     
-    print("Waiting for authentication to complete...")
-    page.wait_for_load_state('load', timeout=30000)
-    human_delay(2000, 4000)
-    print("Login successful!")
+    print_fault_report(har_path, summaries)
+    return all(s['outcome'] != 'gave up' for s in summaries) and summaries[0]['ok']
 
 
-def book_class(page, config, class_info, target_date, password, max_retries=5):
-    """Book a specific class with retry logic"""
-    print(f"\n{'='*60}")
-    print(f"Attempting to book: {class_info['name']} at {class_info['time']}")
-    print(f"Target date: {target_date.strftime('%A, %B %d, %Y')}")
-    print(f"{'='*60}\n")
+# ============================================================
+# BOOKING WINDOW DISCOVERY
+# ============================================================
+
+# Resource types not needed to read the schedule; blocking them keeps discovery traffic small
+DISCOVERY_BLOCKED_RESOURCES = {'image', 'media', 'font'}
+
+CRON_WEEKDAYS = ['1', '2', '3', '4', '5', '6', '0']  # Monday first, as datetime.weekday()
+
+
+def discovery_targets(config):
+    """Every distinct configured class as {'key', 'studio', 'class', 'weekday'}"""
+    targets = {}
+    for booking_info in config['booking_schedule'].values():
+        if not booking_info:
+            continue
+        for class_info in booking_info['classes']:
+            studio = get_studio(config, class_info.get('studio'))
+            weekday = booking_info['target_day']
+            key = f"{studio['key']}|{normalize_text(class_info['name'])}|{weekday.lower()}|{class_info['time']}"
+            targets.setdefault(key, {'key': key, 'studio': studio, 'class': class_info, 'weekday': weekday})
+    return list(targets.values())
+
+
+def session_start(date, class_info, tz):
+    """Timezone-aware start of a class on a given date"""
+    hour, minute = find_times(class_info['time'])[0]
+    return datetime(date.year, date.month, date.day, hour, minute, tzinfo=tz)
+
+
+# Button labels and card text of a class that opened and filled up (as opposed to one not open yet)
+FULL_CARD_PATTERN = re.compile(r'\b(waitlist|wait list|full|sold out|class is full)\b', re.IGNORECASE)
+
+
+def card_release_state(card):
+    """'absent', 'bookable', 'full' (opened and filled) or 'not_open' (shown but not bookable yet)"""
+    if card is None:
+        return 'absent'
+    if card['bookable']:
+        return 'bookable'
+    spots = SPOTS_PATTERN.search(card['text'])
+    if FULL_CARD_PATTERN.search(card.get('button') or '') or FULL_CARD_PATTERN.search(card['text']) or \
+            (spots and int(spots.group(1)) == 0):
+        return 'full'
+    return 'not_open'
+
+
+def infer_release_rule(observations):
+    """Bound how many hours before the start a class opens for booking
+    
+    A class seen open (bookable or full) L hours ahead opens at least L hours
+    ahead; one missing or not yet bookable U hours ahead opens less than U
+    hours ahead. Returns (lower, upper) in hours, either of which may be None.
+    """
+    open_leads = [o['lead_hours'] for o in observations if o['state'] in ('bookable', 'full')]
+    closed_leads = [o['lead_hours'] for o in observations if o['state'] in ('absent', 'not_open')]
+    lower = max(open_leads) if open_leads else None
+    # Ignore "closed" readings that contradict an earlier opening (cancelled sessions)
+    closed_leads = [lead for lead in closed_leads if lower is None or lead > lower]
+    upper = min(closed_leads) if closed_leads else None
+    return lower, upper
+
+
+def describe_release(config, target, lower, upper, tz):
+    """Turn lead-time bounds into the release window of the next session and a cron line"""
+    today = datetime.now(tz).date()
+    next_date = next(today + timedelta(days=offset) for offset in range(1, 8)
+                     if (today + timedelta(days=offset)).strftime('%A').lower() == target['weekday'].lower())
+    start = session_start(next_date, target['class'], tz)
+    rule = {
+        'studio': target['studio']['key'],
+        'name': target['class']['name'],
+        'time': target['class']['time'],
+        'weekday': target['weekday'],
+        'timezone': str(tz),
+        'lead_hours': {'min': lower, 'max': upper,
+                       'estimate': (lower + upper) / 2 if lower is not None and upper is not None else None},
+    }
+    if upper is None:
+        return rule
     
-    for attempt in range(1, max_retries + 1):
-        print(f"Booking attempt {attempt}/{max_retries}...")
-        try:
-            success = _attempt_booking(page, config, class_info, target_date, password, attempt)
-            if success:
-                return True
-            else:
-                if attempt < max_retries:
-                    print(f"Attempt {attempt} failed, retrying...")
-                    human_delay(2000, 4000)
-        except Exception as e:
-            print(f"Attempt {attempt} error: {str(e)}")
-            if attempt < max_retries:
-                print(f"Retrying after error...")
-                human_delay(2000, 4000)
+    earliest = start - timedelta(hours=upper)
+    latest = start - timedelta(hours=lower) if lower is not None else start
+    rule['release_window'] = {'earliest': earliest.strftime('%A %H:%M'), 'latest': latest.strftime('%A %H:%M')}
     
-    print(f"Failed to book after {max_retries} attempts")
-    return False
+    # Start the run a couple of minutes before the earliest possible release
+    run_at = (earliest - timedelta(minutes=config.get('discovery', {}).get('lead_in_minutes', 2))).astimezone(timezone.utc)
+    rule['cron_utc'] = f"{run_at.minute} {run_at.hour} * * {CRON_WEEKDAYS[run_at.weekday()]}"
+    return rule
 
 
-def _attempt_booking(page, config, class_info, target_date, password, attempt_num):
-    """Single attempt to book a class"""
-    # Navigate to studio page
-    print("Navigating to Studio Locomotion page...")
-    page.goto(config['studio_url'], wait_until='load', timeout=60000)
-    human_delay(2000, 4000)  # Human-like delay
+def save_booking_windows(observations_file, observations):
+    """Write the accumulated discovery readings (atomically, so an interrupted run keeps the last copy)"""
+    tmp_path = f'{observations_file}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(observations, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, observations_file)
+
+
+def discover_booking_windows(config, cycles=None, interval_minutes=None, days_ahead=None, max_requests=None):
+    """Read the bookable state of every configured class for a few cycles and infer release rules
     
-    # Random mouse movement (simulate browsing)
-    random_mouse_movement(page)
+    Only the public schedule is read (no login). Images, media and fonts are
+    blocked, and no reading starts once it could exceed the request budget.
+    Observations accumulate in discovery.file across invocations and are saved
+    after every cycle; a reading that fails is skipped. The inferred rules and
+    suggested cron lines are written to discovery.plan_file.
+    """
+    settings = config.get('discovery', {})
+    cycles = cycles or settings.get('cycles', 4)
+    interval_minutes = interval_minutes if interval_minutes is not None else settings.get('interval_minutes', 30)
+    days_ahead = days_ahead or settings.get('days_ahead', 7)
+    max_requests = max_requests or settings.get('max_requests', 600)
+    observations_file = settings.get('file', 'booking_windows.json')
+    plan_file = settings.get('plan_file', 'booking_plan.json')
     
-    # Handle cookie consent popup on studio page  
-    print("Checking for cookie consent on studio page...")
     try:
-        # Wait for popup to appear
-        human_delay(2000, 3000)
-        
-        # Try Playwright frames approach
-        print("Looking for consent button in frames...")
-        frames = page.frames
-        print(f"Found {len(frames)} frames")
-        
-        button_clicked = False
-        for frame in frames:
-            try:
-                # Try to find the button in this frame
-                button = frame.locator('button:has-text("AGREE AND PROCEED"), button:has-text("PROCEED")').first
-                if button.is_visible(timeout=1000):
-                    print(f"Found button in frame: {frame.url}")
-                    button.click(timeout=5000)
-                    button_clicked = True
-                    print("Clicked AGREE AND PROCEED button")
-                    human_delay(1500, 2500)
-                    break
-            except:
-                continue
-        
-        if not button_clicked:
-            print("Button not found in frames, trying main page...")
-            try:
-                button = page.locator('button:has-text("AGREE AND PROCEED")').first
-                button.click(force=True, timeout=5000)
-                print("Clicked button on main page")
-                human_delay(1500, 2500)
-            except:
-                print("Could not find/click consent button, continuing anyway...")
-        
-    except Exception as e:
-        print(f"Cookie popup handling: {str(e)}")
-    
-    # Simulate reading the page
-    if random.random() < 0.4:
-        random_idle_behavior(page)
-    human_delay(500, 1000)
+        with open(observations_file, 'r') as f:
+            observations = json.load(f)
+    except (OSError, ValueError):
+        observations = {}
     
-    # Format date for searching
-    target_day = target_date.strftime('%d').lstrip('0')  # Day without leading zero
-    target_day_padded = target_date.strftime('%d')  # Day with leading zero
-    target_month = target_date.strftime('%B')  # Full month name
-    target_weekday = target_date.strftime('%a').upper()  # MON, TUE, etc.
+    targets = discovery_targets(config)
+    by_studio = {}
+    for target in targets:
+        by_studio.setdefault(target['studio']['key'], []).append(target)
     
-    print(f"Looking for date: {target_weekday} {target_day} ({target_month})")
+    requests = {'count': 0, 'largest_step': 0}
     
-    # Find and click the target date
-    # The calendar shows dates like "MON\n24" in the UI
-    print("Searching for date button in calendar...")
-    try:
-        # Try to find the date - look for the day number in the calendar area
-        # The structure is typically: day name (MON, TUE) and number (24) in separate elements
-        date_found = False
-        
-        # Try clicking on text containing just the day number
-        all_elements = page.locator(f'text={target_day}').all()
-        print(f"Found {len(all_elements)} elements with text '{target_day}'")
-        
-        for elem in all_elements:
-            try:
-                # Check if this is in the calendar area (not somewhere else on the page)
-                elem_text = elem.inner_text()
-                if elem_text.strip() == target_day or elem_text.strip() == target_day_padded:
-                    print(f"Trying to click date element with text: '{elem_text}'")
-                    # Move mouse to date naturally
-                    human_click(elem, page)
-                    date_found = True
-                    print(f"Successfully clicked on date {target_day}")
-                    human_delay(3000, 4000)
-                    break
-            except:
-                continue
-        
-        if not date_found:
-            print(f"Could not find clickable date for {target_day}")
-            print("Taking screenshot for debugging...")
-            page.screenshot(path=f'error_date_not_found_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            return False
-            
-    except Exception as e:
-        print(f"Error finding date: {str(e)}")
-        page.screenshot(path=f'error_date_search_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-        return False
+    def count_request(route):
+        if route.request.resource_type in DISCOVERY_BLOCKED_RESOURCES:
+            route.abort()
+        else:
+            requests['count'] += 1
+            route.continue_()
     
-    # Find the specific class
-    print(f"Searching for class: {class_info['name']} at {class_info['time']}")
+    def affordable():
+        # The next step may cost as much as the most expensive one so far
+        return requests['count'] + max(requests['largest_step'], 1) <= max_requests
     
-    # Look for class card containing the time and name
-    time_str = class_info['time'].lower().replace('am', '').replace('pm', '').strip()
+    def step(func, *args):
+        before = requests['count']
+        try:
+            return func(*args)
+        finally:
+            requests['largest_step'] = max(requests['largest_step'], requests['count'] - before)
     
-    # Try to find class elements
-    try:
-        # Wait for classes to load
-        page.wait_for_selector('[class*="class"], [data-testid*="class"], .schedule-item', timeout=10000)
-        human_delay(2000, 3000)
-        
-        # Simulate reading the page
-        random_idle_behavior(page)
-        human_delay(500, 1000)
+    print(f"Discovering booking windows for {len(targets)} class(es): {cycles} cycle(s) every "
+          f"{interval_minutes} min, {days_ahead} days ahead, at most {max_requests} requests")
+    with sync_playwright() as p:
+        profile = get_launch_profile(config)
+        browser = p.chromium.launch(**get_launch_options(profile))
+        context = browser.new_context(**get_context_options(profile))
+        context.route('**/*', count_request)
+        context.add_init_script(get_stealth_scripts())
+        install_consent_state(context, config)
+        page = context.new_page()
         
-        # Scroll down slowly to load all classes (more human-like)
-        print("Scrolling to load all classes...")
-        for i in range(5):
-            random_scroll(page, direction='down', amount=random.randint(600, 900))
-            human_delay(400, 800)
-            # Occasional mouse movement while scrolling (very human)
-            if random.random() < 0.3:
-                random_mouse_movement(page)
-        
-        human_delay(1000, 2000)
-        
-        # BUTTON-FIRST APPROACH: Find all "Book" buttons, then verify which class they belong to
-        print("Searching for class by examining all booking buttons...")
-        
-        target_class = None
-        class_name_lower = class_info['name'].lower()
-        class_type_lower = class_info['type'].lower()
-        
-        # Time variants for matching
-        time_variants = [
-            class_info['time'].lower(),  # "10:00am"
-            class_info['time'].replace('am', ' am').replace('pm', ' pm').lower(),  # "10:00 am"
-            class_info['time'].replace(':00', '').lower(),  # "10am"
-        ]
-        
-        # Find all "Book" buttons on the page
+        out_of_budget = False
         try:
-            book_buttons = page.locator('button:has-text("Book"), button:has-text("BOOK")').all()
-            print(f"  Found {len(book_buttons)} booking buttons on page")
-            
-            for button in book_buttons:
-                try:
-                    # Go up the parent tree to find the class card container
-                    parent = button
-                    for level in range(8):  # Try up to 8 levels
-                        parent_elem = parent.locator('xpath=..').first
-                        parent_text = parent_elem.inner_text().lower()
-                        
-                        # Check if this parent contains our class name AND time
-                        has_class_name = (class_name_lower in parent_text or class_type_lower in parent_text)
-                        has_correct_time = any(tv in parent_text for tv in time_variants)
-                        
-                        if has_class_name and has_correct_time:
-                            # Additional validation: make sure it's a reasonable-sized class card
-                            # (not the entire page body)
-                            text_length = len(parent_text)
-                            if 50 < text_length < 500:  # Class cards are typically 100-300 chars
-                                # Final check: ensure no OTHER times appear before our target time
-                                # This prevents matching a card that lists multiple classes
-                                lines = parent_text.split('\n')
-                                our_time_found = False
-                                wrong_class = False
-                                
-                                for line in lines:
-                                    # Check if this line has our target time
-                                    if any(tv in line for tv in time_variants):
-                                        # Check if our class name is near this time mention
-                                        if class_name_lower in parent_text[max(0, parent_text.find(line)-100):parent_text.find(line)+200]:
-                                            our_time_found = True
-                                            break
-                                
-                                if our_time_found:
-                                    print(f"  ✓ FOUND! {class_info['name']} at {class_info['time']}")
-                                    print(f"    Card size: {text_length} chars")
-                                    print(f"    Text preview: {parent_text[:150]}...")
-                                    target_class = parent_elem
-                                    break
-                        
-                        parent = parent_elem
-                    
-                    if target_class:
+            for cycle in range(1, cycles + 1):
+                print(f"\n--- Discovery cycle {cycle}/{cycles} ({requests['count']} requests so far) ---")
+                for studio_key, studio_targets in by_studio.items():
+                    studio = studio_targets[0]['studio']
+                    tz = ZoneInfo(studio.get('timezone', 'America/Toronto'))
+                    if not affordable():
+                        out_of_budget = True
                         break
-                        
-                except Exception as e:
-                    continue
+                    try:
+                        step(open_studio_page, page, config, studio)
+                    except Exception as e:
+                        print(f"  ⚠️ Could not open {studio['name']} this cycle: {str(e)}")
+                        continue
                     
-        except Exception as e:
-            print(f"  Error finding book buttons: {str(e)}")
-        
-        if not target_class:
-            print(f"Could not find class: {class_info['name']} at {class_info['time']}")
-            print("Taking screenshot for debugging...")
-            page.screenshot(path=f'error_class_not_found_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            return False
-        
-        # Look for "Book Now" button within the class container
-        print("Looking for Book Now button...")
-        try:
-            book_button = target_class.locator('button:has-text("Book"), button:has-text("Reserve"), button:has-text("BOOK")').first
-        except:
-            # Try to find it in a broader context
-            book_button = page.locator('button:has-text("Book Now"), button:has-text("Book"), button:has-text("Reserve"), button:has-text("BOOK")').first
-        
-        if not book_button:
-            print("Class found but no Book button available (might be full or already booked)")
-            page.screenshot(path=f'error_no_book_button_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            return False
-        
-        print("Clicking Book Now button...")
-        # Scroll to the button first (human behavior)
-        book_button.scroll_into_view_if_needed()
-        human_delay(300, 600)
-        random_mouse_movement(page)  # Move mouse around a bit
-        human_click(book_button, page)
-        
-        # Wait for page to start loading
-        print("Waiting for page to load after clicking Book Now...")
-        human_delay(2000, 3000)
-        
-        # Wait for network to be idle (page fully loaded)
-        try:
-            page.wait_for_load_state('networkidle', timeout=15000)
-            print("Page loaded successfully")
-        except:
-            print("Network idle timeout, continuing anyway...")
-            page.wait_for_load_state('load', timeout=10000)
-        
-        # Additional delay to ensure everything is rendered
-        human_delay(3000, 5000)
-        
-        # Check if we're being asked to login after clicking Book Now
-        print(f"After clicking Book Now - Current URL: {page.url}")
-        
-        # Check if we're on a sign-in page
-        if 'signin.mindbodyonline.com' in page.url or 'login' in page.url.lower():
-            print("⚠️ Login required after clicking Book Now. Logging in...")
-            
-            try:
-                # Wait for the page to fully load
-                page.wait_for_load_state('load', timeout=10000)
-                human_delay(2000, 3000)
-                
-                # Enter email
-                print(f"Entering email: {config['email']}")
-                email_input = page.wait_for_selector('input[type="email"], input[name="email"], input#email, input[id="EmailAddress"], input[placeholder*="email"]', timeout=10000)
-                human_click(email_input, page)
-                human_delay(200, 500)
-                human_type(email_input, config['email'], page)
-                human_delay(500, 1000)
-                
-                # Click continue
-                print("Clicking continue button...")
-                continue_button = page.wait_for_selector('button:has-text("Continue"), button[type="submit"], input[type="submit"]', timeout=10000)
-                human_click(continue_button, page)
-                human_delay(2000, 3000)
-                
-                # Enter password
-                print("Entering password...")
-                password_input = page.wait_for_selector('input[type="password"], input[name="password"], input[id="Password"]', timeout=10000)
-                human_click(password_input, page)
-                human_delay(200, 500)
-                human_type(password_input, password, page)
-                human_delay(500, 1000)
-                
-                # Submit
-                print("Submitting login form...")
-                submit_button = page.wait_for_selector('button[type="submit"], button:has-text("Sign in"), button:has-text("Log in"), input[type="submit"]', timeout=10000)
-                human_click(submit_button, page)
-                
-                print("Waiting for authentication to complete...")
-                page.wait_for_load_state('networkidle', timeout=30000)
-                human_delay(3000, 5000)
-                print(f"Login completed - New URL: {page.url}")
-            except Exception as e:
-                print(f"❌ Error during login after Book Now: {str(e)}")
-                page.screenshot(path=f'error_login_after_book_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-                return False
+                    today = datetime.now(tz).date()
+                    for offset in range(days_ahead + 1):
+                        date = today + timedelta(days=offset)
+                        day_targets = [t for t in studio_targets if t['weekday'].lower() == date.strftime('%A').lower()]
+                        if not day_targets:
+                            continue
+                        if not affordable():
+                            out_of_budget = True
+                            break
+                        try:
+                            if not step(select_date, page, datetime(date.year, date.month, date.day)):
+                                continue
+                            _, matches = step(scan_schedule, page, config, [t['class'] for t in day_targets])
+                        except Exception as e:
+                            # No card rendered, or the page broke: this reading is lost, not the run
+                            print(f"  ⚠️ Could not read {studio['name']} on {date.strftime('%a %d')}: {str(e)}")
+                            continue
+                        
+                        observed_at = datetime.now(tz)
+                        for target, (card, _) in zip(day_targets, matches):
+                            state = card_release_state(card)
+                            lead = (session_start(date, target['class'], tz) - observed_at).total_seconds() / 3600
+                            print(f"  {target['class']['name']} {date.strftime('%a %d')} {target['class']['time']}: "
+                                  f"{state} ({lead:.1f} h ahead)")
+                            observations.setdefault(target['key'], []).append({
+                                'session': date.isoformat(),
+                                'observed_at': observed_at.isoformat(),
+                                'lead_hours': round(lead, 3),
+                                'state': state
+                            })
+                    if out_of_budget:
+                        break
+                save_booking_windows(observations_file, observations)
+                if out_of_budget:
+                    print(f"⚠️ Request budget of {max_requests} reached, stopping discovery")
+                    break
+                if cycle < cycles:
+                    print(f"Next cycle in {interval_minutes} min...")
+                    time.sleep(interval_minutes * 60)
+        finally:
+            # Keep whatever was read even if discovery is interrupted
+            save_booking_windows(observations_file, observations)
         
-        # Check for CAPTCHA and solve with 2captcha if detected
-        print("Checking for CAPTCHA...")
-        print(f"Current URL before CAPTCHA check: {page.url}")
+        browser.close()
+    
+    rules = []
+    print("\n" + "="*60)
+    print("BOOKING WINDOWS")
+    print("="*60)
+    for target in targets:
+        tz = ZoneInfo(target['studio'].get('timezone', 'America/Toronto'))
+        target_observations = observations.get(target['key'], [])
+        lower, upper = infer_release_rule(target_observations)
+        rule = describe_release(config, target, lower, upper, tz)
+        rule['observations'] = len(target_observations)
+        rules.append(rule)
         
-        # Only check for CAPTCHA if we're not already on a booking/confirmation page
-        current_url = page.url.lower()
-        if 'book' in current_url or 'purchase' in current_url or 'checkout' in current_url or 'confirm' in current_url:
-            print("On booking/checkout page, skipping CAPTCHA check")
-        elif detect_captcha(page):
-            print("⚠ CAPTCHA detected! Attempting to solve with 2captcha...")
-            page.screenshot(path=f'captcha_detected_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            
-            # Try to solve with 2captcha
-            if not solve_recaptcha_v2(page, config):
-                print("❌ Failed to solve CAPTCHA, going back to retry booking...")
-                try:
-                    page.go_back()
-                    human_delay(2000, 3000)
-                except:
-                    pass
-                return False  # Retry this booking
-            
-            print("✓ CAPTCHA solved successfully, continuing...")
+        bounds = f"{'?' if lower is None else f'{lower:.1f}'}-{'?' if upper is None else f'{upper:.1f}'} h ahead"
+        print(f"{target['weekday']} {target['class']['time']} {target['class']['name']}: opens {bounds}")
+        if 'release_window' in rule:
+            print(f"  Release between {rule['release_window']['earliest']} and {rule['release_window']['latest']} "
+                  f"({rule['timezone']}); suggested cron: '{rule['cron_utc']}'")
         else:
-            print("No CAPTCHA detected, proceeding...")
-        
-        print(f"Current URL after CAPTCHA check: {page.url}")
-        
-        # Wait for the Buy button page to load
-        print("Waiting for Buy button...")
-        try:
-            buy_button = page.wait_for_selector('button:has-text("Buy"), button:has-text("Complete Purchase"), button:has-text("Confirm"), button:has-text("Complete"), button:has-text("Checkout")', timeout=15000)
-            if buy_button:
-                print(f"✓ Found Buy button! Text: {buy_button.inner_text()}")
-                print("Clicking Buy button to complete booking...")
-                # Scroll to button and move mouse naturally
-                buy_button.scroll_into_view_if_needed()
-                human_delay(500, 1000)
-                random_mouse_movement(page)
-                human_click(buy_button, page)
-                
-                # Wait for page to start processing
-                print("Waiting for booking to process...")
-                human_delay(3000, 4000)
-                
-                # Wait for network to be idle (booking processed)
-                try:
-                    page.wait_for_load_state('networkidle', timeout=15000)
-                    print("Booking processed successfully")
-                except:
-                    print("Network idle timeout, continuing anyway...")
-                    page.wait_for_load_state('load', timeout=10000)
-                
-                # Additional delay to ensure confirmation page is fully loaded
-                human_delay(4000, 6000)
-                print(f"After clicking Buy - Current URL: {page.url}")
-            else:
-                print("Buy button found but not visible")
-                return False
-        except PlaywrightTimeout:
-            print("⚠️ Buy button not found within 15 seconds")
-            print(f"Current URL: {page.url}")
-            page.screenshot(path=f'no_buy_button_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-            return False
-        
-        # CRITICAL: Check for CAPTCHA again after clicking Buy
-        print("Checking for CAPTCHA after clicking Buy...")
-        print(f"Current URL before CAPTCHA check: {page.url}")
-        
-        # Only check for CAPTCHA if we're not on a success/confirmation page
-        current_url = page.url.lower()
-        page_content = page.content().lower()
-        
-        # If we see success indicators, skip CAPTCHA check
-        success_keywords = ['success', 'confirmed', 'thank', 'confirmation', 'you\'re all set']
-        has_success = any(keyword in page_content or keyword in current_url for keyword in success_keywords)
+            print("  Not enough readings yet to bound the release (run discover again closer to it)")
+    print(f"Requests used: {requests['count']}/{max_requests}")
+    print("="*60)
+    
+    with open(plan_file, 'w') as f:
+        json.dump({
+            'generated_at': datetime.now().isoformat(),
+            'requests_used': requests['count'],
+            'classes': rules
+        }, f, indent=2, ensure_ascii=False)
+    print(f"Wrote {plan_file}")
+    return rules
+
+
+# ============================================================
+# BENCHMARKS
+# ============================================================
+
+def format_mb(num_bytes):
+    """Format a byte count in megabytes for bench and resource tables"""
+    return f"{num_bytes / (1024 * 1024):.0f} MB" if num_bytes else 'n/a'
+
+
+def bench_launch_profiles(config, names, runs=3, navigate=False):
+    """Measure launch time, first-page time and peak RSS for each launch profile"""
+    rows = []
+    with sync_playwright() as p:
+        baseline = sum(process_rss_bytes(pid) for pid in process_tree_pids(os.getpid())) if os.path.exists('/proc/self/statm') else 0
+        for name in names:
+            profile = get_launch_profile(config, name)
+            launch_times, page_times, peaks = [], [], []
+            print(f"Benchmarking launch profile '{name}' ({runs} run(s))...")
+            for run in range(runs):
+                with PeakRssSampler() as sampler:
+                    start = time.monotonic()
+                    browser = p.chromium.launch(**get_launch_options(profile))
+                    launch_times.append(time.monotonic() - start)
+                    
+                    start = time.monotonic()
+                    context = browser.new_context(**get_context_options(profile))
+                    page = context.new_page()
+                    page.add_init_script(get_stealth_scripts())
+                    if navigate:
+                        page.goto(config['homepage'], wait_until='load', timeout=60000)
+                    page_times.append(time.monotonic() - start)
+                    browser.close()
+                peaks.append(sampler.peak)
+            rows.append((name, statistics.median(launch_times), statistics.median(page_times), max(peaks)))
+    
+    print("\n" + "="*60)
+    print("LAUNCH PROFILE BENCHMARK")
+    print("="*60)
+    print(f"Baseline RSS (Python + driver): {format_mb(baseline)}")
+    page_label = 'first page' if navigate else 'new page'
+    print(f"{'profile':<16}{'launch':>10}{page_label:>12}{'peak RSS':>12}{'browser RSS':>14}")
+    for name, launch_time, page_time, peak in rows:
+        browser_rss = peak - baseline if peak else 0
+        print(f"{name:<16}{launch_time:>9.2f}s{page_time:>11.2f}s{format_mb(peak):>12}{format_mb(browser_rss):>14}")
+    print("="*60)
+    return rows
+
+
+SYNTHETIC_CLASSES = [
+    # Names that contain each other, accents and case variants are deliberate
+    ('Athlétique', 'Weight training'),
+    ('Athlétique Express', 'Weight training'),
+    ('Composition', 'Strength training'),
+    ('Composition Express', 'Strength training'),
+    ('Express', 'Cardio'),
+    ('Yoga', 'Mobility'),
+    ('Yoga Flow', 'Mobility'),
+    ('Spin', 'Cardio'),
+    ('Spin 45', 'Cardio'),
+    ('Book Club Run', 'Running'),
+]
+
+SYNTHETIC_INSTRUCTORS = ['Émile Charron', 'Emile Charron', 'Patricia Houde', 'Pat Houde', 'Noa Tremblay']
+
+
+def format_synthetic_time(minutes, style):
+    """Format minutes after midnight the way different schedule layouts print times"""
+    hour, minute = divmod(minutes, 60)
+    meridiem = 'am' if hour < 12 else 'pm'
+    hour12 = hour % 12 or 12
+    if style == 0:
+        return f"{hour12}:{minute:02d} {meridiem}"
+    if style == 1:
+        return f"{hour12}:{minute:02d}{meridiem.upper()}"
+    return f"{hour12}:{minute:02d}{meridiem}"
+
+
+def generate_schedule_html(card_count, nesting=3, seed=0):
+    """Build a synthetic schedule page with card_count class cards
+    
+    Returns (html, cards). Every (time, name) pair is unique so each card is a
+    single correct answer, but names are substrings of each other, times overlap
+    digit-wise ("9:30 am" and "19:30"), cards are wrapped in `nesting` levels of
+    layout divs and grouped into sections whose headers also contain times.
+    """
+    rng = random.Random(seed)
+    slots = [(start, cls) for start in range(6 * 60, 22 * 60, 5) for cls in SYNTHETIC_CLASSES]
+    rng.shuffle(slots)
+    slots = sorted(slots[:card_count], key=lambda slot: slot[0])
+    
+    cards = []
+    sections = {}
+    for index, (start, (name, class_type)) in enumerate(slots):
+        card = {
+            'id': f'card-{index}',
+            'time': format_synthetic_time(start, 2).replace(' ', ''),
+            'name': name,
+            'type': class_type,
+            'instructor': rng.choice(SYNTHETIC_INSTRUCTORS),
+            'bookable': rng.random() < 0.8,
+        }
+        cards.append(card)
         
-        if has_success:
-            print("Success page detected, skipping CAPTCHA check")
-        elif detect_captcha(page):
-            print("⚠ CAPTCHA detected after clicking Buy! Attempting to solve with 2captcha...")
-            page.screenshot(path=f'captcha_after_buy_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
+        button = '<button>Book</button>' if card['bookable'] else '<button disabled>Waitlist</button>'
+        body = (
+            f'<div class="time">{format_synthetic_time(start, index % 3)} - {format_synthetic_time(start + 60, index % 3)}</div>'
+            f'<div class="name">{name.upper() if index % 7 == 0 else name}</div>'
+            f'<div class="type">{class_type}</div>'
+            f'<div class="instructor">with {card["instructor"]}</div>'
+            f'<div class="spots">{rng.randint(0, 20)} spots left · {(start // 60 + 12) % 24}:30 studio B</div>'
+            f'{button}'
+        )
+        # The matcher takes the outermost wrapper as the card, so the id goes there
+        layers = ['class-card'] + [f'layout-{level}' for level in range(nesting)]
+        html = body
+        for depth, css_class in enumerate(layers):
+            marker = f' data-synthetic-id="{card["id"]}"' if depth == len(layers) - 1 else ''
+            html = f'<div class="{css_class}"{marker}>{html}</div>'
+        sections.setdefault(start // 60, []).append(html)
+    
+    page_parts = []
+    for hour, items in sorted(sections.items()):
+        header = f'<h2>{format_synthetic_time(hour * 60, 0)} - {format_synthetic_time(hour * 60 + 59, 0)}</h2>'
+        page_parts.append(f'<section class="hour">{header}{"".join(items)}</section>')
+    html = f'<html><body><nav><button>Book a class</button></nav><main>{"".join(page_parts)}</main></body></html>'
+    return html, cards
+
+
+def log_log_slope(points):
+    """Least-squares slope of log(cost) against log(size); 1.0 means linear growth"""
+    points = [(math.log(x), math.log(max(y, 1e-6))) for x, y in points]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance if variance else 0.0
+
+
+def bench_matcher(sizes, targets_per_size=5, max_slope=1.2, seed=0, call_baseline=None):
+    """Measure class matching correctness, wall time and Playwright calls against card count
+    
+    Fails (returns False) on any wrong match, if matching cost grows faster
+    than linearly with the number of cards, or if the calls per match exceed
+    the saved call_baseline file (written on the first run).
+    """
+    rng = random.Random(seed)
+    rows = []
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        page = browser.new_page()
+        for size in sizes:
+            html, cards = generate_schedule_html(size, seed=seed)
+            page.set_content(html)
             
-            # Try to solve with 2captcha
-            if not solve_recaptcha_v2(page, config):
-                print("❌ Failed to solve CAPTCHA after Buy, going back to retry booking...")
-                try:
-                    page.go_back()
-                    human_delay(2000, 3000)
-                except:
-                    pass
-                return False  # Retry this booking
+            bookable = [card for card in cards if card['bookable']]
+            # Always include the shortest names, whose longer variants are the usual trap
+            targets = [card for card in bookable if card['name'] in ('Composition', 'Express')][:2]
+            targets += rng.sample(bookable, min(targets_per_size, len(bookable)))
             
-            print("✓ CAPTCHA solved successfully after Buy button, continuing...")
+            correct, times, calls = 0, [], []
+            for card in targets:
+                stats = CallStats()
+                class_info = {'time': card['time'], 'name': card['name'], 'type': card['type']}
+                start = time.perf_counter()
+                _, locator = match_class_card(instrument(page, stats), class_info)
+                times.append(time.perf_counter() - start)
+                calls.append(stats.total_calls())
+                if locator and locator.get_attribute('data-synthetic-id') == card['id']:
+                    correct += 1
+                else:
+                    print(f"  ✗ Wrong match for {card['name']} at {card['time']} ({size} cards)")
+            rows.append((size, correct, len(targets), statistics.median(times), statistics.mean(calls)))
+        browser.close()
+    
+    time_slope = log_log_slope([(size, seconds) for size, _, _, seconds, _ in rows])
+    call_slope = log_log_slope([(size, n) for size, _, _, _, n in rows])
+    
+    print("\n" + "="*60)
+    print("CLASS MATCHER SCALING BENCHMARK")
+    print("="*60)
+    print(f"{'cards':>8}{'correct':>10}{'median time':>14}{'calls':>8}")
+    for size, correct, total, seconds, n in rows:
+        print(f"{size:>8}{f'{correct}/{total}':>10}{seconds * 1000:>12.1f}ms{n:>8.1f}")
+    print(f"Growth exponent: time {time_slope:.2f}, calls {call_slope:.2f} (limit {max_slope})")
+    print("="*60)
+    
+    calls_ok = True
+    if call_baseline:
+        calls_by_size = {str(size): n for size, _, _, _, n in rows}
+        if os.path.exists(call_baseline):
+            with open(call_baseline, 'r') as f:
+                baseline = json.load(f)
+            for size, n in calls_by_size.items():
+                if size in baseline and n > baseline[size] * 1.1:
+                    print(f"✗ Call count regressed at {size} cards: {n:.1f} vs baseline {baseline[size]:.1f}")
+                    calls_ok = False
         else:
-            print("No CAPTCHA detected after Buy button")
-        
-        # Handle any final confirmation dialogs
-        try:
-            confirm_button = page.wait_for_selector('button:has-text("Confirm"), button:has-text("Yes"), button:has-text("Done")', timeout=5000)
-            if confirm_button:
-                print("Clicking final confirmation button...")
-                human_click(confirm_button, page)
-                human_delay(2000, 3000)
-        except:
-            pass  # No additional confirmation needed
-        
-        # VERIFY THE BOOKING WAS SUCCESSFUL
-        print("Verifying booking success...")
-        human_delay(2000, 3000)
-        
-        # Take screenshot of final page
-        page.screenshot(path=f'booking_result_{class_info["name"]}_{class_info["time"].replace(":", "")}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-        
-        # Check for success indicators
-        page_content = page.content().lower()
-        page_url = page.url.lower()
-        
-        success_indicators = [
-            'success',
-            'confirmed',
-            'reservation confirmed',
-            'booking confirmed',
-            'you\'re all set',
-            'thanks',
-            'thank you',
-            'confirmation'
-        ]
-        
-        failure_indicators = [
-            'error',
-            'failed',
-            'unable to',
-            'try again',
-            'something went wrong'
-        ]
-        
-        # Check for failure first
-        for indicator in failure_indicators:
-            if indicator in page_content:
-                print(f"❌ Booking FAILED - Found failure indicator: '{indicator}'")
-                return False
-        
-        # Check for success
-        found_success = False
-        for indicator in success_indicators:
-            if indicator in page_content or indicator in page_url:
-                print(f"✓ Booking SUCCESS - Found success indicator: '{indicator}'")
-                found_success = True
-                break
-        
-        if not found_success:
-            print("⚠️ Could not verify booking success - no clear success indicator found")
-            print(f"Final URL: {page.url}")
-            # Consider this a failure to be safe
-            return False
-        
-        print(f"✓ Successfully booked and VERIFIED: {class_info['name']} at {class_info['time']}")
-        return True
+            with open(call_baseline, 'w') as f:
+                json.dump(calls_by_size, f, indent=2)
+            print(f"Saved call baseline to {call_baseline}")
+    
+    all_correct = all(correct == total for _, correct, total, _, _ in rows)
+    return all_correct and calls_ok and time_slope <= max_slope and call_slope <= max_slope
+
+
+# Hidden reCAPTCHA markup so the CAPTCHA helpers walk every selector during a soak
+SOAK_CAPTCHA_HTML = (
+    '<div style="display:none">'
+    '<div class="g-recaptcha" id="recaptcha-soak" data-sitekey="soak-site-key"></div>'
+    '<iframe title="reCAPTCHA" src="data:text/html,recaptcha?k=soak-site-key"></iframe>'
+    '</div>'
+)
+
+
+def bench_soak(cycles=2000, max_growth=10, seed=0):
+    """Repeat the schedule scan/match/CAPTCHA-check cycle on one page and watch live handles and JS heap
+    
+    Fails (returns False) if live handles grow by more than max_growth
+    between the end of the warm-up tenth and the last cycle.
+    """
+    global HUMAN_DELAY_SCALE
+    rng = random.Random(seed)
+    html, cards = generate_schedule_html(100, seed=seed)
+    html = html.replace('</body>', SOAK_CAPTCHA_HTML + '</body>')
+    bookable = [card for card in cards if card['bookable']]
+    checkpoints = sorted({max(1, cycles * step // 20) for step in range(1, 21)})
+    rows = []
+    scan_config = {'schedule': {'max_scroll_passes': 2}}
+    # Pacing would only stretch the soak; the handles are what is measured
+    delay_scale, HUMAN_DELAY_SCALE = HUMAN_DELAY_SCALE, 0.0
+    
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        page = instrument(browser.new_page(), CallStats())
+        page.set_content(html)
         
-    except Exception as e:
-        print(f"Error during class booking: {str(e)}")
-        print(traceback.format_exc())
-        page.screenshot(path=f'error_booking_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png')
-        return False
+        start = time.perf_counter()
+        for cycle in range(1, cycles + 1):
+            card = rng.choice(bookable)
+            with open(os.devnull, 'w') as quiet, redirect_stdout(quiet):
+                detect_captcha(page)
+                extract_recaptcha_sitekey(page)
+                _, [(_, locator)] = scan_schedule(page, scan_config, [{'time': card['time'], 'name': card['name']}])
+                if locator:
+                    locator.locator('button').first.get_attribute('disabled')
+            if cycle in checkpoints:
+                heap = page.evaluate('performance.memory ? performance.memory.usedJSHeapSize : 0')
+                rows.append((cycle, LIVE_HANDLES.live(page), heap, time.perf_counter() - start))
+        browser.close()
+    HUMAN_DELAY_SCALE = delay_scale
+    
+    print("\n" + "="*60)
+    print(f"HANDLE SOAK TEST ({cycles} cycles)")
+    print("="*60)
+    print(f"{'cycle':>8}{'live handles':>14}{'JS heap':>12}{'elapsed':>10}")
+    for cycle, live, heap, elapsed in rows:
+        print(f"{cycle:>8}{live:>14}{format_mb(heap):>12}{elapsed:>9.1f}s")
+    warmed = rows[1][1] if len(rows) > 1 else rows[0][1]
+    growth = rows[-1][1] - warmed
+    print(f"Live handle growth after warm-up: {growth} (limit {max_growth})")
+    print("="*60)
+    return growth <= max_growth
+
+
+def run_bench(config, args):
+    """Dispatch the bench subcommand; returns False when a benchmark check fails"""
+    if args.target == 'matcher':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        return bench_matcher(sizes, call_baseline=args.call_baseline)
+    if args.target == 'soak':
+        return bench_soak(args.cycles, args.max_handle_growth)
+    if args.target == 'faults':
+        if not args.har:
+            raise ValueError("bench faults needs --har (record one with --record)")
+        return bench_faults(config, args.har, args.scenario)
+    
+    names = args.launch_profile or sorted(config.get('launch_profiles', {})) or ['headed-debug']
+    bench_launch_profiles(config, names, runs=args.runs, navigate=args.navigate)
+    return True
+
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='MindBody Auto Booking Script')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, serve /metrics and book once per booking day')
+    parser.add_argument('--launch-profile', action='append', metavar='NAME',
+                        help='browser launch profile from config.json (bench accepts several)')
+    parser.add_argument('--record', metavar='HAR',
+                        help='record a read-only pass (homepage, sign-in, schedules) to a HAR file')
+    parser.add_argument('--replay', metavar='HAR',
+                        help='replay login and the schedule steps from a recorded HAR, offline')
+    parser.add_argument('--trace-calls', action='store_true',
+                        help='count and time every Playwright call and print a top-N report')
+    parser.add_argument('--sample-resources', action='store_true',
+                        help='sample CPU and memory of Python, the driver and Chromium by phase')
+    parser.add_argument('--browser-cache', action='store_true',
+                        help='keep the HTTP and code caches in a persistent browser profile (browser_cache.enabled)')
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help='sample the Python stack and write a speedscope (*.json) or collapsed-stack profile')
+    parser.add_argument('--profile-phases', metavar='PHASES',
+                        help='comma-separated booking phases to profile (default: the whole run)')
+    parser.add_argument('--profile-interval', type=float, default=5, metavar='MS',
+                        help='sampling interval in milliseconds')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    discover_parser = subparsers.add_parser('discover', help='observe the schedule to infer when classes open for booking')
+    discover_parser.add_argument('--cycles', type=int, help='number of reading cycles (discovery.cycles)')
+    discover_parser.add_argument('--interval', type=float, metavar='MINUTES',
+                                 help='minutes between cycles (discovery.interval_minutes)')
+    discover_parser.add_argument('--days-ahead', type=int, help='how many days of schedule to read (discovery.days_ahead)')
+    discover_parser.add_argument('--max-requests', type=int, help='request budget (discovery.max_requests)')
+    
+    bench_parser = subparsers.add_parser('bench', help='benchmark launch profiles or the class matcher, soak-test handles '
+                                                       'or time recovery from injected faults')
+    bench_parser.add_argument('target', nargs='?', choices=['launch', 'matcher', 'soak', 'faults'], default='launch')
+    bench_parser.add_argument('--runs', type=int, default=3, help='launches per profile')
+    bench_parser.add_argument('--navigate', action='store_true',
+                              help='also load the homepage in each launched browser')
+    bench_parser.add_argument('--sizes', default='25,50,100,200,400,800',
+                              help='comma-separated card counts for the matcher benchmark')
+    bench_parser.add_argument('--call-baseline', metavar='FILE',
+                              help='fail the matcher benchmark if Playwright calls exceed this saved baseline')
+    bench_parser.add_argument('--cycles', type=int, default=2000, help='query cycles for the soak test')
+    bench_parser.add_argument('--max-handle-growth', type=int, default=10,
+                              help='fail the soak test if live handles grow by more than this')
+    bench_parser.add_argument('--har', help='recorded HAR the fault scenarios replay against')
+    bench_parser.add_argument('--scenario', action='append', metavar='NAME',
+                              help='fault scenario from config.json to run (default: all)')
+    return parser.parse_args(argv)
 
 
 def main():
     """Main execution function"""
+    args = parse_args()
+    
     print("="*60)
     print("MindBody Auto Booking Script")
     print(f"Run time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z')}")
     print("="*60)
     
+    profiler = None
     try:
         # Load configuration
         config = load_config()
-        password = get_password()
+        if args.profile is not None:
+            phases = args.profile_phases.split(',') if args.profile_phases else None
+            profiler = SamplingProfiler(args.profile_interval / 1000.0, phases).start()
+        if args.launch_profile:
+            config['launch_profile'] = args.launch_profile[-1]
+        if args.trace_calls:
+            config.setdefault('instrumentation', {})['enabled'] = True
+        if args.sample_resources:
+            config.setdefault('resources', {})['enabled'] = True
+        if args.browser_cache:
+            config.setdefault('browser_cache', {})['enabled'] = True
         
-        # Determine target classes
-        booking_info = get_target_classes(config)
-        if not booking_info:
-            print("No booking scheduled for today. Exiting.")
+        if args.command == 'bench':
+            sys.exit(0 if run_bench(config, args) else 1)
+        
+        if args.command == 'discover':
+            discover_booking_windows(config, args.cycles, args.interval, args.days_ahead, args.max_requests)
             sys.exit(0)
         
-        target_day = booking_info['target_day']
-        classes = booking_info['classes']
-        target_date = calculate_target_date(target_day)
+        if args.record:
+            sys.exit(0 if record_har(config, args.record) else 1)
         
-        print(f"\nBooking {len(classes)} class(es) for {target_day}, {target_date.strftime('%B %d, %Y')}")
+        if args.replay:
+            sys.exit(0 if replay_har(config, args.replay) else 1)
         
-        # Start browser automation
-        with sync_playwright() as p:
-            # Launch with extra args to appear more human
-            browser = p.chromium.launch(
-                headless=False,
-                args=[
-                    '--disable-blink-features=AutomationControlled',
-                    '--disable-dev-shm-usage',
-                    '--no-sandbox',
-                    '--disable-web-security',
-                    '--disable-features=IsolateOrigins,site-per-process'
-                ]
-            )
-            
-            # Randomize viewport slightly
-            viewport_width = random.randint(1900, 1920)
-            viewport_height = random.randint(1040, 1080)
-            
-            context = browser.new_context(
-                viewport={'width': viewport_width, 'height': viewport_height},
-                user_agent=get_random_user_agent(),
-                locale='en-US',
-                timezone_id='America/Toronto',
-                permissions=['geolocation'],
-                geolocation={'latitude': 45.5017, 'longitude': -73.5673},  # Montreal
-            )
-            
-            page = context.new_page()
-            
-            # Inject stealth scripts
-            page.add_init_script(get_stealth_scripts())
-            
-            # Login once
-            login(page, config, password)
-            
-            # Book each class
-            results = []
-            for class_info in classes:
-                try:
-                    success = book_class(page, config, class_info, target_date, password)
-                    results.append({
-                        'class': class_info,
-                        'success': success
-                    })
-                    
-                    # Wait between bookings to avoid rate limiting
-                    if len(classes) > 1:
-                        human_delay(3000, 5000)
-                except Exception as e:
-                    print(f"Error booking {class_info['name']}: {str(e)}")
-                    results.append({
-                        'class': class_info,
-                        'success': False
-                    })
-            
-            # Summary
-            print("\n" + "="*60)
-            print("BOOKING SUMMARY")
-            print("="*60)
-            for result in results:
-                status = "✓ SUCCESS" if result['success'] else "✗ FAILED"
-                print(f"{status}: {result['class']['name']} at {result['class']['time']}")
-            print("="*60)
-            
-            browser.close()
+        if args.daemon:
+            run_daemon(config)
+        
+        results = run_once(config)
+        if not results:
+            print("No booking scheduled for today. Exiting.")
+            sys.exit(0)
         
         # Exit with appropriate code
         all_success = all(r['success'] for r in results)
@@ -1350,9 +5228,12 @@ def main():
         print(str(e))
         print(traceback.format_exc())
         sys.exit(1)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.summary()
+            profiler.write(get_profile_path(config, args.profile))
 
 
 if __name__ == '__main__':
     main()
-
-